@@ -0,0 +1,101 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Latency of the served requests and count of rejected ones during a traffic spike, with and without admission
+control.
+
+    python -m benchmarks.bench_admission [--capacity 8] [--service-time 0.05] [--spike 256]
+
+The fake LLM node serves `--capacity` calls at once in `--service-time` seconds each, further calls queue inside it.
+`--spike` requests arrive at once, and arrivals keep coming at the rate the node can serve for `--duration` seconds:
+    - `unlimited` sends them all to the node, every request waits behind the whole spike;
+    - `node_limit` adds the node with max_concurrency=capacity and a queue of `--max-queue` calls, the calls beyond
+      are rejected with a 429 error;
+    - `admission` also sets MEGASERVICE_MAX_PENDING_REQUESTS to capacity + max_queue, the requests beyond are
+      rejected with a 503 error before any node is called.
+"""
+
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+from fastapi import HTTPException
+
+from benchmarks.common import percentile, print_table, remote_node, start_server
+from cores.mega import orchestrator as orchestrator_module
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator
+
+
+async def start_llm(capacity: int, service_time: float):
+    slots = asyncio.Semaphore(capacity)
+
+    async def generate(request):
+        await request.read()
+        async with slots:
+            await asyncio.sleep(service_time)
+        return web.json_response({"text": "done"})
+
+    return await start_server({"/v1/chat/completions": generate})
+
+
+async def run_mode(mode: str, args) -> list:
+    runner, port = await start_llm(args.capacity, args.service_time)
+    orchestrator_module.MAX_PENDING_REQUESTS = args.capacity + args.max_queue if mode == "admission" else 0
+    orchestrator = ServiceOrchestrator()
+    llm = remote_node("llm", port, "/v1/chat/completions", ServiceType.UNDEFINED)
+    if mode == "unlimited":
+        orchestrator.add(llm)
+    else:
+        orchestrator.add(llm, max_concurrency=args.capacity, max_queue=args.max_queue)
+    served, rejected = [], {}
+
+    async def request():
+        start = time.perf_counter()
+        try:
+            await orchestrator.schedule({"text": "hi"})
+            served.append(time.perf_counter() - start)
+        except HTTPException as e:
+            rejected[e.status_code] = rejected.get(e.status_code, 0) + 1
+
+    async def steady_arrivals():
+        # the rate the node can serve
+        interval = args.service_time / args.capacity
+        tasks = []
+        for _ in range(int(args.duration / interval)):
+            tasks.append(asyncio.create_task(request()))
+            await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+
+    try:
+        await asyncio.gather(*(request() for _ in range(args.spike)), steady_arrivals())
+    finally:
+        await orchestrator.close()
+        await runner.cleanup()
+        orchestrator_module.MAX_PENDING_REQUESTS = 0
+    return [
+        mode,
+        len(served),
+        rejected.get(429, 0),
+        rejected.get(503, 0),
+        percentile(served, 0.5) * 1e3,
+        percentile(served, 0.99) * 1e3,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capacity", type=int, default=8, help="concurrent calls the node serves")
+    parser.add_argument("--service-time", type=float, default=0.05, help="seconds per call")
+    parser.add_argument("--spike", type=int, default=256, help="requests arriving at once")
+    parser.add_argument("--duration", type=float, default=2, help="seconds of steady arrivals after the spike")
+    parser.add_argument("--max-queue", type=int, default=16, help="calls waiting for a node slot")
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run_mode(mode, args)) for mode in ("unlimited", "node_limit", "admission")]
+    print_table(["mode", "served", "rejected_429", "rejected_503", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
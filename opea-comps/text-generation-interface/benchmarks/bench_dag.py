@@ -0,0 +1,98 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Query costs of the DAG, and per-request scheduling overhead of the compiled execution plan.
+
+    python -m benchmarks.bench_dag [--sizes 5,50,500,5000] [--repeat 200]
+
+The graphs are layered: `width` nodes per level, each one depending on two nodes of the previous level, their build
+time is measured by bench_dag_build. The per-request section runs what `schedule()` does with the graph of a request,
+without calling any micro service: compare the RuntimeGraph view of the compiled plan with the deep copy of the graph
+done before the plan existed.
+"""
+
+import argparse
+import copy
+import random
+import timeit
+
+from benchmarks.common import print_table
+from cores.mega.dag import DAG
+from cores.mega.execution_plan import ExecutionPlan, RuntimeGraph
+
+
+def layered_graph(size: int, width: int = 8, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    nodes = [f"n{i}" for i in range(size)]
+    graph = {node: [] for node in nodes}
+    for i in range(width, size):
+        level_start = (i // width - 1) * width
+        for predecessor in rng.sample(range(level_start, level_start + width), 2):
+            graph[nodes[predecessor]].append(nodes[i])
+    return graph
+
+
+def walk(runtime_graph, ind_nodes):
+    """The graph operations of one request: walk the nodes, look up their predecessors, prune the graph."""
+    for node in runtime_graph.topological_sort():
+        for successor in runtime_graph.downstream(node):
+            runtime_graph.predecessors(successor)
+    runtime_graph.all_leaves()
+    if hasattr(runtime_graph, "prune"):
+        runtime_graph.prune(ind_nodes)
+
+
+def per_request_plan(plan: ExecutionPlan):
+    walk(RuntimeGraph(plan), plan.ind_nodes)
+
+
+def per_request_copy(dag: DAG):
+    # what schedule() did for every request before the plan: a deep copy of the graph, then the same walk
+    runtime_graph = DAG()
+    runtime_graph.graph = copy.deepcopy(dag.graph)
+    walk(runtime_graph, runtime_graph.ind_nodes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="5,50,500,5000", help="comma separated node counts")
+    parser.add_argument("--repeat", type=int, default=200, help="runs of each query for 50 nodes, fewer for more")
+    args = parser.parse_args()
+
+    query_rows, request_rows = [], []
+    for size in map(int, args.sizes.split(",")):
+        graph = layered_graph(size)
+        number = max(10, args.repeat * 50 // size)
+        dag = DAG()
+        dag.from_dict(graph)
+        node = f"n{size // 2}"
+        queries = {
+            "predecessors": lambda: dag.predecessors(node),
+            "downstream": lambda: dag.downstream(node),
+            "topological_sort": lambda: dag.topological_sort(),
+            "levels": lambda: dag.levels(),
+        }
+        row = [size, sum(map(len, graph.values()))]
+        for query in queries.values():
+            # the order and the levels are cached until the graph changes
+            query()
+            row.append(timeit.timeit(query, number=number) / number * 1e6)
+        query_rows.append(row)
+
+        plan = ExecutionPlan.compile(dag)
+        compile_time = timeit.timeit(lambda: ExecutionPlan.compile(dag), number=number) / number
+        plan_time = timeit.timeit(lambda: per_request_plan(plan), number=number) / number
+        copy_time = timeit.timeit(lambda: per_request_copy(dag), number=number) / number
+        request_rows.append(
+            [size, compile_time * 1e6, plan_time * 1e6, plan_time / size * 1e9, copy_time * 1e6, copy_time / plan_time]
+        )
+
+    print("DAG queries (us per call)")
+    print_table(["nodes", "edges", "predecessors", "downstream", "topo_sort", "levels"], query_rows)
+    print()
+    print("Per-request graph overhead (us per request)")
+    print_table(["nodes", "compile_once", "plan_view", "ns_per_node", "deep_copy", "speedup"], request_rows)
+
+
+if __name__ == "__main__":
+    main()
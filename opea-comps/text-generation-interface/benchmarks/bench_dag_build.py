@@ -0,0 +1,111 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Build time of large DAGs, by way of inserting the edges, and how it scales with the size of the graph.
+
+    python -m benchmarks.bench_dag_build [--sizes 500,1000,2000,4000,8000] [--baseline-max 500]
+
+The graphs are the layered graphs of bench_dag. `in order` adds the edges one by one in the order of the graph,
+which is how megaservices call flow_to(), `shuffled` adds the nodes and the edges one by one in random order, so that
+most edges go against the maintained topological order, and `add_edges` inserts the shuffled edges at once,
+sorting the graph once. `baseline` is the DAG before the predecessors were indexed: a deep copy of the graph and a
+full topological sort for every edge, only run up to `--baseline-max` nodes. `exponent` is the growth of the build
+time against the previous size, 1 for a linear build and 2 for a quadratic one.
+"""
+
+import argparse
+import copy
+import math
+import random
+import timeit
+
+from benchmarks.bench_dag import layered_graph
+from benchmarks.common import print_table
+from cores.mega.dag import DAG
+
+
+def edges_of(graph: dict) -> list:
+    return [(node, successor) for node, successors in graph.items() for successor in successors]
+
+
+def shuffled(graph: dict):
+    rng = random.Random(1)
+    nodes = list(graph)
+    rng.shuffle(nodes)
+    edges = edges_of(graph)
+    rng.shuffle(edges)
+    return nodes, edges
+
+
+def build_in_order(graph: dict, nodes: list, edges: list) -> DAG:
+    dag = DAG()
+    for node in graph:
+        dag.add_node(node)
+    for ind_node, dep_node in edges_of(graph):
+        dag.add_edge(ind_node, dep_node)
+    return dag
+
+
+def build_shuffled(graph: dict, nodes: list, edges: list) -> DAG:
+    dag = DAG()
+    for node in nodes:
+        dag.add_node(node)
+    for ind_node, dep_node in edges:
+        dag.add_edge(ind_node, dep_node)
+    return dag
+
+
+def build_add_edges(graph: dict, nodes: list, edges: list) -> DAG:
+    dag = DAG()
+    for node in nodes:
+        dag.add_node(node)
+    dag.add_edges(edges)
+    return dag
+
+
+def build_baseline(graph: dict, nodes: list, edges: list) -> DAG:
+    # add_edge() before the predecessors were indexed: validate a copy of the graph with the edge added
+    dag = DAG()
+    successors = {node: set() for node in nodes}
+    for ind_node, dep_node in edges:
+        candidate = copy.deepcopy(successors)
+        candidate[ind_node].add(dep_node)
+        if not dag.validate(candidate):
+            raise Exception("validation error!")
+        successors = candidate
+    dag.graph = successors
+    return dag
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="500,1000,2000,4000,8000", help="comma separated node counts")
+    parser.add_argument("--baseline-max", type=int, default=500, help="largest graph built by the baseline")
+    args = parser.parse_args()
+
+    modes = {
+        "in order": build_in_order,
+        "shuffled": build_shuffled,
+        "add_edges": build_add_edges,
+        "baseline": build_baseline,
+    }
+    rows = []
+    previous = {}
+    for size in map(int, args.sizes.split(",")):
+        graph = layered_graph(size)
+        nodes, edges = shuffled(graph)
+        for name, build in modes.items():
+            if name == "baseline" and size > args.baseline_max:
+                continue
+            elapsed = min(timeit.repeat(lambda: build(graph, nodes, edges), number=1, repeat=3))
+            exponent = math.nan
+            if name in previous:
+                previous_size, previous_elapsed = previous[name]
+                exponent = math.log(elapsed / previous_elapsed) / math.log(size / previous_size)
+            previous[name] = size, elapsed
+            rows.append([name, size, len(edges), elapsed * 1e3, elapsed / len(edges) * 1e6, exponent])
+    print_table(["mode", "nodes", "edges", "build_ms", "us_per_edge", "exponent"], rows)
+
+
+if __name__ == "__main__":
+    main()
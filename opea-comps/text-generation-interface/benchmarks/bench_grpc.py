@@ -0,0 +1,121 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Embedding -> retriever hops over gRPC against the same hops over HTTP/JSON.
+
+    python -m benchmarks.bench_grpc [--concurrency 1,16,64] [--requests 2000] [--dim 768] [--docs 10]
+
+A micro service process serves an embedding route (TextDoc -> EmbedDoc of `--dim` floats) and a retriever route
+(EmbedDoc -> SearchedDoc of `--docs` 1 KB documents) both over HTTP and gRPC. The megaservice schedules `--requests`
+requests through the two nodes with `http_json` (MEGASERVICE_GRPC=false), `grpc_json`, and `grpc_msgpack` when
+msgpack is installed. CPU time is measured in the megaservice process.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from benchmarks.common import Timer, free_port, percentile, print_table, wait_for_port
+from cores.mega import grpc_service
+from cores.mega import orchestrator as orchestrator_module
+from cores.mega.constants import ServiceType
+from cores.mega.micro_service import MicroService
+from cores.mega.orchestrator import ServiceOrchestrator
+
+
+def serve(port: int, grpc_port: int, dim: int, docs: int):
+    import logging
+
+    from cores.mega.micro_service import opea_microservices, register_microservice
+    from cores.proto.docarray import EmbedDoc, SearchedDoc, TextDoc
+
+    logging.getLogger("uvicorn.access").disabled = True
+    name = "opea_service@bench_retrieval"
+    options = dict(name=name, host="127.0.0.1", port=port, grpc_port=grpc_port)
+
+    @register_microservice(endpoint="/v1/embeddings", service_type=ServiceType.EMBEDDING, **options)
+    async def embed(input: TextDoc) -> EmbedDoc:
+        return EmbedDoc(text=input.text, embedding=[0.123456789] * dim)
+
+    @register_microservice(endpoint="/v1/retrieval", service_type=ServiceType.RETRIEVER, **options)
+    async def retrieve(input: EmbedDoc) -> SearchedDoc:
+        retrieved = [TextDoc(text="x" * 1024) for _ in range(docs)]
+        return SearchedDoc(retrieved_docs=retrieved, initial_query=input.text)
+
+    opea_microservices[name].start()
+
+
+def remote_node(name, port, grpc_port, endpoint, service_type) -> MicroService:
+    return MicroService(
+        name,
+        host="127.0.0.1",
+        port=port,
+        endpoint=endpoint,
+        use_remote_service=True,
+        service_type=service_type,
+        grpc_port=grpc_port,
+    )
+
+
+async def run_mode(mode: str, port: int, grpc_port: int, concurrency: int, requests: int) -> list:
+    orchestrator_module.GRPC = mode != "http_json"
+    grpc_service.GRPC_ENCODING = "msgpack" if mode == "grpc_msgpack" else "json"
+    orchestrator = ServiceOrchestrator()
+    embedding = remote_node("embedding", port, grpc_port, "/v1/embeddings", ServiceType.EMBEDDING)
+    retriever = remote_node("retriever", port, grpc_port, "/v1/retrieval", ServiceType.RETRIEVER)
+    orchestrator.add(embedding).add(retriever).flow_to(embedding, retriever)
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            result_dict, _ = await orchestrator.schedule({"text": "what is a megaservice?"})
+            assert retriever.name in result_dict
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        await orchestrator.schedule({"text": "warm up"})
+        with Timer() as timer:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+    finally:
+        await orchestrator.close()
+    return [
+        mode,
+        concurrency,
+        requests / timer.wall,
+        timer.cpu / requests * 1e6,
+        percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.99) * 1e3,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,16,64", help="comma separated counts of concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per run")
+    parser.add_argument("--dim", type=int, default=768, help="size of the embeddings")
+    parser.add_argument("--docs", type=int, default=10, help="documents retrieved")
+    args = parser.parse_args()
+    if not grpc_service.grpc_available():
+        raise SystemExit("grpcio is required")
+
+    port, grpc_port = free_port(), free_port()
+    server = multiprocessing.Process(target=serve, args=(port, grpc_port, args.dim, args.docs), daemon=True)
+    server.start()
+    wait_for_port(port)
+    wait_for_port(grpc_port)
+    modes = ["http_json", "grpc_json"] + (["grpc_msgpack"] if grpc_service.msgpack is not None else [])
+    rows = []
+    try:
+        for concurrency in map(int, args.concurrency.split(",")):
+            for mode in modes:
+                rows.append(asyncio.run(run_mode(mode, port, grpc_port, concurrency, args.requests)))
+    finally:
+        server.terminate()
+    print_table(["mode", "clients", "requests/s", "cpu_us/request", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Co-located micro service called in-process by the orchestrator, against the same call over loopback HTTP.
+
+    python -m benchmarks.bench_inprocess [--concurrency 1,16,64] [--requests 2000] [--dim 768]
+
+An embedding micro service is registered in this process, returning an EmbedDoc of `--dim` floats, and a
+megaservice schedules `--requests` requests through it. `inprocess` calls the route handler with the validated
+TextDoc, `loopback` (MEGASERVICE_INPROCESS=false) goes through JSON, TCP, uvicorn and FastAPI. Both share the event
+loop of the micro service, as in a single process deployment; uvicorn access logs are disabled.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from benchmarks.common import Timer, free_port, percentile, print_table
+from cores.mega import orchestrator as orchestrator_module
+from cores.mega.constants import ServiceType
+from cores.mega.micro_service import opea_microservices, register_microservice
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.proto.docarray import EmbedDoc, TextDoc
+
+
+def register_embedding(dim: int):
+    @register_microservice(
+        name="opea_service@bench_embedding",
+        service_type=ServiceType.EMBEDDING,
+        host="127.0.0.1",
+        port=free_port(),
+        endpoint="/v1/embeddings",
+        input_datatype=TextDoc,
+        output_datatype=EmbedDoc,
+    )
+    async def embed(input: TextDoc) -> EmbedDoc:
+        return EmbedDoc(text=input.text, embedding=[0.5] * dim)
+
+    return opea_microservices["opea_service@bench_embedding"]
+
+
+async def run_mode(service, mode: str, concurrency: int, requests: int) -> list:
+    orchestrator_module.INPROCESS = mode == "inprocess"
+    orchestrator = ServiceOrchestrator()
+    orchestrator.add(service)
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            await orchestrator.schedule({"text": "a sentence to embed"})
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        await orchestrator.schedule({"text": "warm up"})
+        with Timer() as timer:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+    finally:
+        await orchestrator.close()
+        orchestrator_module.INPROCESS = True
+    return [
+        mode,
+        concurrency,
+        requests / timer.wall,
+        timer.cpu / requests * 1e6,
+        percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.99) * 1e3,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,16,64", help="comma separated counts of concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per run")
+    parser.add_argument("--dim", type=int, default=768, help="size of the embeddings")
+    args = parser.parse_args()
+
+    logging.getLogger("uvicorn.access").disabled = True
+    service = register_embedding(args.dim)
+    # serve HTTP on the loop the service was set up on
+    serving = service.event_loop.create_task(service.execute_server())
+    rows = []
+    try:
+        for concurrency in map(int, args.concurrency.split(",")):
+            for mode in ("inprocess", "loopback"):
+                rows.append(service.event_loop.run_until_complete(run_mode(service, mode, concurrency, args.requests)))
+    finally:
+        service.event_loop.run_until_complete(service.terminate_server())
+        serving.cancel()
+    print_table(["mode", "clients", "requests/s", "cpu_us/request", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
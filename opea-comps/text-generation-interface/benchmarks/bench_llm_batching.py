@@ -0,0 +1,153 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Throughput of the LLM micro service with and without dynamic batching of its `completions` calls.
+
+    python -m benchmarks.bench_llm_batching [--concurrency 1,16,64] [--requests 512]
+
+A stub OpenAI-compatible backend serves `/v1/completions` one call at a time, each call costing `--call-time` seconds
+plus `--prompt-time` seconds per prompt, like a model server whose batches amortize the cost of a step. The LLM micro
+service (opea_llm_microservice.py, with OpeaTextGenService) runs in a process of its own on port 9000, with
+LLM_DYNAMIC_BATCHING=false then true, and `--requests` non-streaming LLMParamsDoc are sent to it. `backend_calls` is
+the count of `completions` calls the backend received.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.common import percentile, print_table, start_server, wait_for_port
+
+LLM_PORT = 9000
+MODEL = "bench-model"
+
+
+def serve_backend(connection, call_time: float, prompt_time: float, calls):
+    async def run():
+        # the backend runs one call at a time
+        step = asyncio.Lock()
+
+        async def completions(request):
+            body = await request.json()
+            prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+            n = body.get("n") or 1
+            async with step:
+                await asyncio.sleep(call_time + prompt_time * len(prompts))
+            with calls.get_lock():
+                calls.value += 1
+            choices = [
+                {"index": i * n + j, "text": f"reply to {prompt}", "finish_reason": "length", "logprobs": None}
+                for i, prompt in enumerate(prompts)
+                for j in range(n)
+            ]
+            return web.json_response(
+                {
+                    "id": "cmpl-bench",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": MODEL,
+                    "choices": choices,
+                    "usage": {"prompt_tokens": len(prompts), "completion_tokens": len(choices), "total_tokens": 0},
+                }
+            )
+
+        runner, port = await start_server({"/v1/completions": completions})
+        connection.send(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def start_llm_service(backend_port: int, batching: bool, args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        LLM_ENDPOINT=f"http://127.0.0.1:{backend_port}",
+        LLM_MODEL_ID=MODEL,
+        LLM_COMPONENT_NAME="OpeaTextGenService",
+        LLM_DYNAMIC_BATCHING=str(batching).lower(),
+        LLM_DYNAMIC_BATCHING_TIMEOUT=str(args.batch_timeout),
+        LLM_DYNAMIC_BATCHING_MAX_BATCH_SIZE=str(args.max_batch_size),
+    )
+    process = subprocess.Popen(
+        [sys.executable, "opea_llm_microservice.py"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(LLM_PORT, timeout=60)
+    except OSError:
+        process.kill()
+        raise SystemExit("the LLM micro service did not start, run opea_llm_microservice.py to see why")
+    return process
+
+
+async def run_clients(concurrency: int, requests: int):
+    latencies = []
+    remaining = iter(range(requests))
+    url = f"http://127.0.0.1:{LLM_PORT}/v1/chat/completions"
+
+    async def client(session):
+        for i in remaining:
+            start = time.perf_counter()
+            payload = {"query": f"question {i}", "max_tokens": 16, "stream": False}
+            async with session.post(url, json=payload) as response:
+                response.raise_for_status()
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        return time.perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,16,64", help="comma separated counts of concurrent clients")
+    parser.add_argument("--requests", type=int, default=512, help="requests per run")
+    parser.add_argument("--call-time", type=float, default=0.02, help="backend seconds per completions call")
+    parser.add_argument("--prompt-time", type=float, default=0.001, help="backend seconds per prompt of a call")
+    parser.add_argument("--batch-timeout", type=float, default=0.01, help="LLM_DYNAMIC_BATCHING_TIMEOUT")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="LLM_DYNAMIC_BATCHING_MAX_BATCH_SIZE")
+    args = parser.parse_args()
+
+    calls = multiprocessing.Value("i", 0)
+    parent, child = multiprocessing.Pipe()
+    backend = multiprocessing.Process(
+        target=serve_backend, args=(child, args.call_time, args.prompt_time, calls), daemon=True
+    )
+    backend.start()
+    backend_port = parent.recv()
+    rows = []
+    try:
+        for batching in (False, True):
+            service = start_llm_service(backend_port, batching, args)
+            try:
+                for concurrency in map(int, args.concurrency.split(",")):
+                    calls.value = 0
+                    elapsed, latencies = asyncio.run(run_clients(concurrency, args.requests))
+                    rows.append(
+                        [
+                            "batched" if batching else "unbatched",
+                            concurrency,
+                            args.requests / elapsed,
+                            calls.value,
+                            percentile(latencies, 0.5) * 1e3,
+                            percentile(latencies, 0.99) * 1e3,
+                        ]
+                    )
+            finally:
+                service.terminate()
+                service.wait()
+    finally:
+        backend.terminate()
+    print_table(["mode", "clients", "requests/s", "backend_calls", "p50_ms", "p99_ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Memory per request of a fan-out/fan-in graph, keeping or releasing the intermediate results.
+
+    python -m benchmarks.bench_memory [--branches 4] [--payload-mb 4] [--concurrency 1,8]
+
+A retriever node returns `--payload-mb` MB of documents to `--branches` nodes, each returning a payload of the same
+size to a last node that merges them and returns a small reply. The micro services run in a process of their own,
+so that tracemalloc only accounts for the megaservice: `peak` is the highest memory allocated during the run, and
+`retained` what the results returned by schedule() still hold, both per request. With
+MEGASERVICE_KEEP_INTERMEDIATE_RESULTS=false the output of a node is dropped once all its successors consumed it.
+"""
+
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import tracemalloc
+
+from aiohttp import web
+
+from benchmarks.common import print_table, remote_node, start_server
+from cores.mega import orchestrator as orchestrator_module
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator
+
+
+def serve(connection, payload_size: int):
+    async def retrieve(request):
+        await request.read()
+        return web.json_response({"text": "query", "retrieved_docs": ["d" * 1024] * (payload_size // 1024)})
+
+    async def branch(request):
+        await request.read()
+        name = request.match_info["name"]
+        return web.json_response({name: "b" * payload_size})
+
+    async def merge(request):
+        body = await request.json()
+        return web.json_response({"text": "done", "merged": sorted(body)})
+
+    async def run():
+        runner, port = await start_server({"/v1/retrieval": retrieve, "/v1/branch/{name}": branch, "/v1/merge": merge})
+        connection.send(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def build(port: int, branches: int) -> ServiceOrchestrator:
+    orchestrator = ServiceOrchestrator()
+    retriever = remote_node("retriever", port, "/v1/retrieval", ServiceType.RETRIEVER)
+    merger = remote_node("merger", port, "/v1/merge", ServiceType.UNDEFINED)
+    orchestrator.add(retriever).add(merger)
+    for i in range(branches):
+        node = remote_node(f"branch{i}", port, f"/v1/branch/branch{i}", ServiceType.UNDEFINED)
+        orchestrator.add(node).flow_to(retriever, node)
+        orchestrator.flow_to(node, merger)
+    return orchestrator
+
+
+async def run_mode(port: int, keep: bool, branches: int, concurrency: int) -> list:
+    orchestrator_module.KEEP_INTERMEDIATE_RESULTS = keep
+    orchestrator = build(port, branches)
+    try:
+        # warm up the connection pool and the imports outside of the measurement
+        await orchestrator.schedule({"text": "query"})
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        results = await asyncio.gather(*(orchestrator.schedule({"text": "query"}) for _ in range(concurrency)))
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        kept = len(results[0][0])
+    finally:
+        await orchestrator.close()
+        orchestrator_module.KEEP_INTERMEDIATE_RESULTS = True
+    mb = 1024 * 1024
+    return [
+        "keep" if keep else "release",
+        concurrency,
+        kept,
+        (peak - baseline) / concurrency / mb,
+        (current - baseline) / concurrency / mb,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--branches", type=int, default=4, help="nodes between the retriever and the merger")
+    parser.add_argument("--payload-mb", type=float, default=4, help="size of the output of each intermediate node")
+    parser.add_argument("--concurrency", default="1,8", help="comma separated counts of concurrent requests")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, int(args.payload_mb * 1024 * 1024)), daemon=True)
+    server.start()
+    port = parent.recv()
+    rows = []
+    try:
+        for concurrency in map(int, args.concurrency.split(",")):
+            for keep in (True, False):
+                rows.append(asyncio.run(run_mode(port, keep, args.branches, concurrency)))
+    finally:
+        server.terminate()
+    print_table(["results", "requests", "nodes_kept", "peak_mb/request", "retained_mb/request"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Receive-side cost of a large media payload sent inline or as a shared memory handle, by payload size.
+
+    python -m benchmarks.bench_shm [--sizes-mb 1,8,32] [--requests 20]
+
+A FastAPI route taking a Base64ByteStrDoc, as the ASR or image micro services do, is called through its ASGI app
+without any socket, so that only what the micro service does with the request body is measured: `inline` parses the
+base64 payload from the JSON body, `round trip` resolves the handle in a middleware that encodes the body again as
+JSON, as done before the handles were resolved by the route, and `route` resolves the handle of the validated doc
+with SharedPayloadRoute. `cpu_ms` is the CPU time and `peak_mb` the highest memory allocated per request.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+from fastapi import FastAPI
+
+from benchmarks.common import print_table
+from cores.mega.shm import SharedPayloadRoute, SharedPayloadStore, resolve_shared_payloads
+from cores.proto.docarray import Base64ByteStrDoc
+
+
+class RoundTripMiddleware:
+    """Resolve the handles of the JSON body and encode it again before the route parses it."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        body = json.dumps(resolve_shared_payloads(json.loads(message["body"]))).encode("utf-8")
+        headers = [(key, value) for key, value in scope["headers"] if key != b"content-length"]
+        scope = dict(scope, headers=headers + [(b"content-length", b"%d" % len(body))])
+        replayed = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def replay():
+            return replayed.pop() if replayed else await receive()
+
+        await self.app(scope, replay, send)
+
+
+def make_app(mode: str) -> FastAPI:
+    app = FastAPI()
+    if mode == "route":
+        app.router.route_class = SharedPayloadRoute
+    elif mode == "round trip":
+        app.add_middleware(RoundTripMiddleware)
+
+    @app.post("/v1/asr")
+    async def asr(doc: Base64ByteStrDoc):
+        return {"size": len(doc.byte_str)}
+
+    return app
+
+
+async def post(app, body: bytes) -> dict:
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": "/v1/asr",
+        "raw_path": b"/v1/asr",
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", b"%d" % len(body))],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    return json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+async def run_mode(mode: str, payload: str, handle: str, requests: int) -> list:
+    app = make_app(mode)
+    body = json.dumps({"byte_str": payload if mode == "inline" else handle}).encode("utf-8")
+    # warm up the app outside of the measurement
+    assert (await post(app, body))["size"] == len(payload)
+    start = time.process_time()
+    for _ in range(requests):
+        await post(app, body)
+    cpu = (time.process_time() - start) / requests
+    tracemalloc.start()
+    await post(app, body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return [mode, len(payload) / 2**20, len(body), cpu * 1e3, peak / 2**20]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", default="1,8,32", help="comma separated payload sizes in MB")
+    parser.add_argument("--requests", type=int, default=20, help="requests per mode and size")
+    args = parser.parse_args()
+
+    store = SharedPayloadStore(min_size=0)
+    rows = []
+    try:
+        for size in map(float, args.sizes_mb.split(",")):
+            payload = base64.b64encode(os.urandom(int(size * 2**20) * 3 // 4)).decode("ascii")
+            handle = store.export(payload)
+            for mode in ("inline", "round trip", "route"):
+                rows.append(asyncio.run(run_mode(mode, payload, handle, args.requests)))
+            store.release(handle)
+    finally:
+        store.close()
+    print_table(["mode", "payload_mb", "body_bytes", "cpu_ms", "peak_mb"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""CPU per token of the SSE framing of streamed LLM replies, by count of interleaved streams.
+
+    python -m benchmarks.bench_sse [--streams 1,64,1024] [--tokens 256]
+
+The framing alone is measured, in process and without I/O: `--streams` token streams in the `data: b'...'` format of
+the LLM micro services are fed chunk by chunk, their chunks interleaved as when the streams are read concurrently.
+`passthrough` counts the token events of a stream forwarded as is, `downstream` decodes the tokens into sentences and
+re-encodes the text of each sentence as token events, the downstream node being left out. `legacy` is the framing of
+the baseline orchestrator: every chunk decoded to str and sliced by `extract_chunk_str`, and the tokens encoded as str.
+With `--split` the chunks are cut at arbitrary bytes instead of event boundaries, as TCP may deliver them; `correct`
+tells whether the re-encoded tokens still spell the text of the stream.
+"""
+
+import argparse
+import random
+import re
+import time
+
+from benchmarks.common import print_table
+from cores.mega.sse import DONE_DATA, DONE_EVENT, TOKEN_PATTERN, SSEDecoder, SSEEventCounter, decode_token, encode_token
+
+HITTED_ENDS = [".", "?", "!", "。", "，", "！"]
+
+
+def make_stream(tokens: int) -> bytes:
+    words = [" word." if i % 8 == 7 else " word" for i in range(tokens)]
+    return b"".join(b"data: " + repr(word.encode()).encode() + b"\n\n" for word in words) + DONE_EVENT
+
+
+def chunked(stream: bytes, split: bool, rng: random.Random) -> list:
+    events = [event + b"\n\n" for event in stream.split(b"\n\n")[:-1]]
+    if not split:
+        return events
+    chunks, start = [], 0
+    while start < len(stream):
+        end = start + rng.randint(1, 48)
+        chunks.append(stream[start:end])
+        start = end
+    return chunks
+
+
+def interleave(streams: list) -> list:
+    # (stream index, chunk) in the order the chunks of concurrent streams are read
+    longest = max(map(len, streams))
+    return [(i, chunks[n]) for n in range(longest) for i, chunks in enumerate(streams) if n < len(chunks)]
+
+
+def legacy_extract_chunk_str(chunk_str: str) -> str:
+    if chunk_str == "data: [DONE]\n\n":
+        return ""
+    prefix = "data: b'"
+    prefix_2 = 'data: b"'
+    suffix = "'\n\n"
+    suffix_2 = '"\n\n'
+    if chunk_str.startswith(prefix) or chunk_str.startswith(prefix_2):
+        chunk_str = chunk_str[len(prefix) :]
+    if chunk_str.endswith(suffix) or chunk_str.endswith(suffix_2):
+        chunk_str = chunk_str[: -len(suffix)]
+    return chunk_str
+
+
+def legacy_token_generator(sentence: str, is_last: bool):
+    for token in re.findall(r"\s?\S+\s?", sentence, re.UNICODE):
+        yield "data: " + repr(token.replace("\\n", "\n").encode("utf-8")) + "\n\n"
+    if is_last:
+        yield "data: [DONE]\n\n"
+
+
+def legacy_downstream(chunks: list, count: int) -> list:
+    buffered = [""] * count
+    outputs = [[] for _ in range(count)]
+    for i, chunk in chunks:
+        chunk = chunk.decode("utf-8")
+        buffered[i] += legacy_extract_chunk_str(chunk)
+        is_last = chunk.endswith("[DONE]\n\n")
+        if (buffered[i] and buffered[i][-1] in HITTED_ENDS) or is_last:
+            outputs[i].extend(token.encode("utf-8") for token in legacy_token_generator(buffered[i], is_last))
+            buffered[i] = ""
+    return outputs
+
+
+def downstream(chunks: list, count: int) -> list:
+    decoders = [SSEDecoder() for _ in range(count)]
+    buffered = [""] * count
+    outputs = [[] for _ in range(count)]
+    for i, chunk in chunks:
+        for data in decoders[i].feed(chunk):
+            is_last = data == DONE_DATA
+            if not is_last:
+                buffered[i] += decode_token(data)
+            if (buffered[i] and buffered[i][-1] in HITTED_ENDS) or is_last:
+                outputs[i].extend(encode_token(token) for token in TOKEN_PATTERN.findall(buffered[i]))
+                if is_last:
+                    outputs[i].append(DONE_EVENT)
+                buffered[i] = ""
+    return outputs
+
+
+def passthrough(chunks: list, count: int) -> list:
+    counters = [SSEEventCounter() for _ in range(count)]
+    events = [0] * count
+    for i, chunk in chunks:
+        events[i] += counters[i].feed(chunk)
+    return events
+
+
+def text(stream: bytes) -> str:
+    return "".join(decode_token(data) for data in SSEDecoder().feed(stream) if data != DONE_DATA)
+
+
+def spells_stream(outputs: list, stream: bytes) -> bool:
+    return all(text(b"".join(output)) == text(stream) for output in outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", default="1,64,1024", help="comma separated counts of interleaved streams")
+    parser.add_argument("--tokens", type=int, default=256, help="tokens per stream")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per mode, the fastest is reported")
+    parser.add_argument("--split", action="store_true", help="cut the chunks at arbitrary bytes")
+    args = parser.parse_args()
+
+    stream = make_stream(args.tokens)
+    rng = random.Random(0)
+    rows = []
+    for count in map(int, args.streams.split(",")):
+        chunks = interleave([chunked(stream, args.split, rng) for _ in range(count)])
+        modes = [
+            # the [DONE] event is counted as well
+            ("passthrough", passthrough, lambda events: all(n == args.tokens + 1 for n in events)),
+            ("legacy downstream", legacy_downstream, lambda outputs: spells_stream(outputs, stream)),
+            ("downstream", downstream, lambda outputs: spells_stream(outputs, stream)),
+        ]
+        for name, frame, check in modes:
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.process_time()
+                result = frame(chunks, count)
+                best = min(best, time.process_time() - start)
+            cpu_per_token = best / (count * args.tokens) * 1e6
+            rows.append([name, count, "split" if args.split else "event", cpu_per_token, check(result)])
+    print_table(["mode", "streams", "chunks", "cpu_us/token", "correct"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Throughput and CPU per token of streamed LLM replies through the orchestrator, by count of concurrent streams.
+
+    python -m benchmarks.bench_streaming [--concurrency 1,16,64,256] [--tokens 64] [--token-delay 0.01]
+
+A fake LLM micro service, in a process of its own, streams `--tokens` SSE events `--token-delay` seconds apart. In
+`passthrough` mode the stream of the LLM node is the reply of the megaservice, in `downstream` mode its sentences are
+forwarded to a second node, whose text is tokenised again. Since the event loop never blocks on a stream, the token
+throughput should grow with the count of concurrent streams until the orchestrator process runs out of CPU; the CPU
+time per token, measured in the orchestrator process only, is what bounds the streams one process can carry.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+from aiohttp import web
+
+from benchmarks.common import Timer, percentile, print_table, remote_node, start_server
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.proto.docarray import LLMParams
+
+
+def serve_llm(connection, tokens: int, token_delay: float):
+    async def generate(request):
+        await request.read()
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i in range(tokens):
+            await asyncio.sleep(token_delay)
+            token = " word." if i % 8 == 7 else " word"
+            await response.write(b"data: " + repr(token.encode()).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def echo(request):
+        body = await request.json()
+        return web.json_response({"text": body.get("text", "")})
+
+    async def run():
+        runner, port = await start_server({"/v1/chat/completions": generate, "/v1/echo": echo})
+        connection.send(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+async def stream_once(orchestrator: ServiceOrchestrator, node: str):
+    start = time.perf_counter()
+    result_dict, _ = await orchestrator.schedule({"text": "hi"}, llm_parameters=LLMParams(stream=True))
+    first_token = None
+    events = 0
+    async for chunk in result_dict[node].body_iterator:
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        events += (chunk if isinstance(chunk, bytes) else chunk.encode()).count(b"\n\n")
+    # the [DONE] event is not a token
+    return first_token, events - 1
+
+
+async def run_level(port: int, mode: str, concurrency: int):
+    orchestrator = ServiceOrchestrator()
+    llm = remote_node("llm", port, "/v1/chat/completions", ServiceType.LLM)
+    orchestrator.add(llm)
+    node = llm.name
+    if mode == "downstream":
+        tts = remote_node("tts", port, "/v1/echo", ServiceType.TTS)
+        orchestrator.add(tts).flow_to(llm, tts)
+        node = tts.name
+    try:
+        # warm up the connection pool
+        await asyncio.gather(*(stream_once(orchestrator, node) for _ in range(min(concurrency, 8))))
+        with Timer() as timer:
+            results = await asyncio.gather(*(stream_once(orchestrator, node) for _ in range(concurrency)))
+    finally:
+        await orchestrator.close()
+    tokens = sum(count for _, count in results)
+    first_tokens = [first_token for first_token, _ in results]
+    return [
+        mode,
+        concurrency,
+        tokens / timer.wall,
+        timer.cpu / tokens * 1e6,
+        percentile(first_tokens, 0.5) * 1e3,
+        percentile(first_tokens, 0.99) * 1e3,
+        timer.wall,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,16,64,256", help="comma separated counts of concurrent streams")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per stream")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between two tokens")
+    parser.add_argument("--modes", default="passthrough,downstream")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve_llm, args=(child, args.tokens, args.token_delay), daemon=True)
+    server.start()
+    port = parent.recv()
+    rows = []
+    try:
+        for mode in args.modes.split(","):
+            for concurrency in map(int, args.concurrency.split(",")):
+                rows.append(asyncio.run(run_level(port, mode, concurrency)))
+    finally:
+        server.terminate()
+    print(json.dumps({"tokens": args.tokens, "token_delay": args.token_delay}))
+    print_table(["mode", "streams", "tokens/s", "cpu_us/token", "ttft_p50_ms", "ttft_p99_ms", "wall_s"], rows)
+
+
+if __name__ == "__main__":
+    main()
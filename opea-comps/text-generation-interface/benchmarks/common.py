@@ -0,0 +1,77 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Helpers shared by the benchmarks: fake micro services, remote nodes and result tables."""
+
+import math
+import socket
+import time
+from typing import Dict, List, Sequence
+
+from aiohttp import web
+
+from cores.mega.micro_service import MicroService
+
+
+async def start_server(routes: Dict[str, object]):
+    """Serve the aiohttp handlers of `routes` (path -> handler) on a free local port, return (runner, port)."""
+    app = web.Application(client_max_size=1024**3)
+    for path, handler in routes.items():
+        app.router.add_post(path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, runner.addresses[0][1]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    """Wait for a server started in another process to listen on the local port."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def remote_node(name: str, port: int, endpoint: str, service_type) -> MicroService:
+    return MicroService(
+        name, host="127.0.0.1", port=port, endpoint=endpoint, use_remote_service=True, service_type=service_type
+    )
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Timer:
+    """Wall-clock and CPU time of a block."""
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+
+def print_table(headers: List[str], rows: List[List[object]]):
+    cells = [[f"{cell:.4g}" if isinstance(cell, float) else str(cell) for cell in row] for row in rows]
+    widths = [max(len(header), *(len(row[i]) for row in cells)) for i, header in enumerate(headers)]
+    print("  ".join(header.rjust(width) for header, width in zip(headers, widths)))
+    for row in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
@@ -0,0 +1,44 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import time
+
+from fastapi import HTTPException
+
+
+class ConcurrencyLimiter:
+    """Bound the concurrent calls to a node, with a bounded queue of the calls waiting for a slot.
+
+    Calls arriving while the queue is full are rejected with a 429 error instead of piling up.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.waiting = 0
+        # called with the count of waiting calls whenever it changes
+        self.on_waiting = lambda waiting: None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def acquire(self, timeout: float) -> float:
+        """Wait for a free slot for at most `timeout` seconds and return how long the call waited."""
+        if not self._semaphore.locked():
+            # a free slot is taken without yielding, so concurrent callers see it as taken right away
+            await self._semaphore.acquire()
+            return 0.0
+        if self.waiting >= self.max_queue:
+            raise HTTPException(status_code=429, detail=f"Too many requests queued for {self.name}")
+        start = time.time()
+        self.waiting += 1
+        self.on_waiting(self.waiting)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        finally:
+            self.waiting -= 1
+            self.on_waiting(self.waiting)
+        return time.time() - start
+
+    def release(self) -> None:
+        self._semaphore.release()
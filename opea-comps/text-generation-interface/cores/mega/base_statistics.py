@@ -1,67 +1,235 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
-import numpy as np
+import glob
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+
+# relative error of the latency quantiles
+STATISTICS_RELATIVE_ACCURACY = float(os.getenv("STATISTICS_RELATIVE_ACCURACY", 0.01))
+# sliding windows reported besides the whole history, e.g. "1m,5m,1h"
+STATISTICS_WINDOWS = os.getenv("STATISTICS_WINDOWS", "1m,5m,1h")
+# the windows slide by slots of that many seconds
+WINDOW_SLOT_SECONDS = 10
+# latencies below it are counted as zero
+MIN_LATENCY = 1e-9
+
+_GAMMA = (1 + STATISTICS_RELATIVE_ACCURACY) / (1 - STATISTICS_RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def _parse_windows(windows: str) -> Dict[str, int]:
+    """Return the count of slots of each window of a comma separated list of durations such as 30s, 5m or 1h."""
+    slots = {}
+    for window in windows.split(","):
+        window = window.strip()
+        if window:
+            seconds = float(window[:-1]) * _UNITS[window[-1]] if window[-1] in _UNITS else float(window)
+            slots[window] = max(1, math.ceil(seconds / WINDOW_SLOT_SECONDS))
+    return slots
+
+
+_WINDOW_SLOTS = _parse_windows(STATISTICS_WINDOWS)
 
 # name => statistic dict
 statistics_dict = {}
 
 
+class LatencySketch:
+    """Fixed-memory quantile sketch of latencies, mergeable with the sketches of other processes.
+
+    Latencies are counted in buckets of logarithmically growing width, so that any quantile is known within
+    STATISTICS_RELATIVE_ACCURACY relative error: a bucket per factor of _GAMMA, i.e. about 1200 buckets at most from
+    a microsecond to an hour with 1% accuracy. Count and sum are exact.
+    """
+
+    __slots__ = ("buckets", "zeros", "count", "total")
+
+    def __init__(self):
+        self.buckets = {}  # bucket index -> count
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < MIN_LATENCY:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / _LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: "LatencySketch"):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # the value the farthest from both bounds of the bucket, relatively
+                return 2 * _GAMMA**index / (_GAMMA + 1)
+        return 2 * _GAMMA ** max(self.buckets) / (_GAMMA + 1)
+
+    def average(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def to_dict(self) -> dict:
+        # JSON object keys are strings
+        return {
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "zeros": self.zeros,
+            "count": self.count,
+            "total": self.total,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencySketch":
+        sketch = cls()
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = data["count"]
+        sketch.total = data["total"]
+        return sketch
+
+
 class BaseStatistics:
-    """Base class to store in-memory statistics of an entity for measurement in one service."""
+    """Base class to store in-memory statistics of an entity for measurement in one service.
+
+    Besides the whole history, the latencies of the last WINDOW_SLOT_SECONDS slots are kept for the sliding windows
+    of STATISTICS_WINDOWS. Memory does not grow with the count of requests.
+    """
+
+    # the measured series, each one kept in the LatencySketch attribute of that name
+    SERIES = ("response_times", "first_token_latencies", "inter_token_latencies", "tokens_per_second")
 
     def __init__(
         self,
     ):
-        self.response_times = []  # store responses time for all requests
-        self.first_token_latencies = []  # store first token latencies for all requests
+        self.response_times = LatencySketch()  # responses time of all requests
+        self.first_token_latencies = LatencySketch()  # first token latencies of all requests
+        self.inter_token_latencies = LatencySketch()  # mean inter-token latency of each streamed reply
+        self.tokens_per_second = LatencySketch()  # output tokens per second of each streamed reply
+        self._slots = {}  # slot -> series -> sketch of the requests of the slot
+        self._slot_order = deque()
+        self._window_slots = max(_WINDOW_SLOTS.values(), default=0)
+
+    def _slot(self, slot: int) -> Dict[str, LatencySketch]:
+        sketches = self._slots.get(slot)
+        if sketches is None:
+            sketches = self._slots[slot] = {series: LatencySketch() for series in self.SERIES}
+            self._slot_order.append(slot)
+            # slots are created in time order, but for merged ones: the expired ones are at the front, the few merged
+            # out of order ones expire once they reach it
+            while self._slot_order and self._slot_order[0] <= slot - self._window_slots:
+                del self._slots[self._slot_order.popleft()]
+        return sketches
+
+    def _append(self, values: Dict[str, float]):
+        slot = self._slot(int(time.time() // WINDOW_SLOT_SECONDS)) if self._window_slots else None
+        for series, value in values.items():
+            getattr(self, series).add(value)
+            if slot is not None:
+                slot[series].add(value)
 
     def append_latency(self, latency, first_token_latency=None):
-        self.response_times.append(latency)
+        values = {"response_times": latency}
         if first_token_latency:
-            self.first_token_latencies.append(first_token_latency)
+            values["first_token_latencies"] = first_token_latency
+        self._append(values)
 
-    def calculate_statistics(self):
-        if not self.response_times:
-            return {
-                "p50_latency": None,
-                "p99_latency": None,
-                "average_latency": None,
-            }
-        # Calculate the P50 (median)
-        p50 = np.percentile(self.response_times, 50)
+    def append_stream(self, duration, first_token_latency=None, inter_token_latency=None, tokens_per_second=None):
+        """Add the measurements of a streamed reply: its whole duration, the latency of its first token, the mean
+        latency between its next tokens and its output tokens per second."""
+        values = {"response_times": duration}
+        if first_token_latency:
+            values["first_token_latencies"] = first_token_latency
+        if inter_token_latency is not None:
+            values["inter_token_latencies"] = inter_token_latency
+        if tokens_per_second is not None:
+            values["tokens_per_second"] = tokens_per_second
+        self._append(values)
 
-        # Calculate the P99
-        p99 = np.percentile(self.response_times, 99)
+    def snapshot(self) -> dict:
+        """Return the measurements as a JSON serializable dict, for merge()."""
+        snapshot = {series: getattr(self, series).to_dict() for series in self.SERIES}
+        snapshot["slots"] = {
+            str(slot): {series: sketch.to_dict() for series, sketch in sketches.items()}
+            for slot, sketches in self._slots.items()
+        }
+        return snapshot
 
-        avg = np.average(self.response_times)
+    def merge(self, snapshot: dict):
+        """Add the measurements of a snapshot(), e.g. taken in another worker process."""
+        for series in self.SERIES:
+            getattr(self, series).merge(LatencySketch.from_dict(snapshot[series]))
+        oldest = int(time.time() // WINDOW_SLOT_SECONDS) - self._window_slots
+        # slots are aligned on the clock, the same slot of several processes covers the same time
+        for slot, sketches in sorted((int(slot), sketches) for slot, sketches in snapshot["slots"].items()):
+            if slot > oldest:
+                merged = self._slot(slot)
+                for series in self.SERIES:
+                    merged[series].merge(LatencySketch.from_dict(sketches[series]))
 
+    @staticmethod
+    def _latency_statistics(sketch: LatencySketch, suffix: str = ""):
         return {
-            "p50_latency": p50,
-            "p99_latency": p99,
-            "average_latency": avg,
+            f"p50_latency{suffix}": sketch.quantile(0.5),
+            f"p99_latency{suffix}": sketch.quantile(0.99),
+            f"average_latency{suffix}": sketch.average(),
         }
 
-    def calculate_first_token_statistics(self):
-        if not self.first_token_latencies:
-            return {
-                "p50_latency_first_token": None,
-                "p99_latency_first_token": None,
-                "average_latency_first_token": None,
-            }
-        # Calculate the P50 (median)
-        p50 = np.percentile(self.first_token_latencies, 50)
+    @classmethod
+    def _stream_statistics(cls, inter_token_latencies: LatencySketch, tokens_per_second: LatencySketch):
+        if not inter_token_latencies.count and not tokens_per_second.count:
+            # not a streaming service
+            return {}
+        results = cls._latency_statistics(inter_token_latencies, "_inter_token")
+        results["p50_tokens_per_second"] = tokens_per_second.quantile(0.5)
+        results["average_tokens_per_second"] = tokens_per_second.average()
+        return results
 
-        # Calculate the P99
-        p99 = np.percentile(self.first_token_latencies, 99)
+    def calculate_statistics(self):
+        return self._latency_statistics(self.response_times)
 
-        avg = np.average(self.first_token_latencies)
+    def calculate_first_token_statistics(self):
+        return self._latency_statistics(self.first_token_latencies, "_first_token")
 
-        return {
-            "p50_latency_first_token": p50,
-            "p99_latency_first_token": p99,
-            "average_latency_first_token": avg,
-        }
+    def calculate_stream_statistics(self):
+        """Return the inter-token latency and tokens per second statistics, none for a service without streams."""
+        return self._stream_statistics(self.inter_token_latencies, self.tokens_per_second)
+
+    def calculate_window_statistics(self):
+        """Return the statistics of each sliding window, with the same keys as for the whole history."""
+        current = int(time.time() // WINDOW_SLOT_SECONDS)
+        results = {}
+        for window, count in _WINDOW_SLOTS.items():
+            merged = {series: LatencySketch() for series in self.SERIES}
+            for slot in range(current - count + 1, current + 1):
+                if slot in self._slots:
+                    for series, sketch in self._slots[slot].items():
+                        merged[series].merge(sketch)
+            results[window] = self._latency_statistics(merged["response_times"])
+            results[window].update(self._latency_statistics(merged["first_token_latencies"], "_first_token"))
+            results[window].update(
+                self._stream_statistics(merged["inter_token_latencies"], merged["tokens_per_second"])
+            )
+        return results
 
 
 def register_statistics(
@@ -75,11 +243,47 @@ def register_statistics(
     return decorator
 
 
-def collect_all_statistics():
-    results = {}
-    if statistics_dict:
+def dump_statistics(path: str):
+    """Write a snapshot of all the statistics of this process to path, replaced atomically."""
+    snapshots = {name: statistic.snapshot() for name, statistic in statistics_dict.items()}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshots, f)
+    os.replace(tmp_path, path)
+
+
+def _load_snapshots(snapshot_dir: str):
+    own = os.path.join(snapshot_dir, f"{os.getpid()}.json")
+    for path in glob.glob(os.path.join(snapshot_dir, "*.json")):
+        if path == own:
+            # stale, the statistics of this process are taken from memory
+            continue
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            # the worker went away meanwhile
+            continue
+
+
+def collect_all_statistics(snapshot_dir: Optional[str] = None):
+    """Calculate all the statistics, merged with the dump_statistics() snapshots of snapshot_dir if given."""
+    statistics = statistics_dict
+    if snapshot_dir is not None:
+        statistics = {}
         for name, statistic in statistics_dict.items():
+            statistics[name] = BaseStatistics()
+            statistics[name].merge(statistic.snapshot())
+        for snapshots in _load_snapshots(snapshot_dir):
+            for name, snapshot in snapshots.items():
+                statistics.setdefault(name, BaseStatistics()).merge(snapshot)
+    results = {}
+    if statistics:
+        for name, statistic in statistics.items():
             tmp_dict = statistic.calculate_statistics()
             tmp_dict.update(statistic.calculate_first_token_statistics())
+            tmp_dict.update(statistic.calculate_stream_statistics())
+            if _WINDOW_SLOTS:
+                tmp_dict["windows"] = statistic.calculate_window_statistics()
             results.update({name: tmp_dict})
     return results
@@ -0,0 +1,87 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import json
+from typing import Any, Awaitable, Callable, Dict, List
+
+from .result_cache import without_per_request_fields
+
+
+class _Batch:
+    __slots__ = ("payloads", "futures", "deadline", "timer")
+
+    def __init__(self):
+        self.payloads = []
+        self.futures = []
+        self.deadline = float("inf")
+        self.timer = None
+
+
+class NodeBatcher:
+    """Coalesce the concurrent calls to a node into batched calls.
+
+    Calls whose payloads only differ by `batch_key` and by per-request fields, such as the `id` of the docs passed on
+    from an upstream node (see result_cache.PER_REQUEST_FIELDS), are compatible. They are collected for at most
+    `window` seconds, or until `max_batch_size` of them arrived, then `send` is called once with all their payloads
+    and the earliest of their deadlines. It has to return one result per payload, in order.
+    """
+
+    def __init__(
+        self,
+        batch_key: str,
+        window: float,
+        max_batch_size: int,
+        send: Callable[[List[Dict], float], Awaitable[List[Any]]],
+    ):
+        self.batch_key = batch_key
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._send = send
+        self._batches = {}  # compatibility key -> _Batch being collected
+        self._running = set()
+
+    def accepts(self, payload: Dict) -> bool:
+        """Only single inputs are batched, a payload already carrying a list is sent as is."""
+        value = payload.get(self.batch_key)
+        return value is not None and not isinstance(value, list)
+
+    async def submit(self, payload: Dict, deadline: float) -> Any:
+        compatible = without_per_request_fields({k: v for k, v in payload.items() if k != self.batch_key})
+        key = json.dumps(compatible, sort_keys=True, separators=(",", ":"), default=str)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        future = asyncio.get_running_loop().create_future()
+        batch.payloads.append(payload)
+        batch.futures.append(future)
+        batch.deadline = min(batch.deadline, deadline)
+        if len(batch.payloads) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: str) -> None:
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: _Batch) -> None:
+        try:
+            results = await self._send(batch.payloads, batch.deadline)
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
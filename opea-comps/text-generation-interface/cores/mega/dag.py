@@ -1,63 +1,190 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
+import heapq
 from collections import OrderedDict, defaultdict
-from copy import deepcopy
 
 
 class DAG(object):
+    """Directed acyclic graph of named nodes.
+
+    `graph` maps each node to the set of its successors, and the predecessors are indexed as well, so that both are
+    looked up in O(1). A topological order is maintained while edges are inserted (Pearce-Kelly): an edge that agrees
+    with it costs nothing, otherwise only the nodes ordered between its two ends are searched for a cycle and
+    reordered. Inserting many edges against the order costs up to O(nodes * edges) that way, `add_edges()` and
+    `from_dict()` insert them all and sort the graph once instead. The topological order and the levels are cached
+    until the graph changes.
+
+    The graph must only be changed through the methods of the class, or by assigning a whole new `graph`.
+    """
+
     def __init__(self):
         self.reset_graph()
 
+    @property
+    def graph(self):
+        return self._successors
+
+    @graph.setter
+    def graph(self, graph):
+        """Replace the graph, raising ValueError when it has a cycle."""
+        if any(successor not in graph for successors in graph.values() for successor in successors):
+            raise KeyError("one or more nodes do not exist in graph")
+        order = self.topological_sort(graph=graph)
+        self.reset_graph()
+        for node in graph:
+            self._successors[node] = set(graph[node])
+            self._predecessors[node] = {}
+        for node, successors in graph.items():
+            for successor in successors:
+                self._predecessors[successor][node] = None
+        self._rank = {node: rank for rank, node in enumerate(order)}
+        self._next_rank = len(order)
+
     def add_node(self, node_name: str):
-        graph = self.graph
-        if node_name in graph:
+        if node_name in self._successors:
             raise KeyError("node %s already exists" % node_name)
-        graph[node_name] = set()
+        self._successors[node_name] = set()
+        self._predecessors[node_name] = {}
+        # new nodes have no edges yet, they can go last in the topological order
+        self._rank[node_name] = self._next_rank
+        self._next_rank += 1
+        self._invalidate()
 
     def add_node_if_not_exists(self, node_name):
-        try:
+        if node_name not in self._successors:
             self.add_node(node_name)
-        except KeyError:
-            pass
 
     def delete_node(self, node_name):
-        graph = self.graph
-        if node_name not in graph:
+        if node_name not in self._successors:
             raise KeyError("node %s does not exist" % node_name)
-        graph.pop(node_name)
-
-        for node, edges in graph.items():
-            if node_name in edges:
-                edges.remove(node_name)
+        for successor in self._successors.pop(node_name):
+            del self._predecessors[successor][node_name]
+        for predecessor in self._predecessors.pop(node_name):
+            self._successors[predecessor].discard(node_name)
+        # removing a node keeps the order of the others topological
+        del self._rank[node_name]
+        self._invalidate()
 
     def delete_node_if_exists(self, node_name):
-        try:
+        if node_name in self._successors:
             self.delete_node(node_name)
-        except KeyError:
-            pass
 
     def add_edge(self, ind_node, dep_node):
-        graph = self.graph
-        if ind_node not in graph or dep_node not in graph:
+        successors = self._successors
+        if ind_node not in successors or dep_node not in successors:
             raise KeyError("one or more nodes do not exist in graph")
-        test_graph = deepcopy(graph)
-        test_graph[ind_node].add(dep_node)
-        is_valid = self.validate(test_graph)
-        if is_valid:
-            graph[ind_node].add(dep_node)
-        else:
+        if dep_node in successors[ind_node]:
+            return
+        rank = self._rank
+        if rank[dep_node] <= rank[ind_node]:
+            # the edge goes against the current order: reorder the nodes in between, or fail on a cycle
+            if not self._reorder(ind_node, dep_node):
+                raise Exception("validation error!")
+        successors[ind_node].add(dep_node)
+        self._predecessors[dep_node][ind_node] = None
+        self._invalidate()
+
+    def add_edges(self, edges):
+        """Add the (ind_node, dep_node) edges at once, sorting the graph once rather than per edge.
+
+        Raises like add_edge() when an edge closes a cycle, the graph is then left unchanged.
+        """
+        successors = self._successors
+        added = []
+        for ind_node, dep_node in edges:
+            if ind_node not in successors or dep_node not in successors:
+                for ind, dep in added:
+                    self.delete_edge(ind, dep)
+                raise KeyError("one or more nodes do not exist in graph")
+            if dep_node not in successors[ind_node]:
+                successors[ind_node].add(dep_node)
+                self._predecessors[dep_node][ind_node] = None
+                added.append((ind_node, dep_node))
+        if not added:
+            return
+        self._invalidate()
+        try:
+            self._sort()
+        except ValueError:
+            for ind_node, dep_node in added:
+                self.delete_edge(ind_node, dep_node)
             raise Exception("validation error!")
 
+    def _sort(self):
+        """Recompute the maintained topological order in O(edges + nodes log nodes), raising ValueError on a cycle.
+
+        Nodes that do not depend on each other keep their relative order."""
+        rank = self._rank
+        in_degree = {node: len(predecessors) for node, predecessors in self._predecessors.items()}
+        ready = [(rank[node], node) for node, degree in in_degree.items() if not degree]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            node = heapq.heappop(ready)[1]
+            order.append(node)
+            for successor in self._successors[node]:
+                in_degree[successor] -= 1
+                if not in_degree[successor]:
+                    heapq.heappush(ready, (rank[successor], successor))
+        if len(order) != len(self._successors):
+            raise ValueError("graph is not acyclic")
+        self._rank = {node: new_rank for new_rank, node in enumerate(order)}
+        self._next_rank = len(order)
+
+    def _reorder(self, ind_node, dep_node) -> bool:
+        """Move the nodes ordered between dep_node and ind_node so that the edge ind_node -> dep_node agrees with the
+        topological order, return False when the edge would close a cycle."""
+        rank = self._rank
+        lower, upper = rank[dep_node], rank[ind_node]
+        # nodes reachable from dep_node that are not ordered after ind_node
+        forward = []
+        seen = {dep_node}
+        stack = [dep_node]
+        while stack:
+            node = stack.pop()
+            if node == ind_node:
+                return False
+            forward.append(node)
+            for successor in self._successors[node]:
+                if successor not in seen and rank[successor] <= upper:
+                    seen.add(successor)
+                    stack.append(successor)
+        # nodes ind_node is reachable from that are not ordered before dep_node
+        backward = []
+        seen = {ind_node}
+        stack = [ind_node]
+        while stack:
+            node = stack.pop()
+            backward.append(node)
+            for predecessor in self._predecessors[node]:
+                if predecessor not in seen and rank[predecessor] >= lower:
+                    seen.add(predecessor)
+                    stack.append(predecessor)
+        # both sets keep their relative order, the backward one now goes first, in the same ranks
+        backward.sort(key=rank.get)
+        forward.sort(key=rank.get)
+        ranks = sorted(rank[node] for node in backward + forward)
+        for node, new_rank in zip(backward + forward, ranks):
+            rank[node] = new_rank
+        return True
+
     def delete_edge(self, ind_node, dep_node):
-        graph = self.graph
-        if dep_node not in graph.get(ind_node, []):
+        if dep_node not in self._successors.get(ind_node, ()):
             raise KeyError("this edge does not exist in graph")
-        graph[ind_node].remove(dep_node)
+        self._successors[ind_node].remove(dep_node)
+        del self._predecessors[dep_node][ind_node]
+        self._invalidate()
 
     def predecessors(self, node):
-        graph = self.graph
-        return [key for key in graph if node in graph[key]]
+        """Return the predecessors of the node, in the order the nodes were added."""
+        predecessors = self._predecessors.get(node)
+        if not predecessors:
+            return []
+        if len(predecessors) == 1:
+            return list(predecessors)
+        position = self._positions()
+        return sorted(predecessors, key=position.get)
 
     def downstream(self, node) -> list:
         graph = self.graph
@@ -66,7 +193,6 @@ class DAG(object):
         return list(graph[node])
 
     def all_downstreams(self, node):
-        graph = self.graph
         nodes = [node]
         nodes_seen = set()
         i = 0
@@ -77,7 +203,7 @@ class DAG(object):
                     nodes_seen.add(downstream_node)
                     nodes.append(downstream_node)
             i += 1
-        return list(filter(lambda node: node in nodes_seen, self.topological_sort(graph=graph)))
+        return [node for node in self.topological_sort() if node in nodes_seen]
 
     def all_leaves(self):
         graph = self.graph
@@ -87,23 +213,38 @@ class DAG(object):
         self.reset_graph()
         for new_node in graph_dict.keys():
             self.add_node(new_node)
-        for ind_node, dep_nodes in graph_dict.items():
+        for dep_nodes in graph_dict.values():
             if not isinstance(dep_nodes, list):
                 raise TypeError("dict values must be lists")
-            for dep_node in dep_nodes:
-                self.add_edge(ind_node, dep_node)
+        self.add_edges((ind_node, dep_node) for ind_node, dep_nodes in graph_dict.items() for dep_node in dep_nodes)
 
     def reset_graph(self):
-        self.graph = OrderedDict()
+        self._successors = OrderedDict()
+        self._predecessors = {}  # node -> predecessors, a dict used as an ordered set
+        self._rank = {}  # node -> position in the maintained topological order, not contiguous
+        self._next_rank = 0
+        self._invalidate()
 
-    def ind_nodes(self, graph=None):
-        graph = graph if graph is not None else self.graph
+    def _invalidate(self):
+        self._order = None
+        self._levels = None
+        self._position = None
 
+    def _positions(self):
+        if self._position is None:
+            self._position = {node: i for i, node in enumerate(self._successors)}
+        return self._position
+
+    def ind_nodes(self, graph=None):
+        if graph is None:
+            return [node for node in self._successors if not self._predecessors[node]]
         dependent_nodes = set(node for dependents in graph.values() for node in dependents)
         return [node for node in graph.keys() if node not in dependent_nodes]
 
     def validate(self, graph=None):
-        graph = graph if graph is not None else self.graph
+        if graph is None:
+            # acyclic by construction
+            return len(self._successors) > 0
         if len(self.ind_nodes(graph=graph)) == 0:
             # no independent nodes
             return False
@@ -116,7 +257,9 @@ class DAG(object):
 
     def topological_sort(self, graph=None):
         if graph is None:
-            graph = self.graph
+            if self._order is None:
+                self._order = sorted(self._successors, key=self._rank.get)
+            return list(self._order)
         result = []
         in_degree = defaultdict(lambda: 0)
 
@@ -138,5 +281,21 @@ class DAG(object):
         else:
             raise ValueError("graph is not acyclic")
 
+    def levels(self):
+        """Return the nodes grouped by their longest distance from an independent node.
+
+        The nodes of a level only depend on nodes of the earlier levels, so they can run concurrently.
+        """
+        if self._levels is None:
+            depth = {}
+            levels = []
+            for node in self.topological_sort():
+                depth[node] = max((depth[pred] + 1 for pred in self._predecessors[node]), default=0)
+                if depth[node] == len(levels):
+                    levels.append([])
+                levels[depth[node]].append(node)
+            self._levels = levels
+        return [list(level) for level in self._levels]
+
     def size(self):
-        return len(self.graph)
+        return len(self._successors)
@@ -0,0 +1,131 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import functools
+import re
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+from .dag import DAG
+
+
+class ExecutionPlan:
+    """Immutable, pre-indexed snapshot of a DAG, compiled once and shared by every request."""
+
+    __slots__ = ("nodes", "order", "successors", "predecessors", "in_degree", "ind_nodes", "leaves", "levels")
+
+    def __init__(self, graph: Dict[str, Set[str]], order: list):
+        self.nodes = tuple(graph)
+        self.order = tuple(order)
+        self.successors = {node: tuple(graph[node]) for node in self.nodes}
+        predecessors = {node: [] for node in self.nodes}
+        for node in self.nodes:
+            for successor in self.successors[node]:
+                predecessors[successor].append(node)
+        self.predecessors = {node: tuple(preds) for node, preds in predecessors.items()}
+        self.in_degree = {node: len(preds) for node, preds in self.predecessors.items()}
+        self.ind_nodes = tuple(node for node in self.nodes if not self.in_degree[node])
+        self.leaves = tuple(node for node in self.nodes if not self.successors[node])
+        # nodes grouped by their longest distance from an independent node, each level only depends on earlier ones
+        depth = {}
+        for node in self.order:
+            depth[node] = max((depth[pred] + 1 for pred in self.predecessors[node]), default=0)
+        levels = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+        for node in self.order:
+            levels[depth[node]].append(node)
+        self.levels = tuple(tuple(level) for level in levels)
+
+    @classmethod
+    def compile(cls, dag: DAG) -> "ExecutionPlan":
+        return cls(dag.graph, dag.topological_sort())
+
+
+class RuntimeGraph(DAG):
+    """Per-request view of an ExecutionPlan.
+
+    Reads are answered from the shared plan. The indexes of the DAG are only built from it the first time they are
+    needed, e.g. when a node returns a `downstream_black_list` and the request prunes an edge, after which every
+    method of the DAG works on the request's own copy.
+    """
+
+    _INDEXES = frozenset({"_successors", "_predecessors", "_rank", "_next_rank", "_order", "_levels", "_position"})
+
+    def __init__(self, plan: ExecutionPlan):
+        self.plan = plan
+
+    def __getattr__(self, name):
+        # only called for missing attributes, i.e. the indexes of a graph that still reads from the plan
+        if name not in self._INDEXES:
+            raise AttributeError(name)
+        plan = self.plan
+        self._successors = OrderedDict((node, set(successors)) for node, successors in plan.successors.items())
+        self._predecessors = {node: dict.fromkeys(preds) for node, preds in plan.predecessors.items()}
+        self._rank = {node: rank for rank, node in enumerate(plan.order)}
+        self._next_rank = len(plan.order)
+        self._invalidate()
+        return getattr(self, name)
+
+    @property
+    def _copied(self) -> bool:
+        return "_successors" in self.__dict__
+
+    def downstream(self, node) -> list:
+        if self._copied:
+            return super().downstream(node)
+        if node not in self.plan.successors:
+            raise KeyError("node %s is not in graph" % node)
+        return list(self.plan.successors[node])
+
+    def predecessors(self, node):
+        if self._copied:
+            return super().predecessors(node)
+        return list(self.plan.predecessors.get(node, ()))
+
+    def all_leaves(self):
+        if self._copied:
+            return super().all_leaves()
+        return list(self.plan.leaves)
+
+    def ind_nodes(self, graph=None):
+        if graph is None and not self._copied:
+            return list(self.plan.ind_nodes)
+        return super().ind_nodes(graph=graph)
+
+    def topological_sort(self, graph=None):
+        if graph is None and not self._copied:
+            return list(self.plan.order)
+        return super().topological_sort(graph=graph)
+
+    def levels(self):
+        if self._copied:
+            return super().levels()
+        return [list(level) for level in self.plan.levels]
+
+    def size(self):
+        if self._copied:
+            return super().size()
+        return len(self.plan.nodes)
+
+    def prune(self, roots):
+        """Drop the nodes that are no longer reachable from `roots` once edges were removed."""
+        if not self._copied:
+            return
+        graph = self._successors
+        reachable = set(roots)
+        stack = list(roots)
+        while stack:
+            for successor in graph[stack.pop()]:
+                if successor not in reachable:
+                    reachable.add(successor)
+                    stack.append(successor)
+        for node in [node for node in graph if node not in reachable]:
+            self.delete_node(node)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_black_list_pattern(pattern: str) -> Optional[re.Pattern]:
+    """Compile a `downstream_black_list` entry once, returning None for an invalid pattern."""
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
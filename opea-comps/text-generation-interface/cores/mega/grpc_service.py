@@ -0,0 +1,254 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from pydantic import ValidationError
+
+from .inprocess import LocalHandler, local_body_iterator, route_handler
+from .logger import CustomLogger
+
+try:
+    import grpc
+except ImportError:  # grpcio is optional, micro services are then only reachable over HTTP
+    grpc = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional, request bodies are then sent as JSON
+    msgpack = None
+
+logger = CustomLogger("grpc_service")
+
+GRPC_SERVICE = "opea.MicroService"
+INVOKE_METHOD = f"/{GRPC_SERVICE}/Invoke"
+INVOKE_STREAM_METHOD = f"/{GRPC_SERVICE}/InvokeStream"
+# metadata naming the HTTP route whose handler serves the call
+ENDPOINT_METADATA = "x-opea-endpoint"
+# metadata naming the encoding of the request body, "msgpack" or "json"
+ENCODING_METADATA = "x-opea-encoding"
+# encoding of the request bodies sent by the orchestrator, msgpack when it is installed
+GRPC_ENCODING = os.getenv("MEGASERVICE_GRPC_ENCODING", "msgpack" if msgpack is not None else "json")
+
+# HTTP status reported for the gRPC errors of a call, the others are reported as 502 errors
+_HTTP_STATUS = {
+    "INVALID_ARGUMENT": 400,
+    "FAILED_PRECONDITION": 400,
+    "OUT_OF_RANGE": 400,
+    "UNAUTHENTICATED": 401,
+    "PERMISSION_DENIED": 403,
+    "NOT_FOUND": 404,
+    "ALREADY_EXISTS": 409,
+    "ABORTED": 409,
+    "RESOURCE_EXHAUSTED": 429,
+    "UNIMPLEMENTED": 501,
+    # servers cancel the calls beyond their pending requests limit
+    "CANCELLED": 503,
+    "UNAVAILABLE": 503,
+}
+
+
+def grpc_available() -> bool:
+    return grpc is not None
+
+
+def _reply_metadata(status: int, content_type: str) -> Tuple:
+    return (("x-opea-status", str(status)), ("x-opea-content-type", content_type or ""))
+
+
+class JSONReply(Response):
+    media_type = "application/json"
+
+    def __init__(self, status_code: int, content: Dict):
+        super().__init__(json.dumps(content).encode("utf-8"), status_code=status_code)
+
+
+class GrpcServer:
+    """gRPC endpoint of a micro service, served next to its HTTP one.
+
+    The two methods of the generic `opea.MicroService` service take the body of the HTTP route named by the
+    `x-opea-endpoint` metadata, msgpack or JSON encoded as the `x-opea-encoding` metadata tells, and call its handler
+    directly. `Invoke` replies with the whole body, `InvokeStream` with the chunks of a streamed reply. The HTTP
+    status and content type of the reply are sent as initial metadata, so that callers handle errors as they do over
+    HTTP.
+
+    The calls do not go through the middlewares of the FastAPI app: they get no X-Process-Time header, are not
+    counted by the Prometheus HTTP metrics of `/metrics`, and CORS does not apply to them.
+    """
+
+    def __init__(self, app, host: str, port: int):
+        self.app = app
+        self.address = f"{host}:{port}"
+        self.server = None
+        self._handlers = {}  # route path -> LocalHandler
+
+    async def serve(self) -> None:
+        identity = dict(request_deserializer=None, response_serializer=None)
+        handler = grpc.method_handlers_generic_handler(
+            GRPC_SERVICE,
+            {
+                "Invoke": grpc.unary_unary_rpc_method_handler(self._invoke, **identity),
+                "InvokeStream": grpc.unary_stream_rpc_method_handler(self._invoke_stream, **identity),
+            },
+        )
+        self.server = grpc.aio.server()
+        self.server.add_generic_rpc_handlers((handler,))
+        self.server.add_insecure_port(self.address)
+        await self.server.start()
+        logger.info(f"gRPC server listening on {self.address}")
+        await self.server.wait_for_termination()
+
+    async def stop(self) -> None:
+        if self.server is not None:
+            await self.server.stop(grace=None)
+
+    def _route_handler(self, context) -> Optional[LocalHandler]:
+        path = dict(context.invocation_metadata()).get(ENDPOINT_METADATA)
+        if path not in self._handlers:
+            # routes are registered after the micro service is created, resolve them on first use
+            self._handlers[path] = route_handler(self.app, path)
+        return self._handlers[path]
+
+    async def _call(self, request: bytes, context):
+        handler = self._route_handler(context)
+        if handler is None:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, "No route with a single typed body argument")
+        encoding = dict(context.invocation_metadata()).get(ENCODING_METADATA, "json")
+        if encoding == "msgpack":
+            if msgpack is None:
+                return JSONReply(415, {"detail": "msgpack is not installed, send JSON bodies"})
+            data = msgpack.unpackb(request)
+        else:
+            data = json.loads(request)
+        try:
+            return await handler(data)
+        except HTTPException as e:
+            return JSONReply(e.status_code, {"detail": e.detail})
+        except ValidationError as e:
+            return JSONReply(422, {"detail": jsonable_encoder(e.errors())})
+
+    async def _invoke(self, request: bytes, context) -> bytes:
+        result = await self._call(request, context)
+        if isinstance(result, StreamingResponse):
+            await context.send_initial_metadata(_reply_metadata(result.status_code, result.media_type))
+            return b"".join([chunk async for chunk in local_body_iterator(result)])
+        if isinstance(result, Response):
+            await context.send_initial_metadata(_reply_metadata(result.status_code, result.media_type))
+            return result.body
+        await context.send_initial_metadata(_reply_metadata(200, "application/json"))
+        return json.dumps(jsonable_encoder(result)).encode("utf-8")
+
+    async def _invoke_stream(self, request: bytes, context) -> AsyncIterator[bytes]:
+        result = await self._call(request, context)
+        if isinstance(result, Response):
+            await context.send_initial_metadata(_reply_metadata(result.status_code, result.media_type))
+        else:
+            await context.send_initial_metadata(_reply_metadata(200, "application/json"))
+        async for chunk in local_body_iterator(result):
+            yield chunk
+
+
+class GrpcClient:
+    """Channels to the gRPC endpoints of the micro services, each one multiplexes all calls on one HTTP/2 connection.
+
+    At most `limit_per_target` calls are in flight per target, like the connections of the HTTP pool, the others wait
+    here: servers cancel the calls beyond their own pending requests limit.
+    """
+
+    def __init__(self, limit_per_target: int):
+        self.limit_per_target = limit_per_target
+        self._channels = {}  # target -> (event loop, channel, semaphore of the calls in flight)
+
+    def _channel(self, target: str):
+        loop = asyncio.get_running_loop()
+        entry = self._channels.get(target)
+        if entry is None or entry[0] is not loop:
+            channel = grpc.aio.insecure_channel(target)
+            entry = self._channels[target] = (loop, channel, asyncio.Semaphore(self.limit_per_target))
+        return entry[1], entry[2]
+
+    async def invoke(
+        self, target: str, endpoint: str, data: Dict, timeout: float, metadata: Tuple
+    ) -> Tuple[int, str, bytes]:
+        """Call the handler of the endpoint with the inputs and return the status, content type and body of its reply.
+
+        gRPC errors are raised as the HTTPException of the matching status, see _raise_http_error().
+        """
+        channel, in_flight = self._channel(target)
+        body, metadata = _encode_request(endpoint, data, metadata)
+        async with in_flight:
+            call = channel.unary_unary(INVOKE_METHOD)(body, timeout=timeout, metadata=metadata)
+            try:
+                reply = await call
+                status, content_type = _parse_reply_metadata(await call.initial_metadata())
+            except grpc.aio.AioRpcError as e:
+                _raise_http_error(e)
+        return status, content_type, reply
+
+    async def invoke_stream(self, target: str, endpoint: str, data: Dict, timeout: float, metadata: Tuple):
+        """Call the handler of the endpoint, return the status and content type of its reply and the streaming call.
+
+        The chunks of the reply are read with stream_chunks(call), the call has to be cancelled if they are not read
+        to their end.
+        """
+        channel, in_flight = self._channel(target)
+        body, metadata = _encode_request(endpoint, data, metadata)
+        await in_flight.acquire()
+        try:
+            call = channel.unary_stream(INVOKE_STREAM_METHOD)(body, timeout=timeout, metadata=metadata)
+        except BaseException:
+            in_flight.release()
+            raise
+        # the slot is held until the stream ends or is cancelled
+        call.add_done_callback(lambda _: in_flight.release())
+        try:
+            status, content_type = _parse_reply_metadata(await call.initial_metadata())
+        except grpc.aio.AioRpcError as e:
+            call.cancel()
+            _raise_http_error(e)
+        except BaseException:
+            call.cancel()
+            raise
+        return status, content_type, call
+
+    async def close(self) -> None:
+        channels, self._channels = self._channels, {}
+        for _, channel, _ in channels.values():
+            await channel.close()
+
+
+def _parse_reply_metadata(metadata) -> Tuple[int, str]:
+    metadata = dict(metadata or ())
+    return int(metadata.get("x-opea-status", 200)), metadata.get("x-opea-content-type", "application/json")
+
+
+async def stream_chunks(call) -> AsyncIterator[bytes]:
+    """Return the chunks of a streaming call of invoke_stream(), its gRPC errors raised as by invoke()."""
+    try:
+        async for chunk in call:
+            yield chunk
+    except grpc.aio.AioRpcError as e:
+        _raise_http_error(e)
+
+
+def _encode_request(endpoint: str, data: Dict, metadata: Tuple) -> Tuple[bytes, Tuple]:
+    if GRPC_ENCODING == "msgpack":
+        body = msgpack.packb(data)
+    else:
+        body = json.dumps(data).encode("utf-8")
+    return body, ((ENDPOINT_METADATA, endpoint), (ENCODING_METADATA, GRPC_ENCODING)) + metadata
+
+
+def _raise_http_error(error) -> None:
+    """Raise the error of a call as the HTTP path reports its errors."""
+    if error.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        # the orchestrator turns timeouts into 504 errors
+        raise asyncio.TimeoutError(error.details()) from error
+    status = _HTTP_STATUS.get(error.code().name, 502)
+    raise HTTPException(status_code=status, detail=error.details() or error.code().name) from error
@@ -4,16 +4,59 @@
 import asyncio
 import logging
 import multiprocessing
+import multiprocessing.connection
+import os
 import re
+import shutil
+import signal
+import socket
+import tempfile
+import time
 from typing import Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.responses import Response
 from prometheus_fastapi_instrumentator import Instrumentator
+from starlette.datastructures import MutableHeaders
 from uvicorn import Config, Server
 
+from ..telemetry.opea_telemetry import in_memory_exporter
 from .base_service import BaseService
-from .base_statistics import collect_all_statistics
+from .base_statistics import collect_all_statistics, dump_statistics
+
+# reply header with the seconds the server spent on a request until its reply started
+PROCESS_TIME_HEADER = "X-Process-Time"
+# worker processes serving the port, the default process serves it itself
+HTTP_SERVICE_WORKERS = int(os.getenv("HTTP_SERVICE_WORKERS", 1))
+# run the server on uvloop when it is installed
+HTTP_SERVICE_UVLOOP = os.getenv("HTTP_SERVICE_UVLOOP", "false").lower() == "true"
+# seconds between the statistics snapshots of each worker process
+STATISTICS_SYNC_INTERVAL = float(os.getenv("HTTP_SERVICE_STATISTICS_SYNC_INTERVAL", 1))
+# a worker exiting sooner after it started is not restarted, the service stops instead
+WORKER_MIN_UPTIME = 5
+
+
+class ProcessTimeMiddleware:
+    """Add the PROCESS_TIME_HEADER to every HTTP reply.
+
+    Callers subtract it from the latency they observed to tell network from server time. For streamed replies it is
+    the time to the first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(PROCESS_TIME_HEADER, f"{time.perf_counter() - start:.6f}")
+            await send(message)
+
+        await self.app(scope, receive, send_timed)
 
 
 class HTTPService(BaseService):
@@ -26,17 +69,25 @@ class HTTPService(BaseService):
         self,
         uvicorn_kwargs: Optional[dict] = None,
         cors: Optional[bool] = True,
+        workers: Optional[int] = None,
         **kwargs,
     ):
         """Initialize the HTTPService
         :param uvicorn_kwargs: Dictionary of kwargs arguments that will be passed to Uvicorn server when starting the server
         :param cors: If set, a CORS middleware is added to FastAPI frontend to allow cross-origin access.
+        :param workers: Count of processes forked by start() to serve the port, HTTP_SERVICE_WORKERS by default.
+            With more than one, the server is only set up in the workers, and `/v1/statistics` merges theirs.
 
         :param kwargs: keyword args
         """
         super().__init__(**kwargs)
         self.uvicorn_kwargs = uvicorn_kwargs or {}
         self.cors = cors
+        self.workers = workers or HTTP_SERVICE_WORKERS
+        # snapshots of the statistics of the worker processes
+        self._statistics_dir = None
+        # stops the worker processes while the master serves them
+        self._stop_workers = None
         self._app = self._create_app()
         Instrumentator().instrument(self._app).expose(self._app)
 
@@ -64,6 +115,7 @@ class HTTPService(BaseService):
                 allow_headers=["*"],
             )
             self.logger.info("CORS is enabled.")
+        app.add_middleware(ProcessTimeMiddleware)
 
         @app.get(
             path="/v1/health_check",
@@ -86,9 +138,26 @@ class HTTPService(BaseService):
         )
         async def _get_statistics():
             """Get the statistics of GenAI services."""
-            result = collect_all_statistics()
+            result = collect_all_statistics(self._statistics_dir)
             return result
 
+        @app.get(
+            path="/v1/traces",
+            summary="Get the recent trace spans of this process",
+            tags=["Debug"],
+        )
+        async def _get_traces(
+            trace_id: Optional[str] = None,
+            name: Optional[str] = None,
+            min_duration_ms: Optional[float] = None,
+            limit: int = 100,
+        ):
+            """Get the most recent spans first, filtered by trace id, span name and minimal duration."""
+            try:
+                return in_memory_exporter.query(trace_id, name, min_duration_ms, limit)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid trace id {trace_id}")
+
         return app
 
     def add_startup_event(self, func):
@@ -96,8 +165,11 @@ class HTTPService(BaseService):
         async def startup_event():
             asyncio.create_task(func)
 
-    async def initialize_server(self):
-        """Initialize and return HTTP server."""
+    async def initialize_server(self, sockets=None):
+        """Initialize and return HTTP server.
+
+        :param sockets: listening sockets to serve instead of binding the host and port.
+        """
         self.logger.info("Setting up HTTP server")
 
         class UviServer(Server):
@@ -134,7 +206,7 @@ class HTTPService(BaseService):
         )
         logging.getLogger("uvicorn.access").addFilter(lambda record: "/v1/health_check" not in record.getMessage())
         self.logger.info(f"Uvicorn server setup on port {self.primary_port}")
-        await self.server.setup_server()
+        await self.server.setup_server(sockets=sockets)
         self.logger.info("HTTP server setup successful")
 
     async def execute_server(self):
@@ -143,25 +215,156 @@ class HTTPService(BaseService):
 
     async def terminate_server(self):
         """Terminate the HTTP server and free resources allocated when setting up the server."""
+        if self.server is None:
+            # the master of several workers never sets up a server
+            return
         self.logger.info("Initiating server termination")
         self.server.should_exit = True
         await self.server.shutdown()
         self.logger.info("Server termination completed")
 
+    @staticmethod
+    def _new_event_loop():
+        if HTTP_SERVICE_UVLOOP:
+            try:
+                import uvloop
+
+                return uvloop.new_event_loop()
+            except ImportError:
+                pass
+        return asyncio.new_event_loop()
+
     def _async_setup(self):
-        self.event_loop = asyncio.new_event_loop()
+        self.event_loop = self._new_event_loop()
         asyncio.set_event_loop(self.event_loop)
+        if self.workers > 1:
+            # the workers set up their own server when they start
+            return
         self.event_loop.run_until_complete(self.initialize_server())
 
     def start(self):
         """Running method to block the main thread.
 
         This method runs the event loop until a Future is done. It is designed to be called in the main thread to keep it busy.
+        With several workers, it forks and supervises them instead, restarting the ones that exit until it is stopped
+        with SIGINT or SIGTERM.
         """
+        if self.workers > 1:
+            self._serve_workers()
+            return
         self.event_loop.run_until_complete(self.execute_server())
 
-    def stop(self):
+    def _listen_socket(self, reuse_port: bool) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.host_address else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host_address, self.primary_port))
+        sock.set_inheritable(True)
+        return sock
+
+    def _serve_workers(self):
+        from prometheus_client import values
+
+        # prometheus_client picks the storage of all the metric values when it is imported, with in-process values
+        # each worker would only ever report its own share on /metrics
+        if values.ValueClass is values.MutexValue:
+            raise RuntimeError(
+                f"{self.workers} worker processes need PROMETHEUS_MULTIPROC_DIR set to an empty writable directory "
+                "before the service is imported, for their metrics to be aggregated"
+            )
+        # with SO_REUSEPORT every worker listens on a socket of its own and the kernel balances the connections,
+        # otherwise they all accept on the socket bound here
+        reuse_port = hasattr(socket, "SO_REUSEPORT")
+        shared_socket = None if reuse_port else self._listen_socket(reuse_port=False)
+        self._statistics_dir = tempfile.mkdtemp(prefix="opea_statistics_")
+        context = multiprocessing.get_context("fork")
+        workers = {}
+        stopping = False
+
+        def spawn(index):
+            process = context.Process(target=self._run_worker, args=(shared_socket,), name=f"{self.name}-{index}")
+            process.start()
+            process.started = time.monotonic()
+            return process
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for process in workers.values():
+                process.terminate()
+
+        previous_handlers = {sig: signal.signal(sig, stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+        self._stop_workers = lambda: stop(None, None)
+        try:
+            for index in range(self.workers):
+                workers[index] = spawn(index)
+            self.logger.info(f"Serving port {self.primary_port} with {self.workers} worker processes")
+            while workers:
+                multiprocessing.connection.wait([process.sentinel for process in workers.values()])
+                for index, process in list(workers.items()):
+                    if process.is_alive():
+                        continue
+                    process.join()
+                    self._worker_exited(process.pid)
+                    if stopping:
+                        del workers[index]
+                    elif time.monotonic() - process.started < WORKER_MIN_UPTIME:
+                        self.logger.error(f"Worker {process.pid} exited with {process.exitcode} on start, stopping")
+                        del workers[index]
+                        stop(None, None)
+                    else:
+                        self.logger.warning(f"Worker {process.pid} exited with {process.exitcode}, restarting it")
+                        workers[index] = spawn(index)
+        finally:
+            self._stop_workers = None
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+            if shared_socket is not None:
+                shared_socket.close()
+            shutil.rmtree(self._statistics_dir, ignore_errors=True)
+
+    def _worker_exited(self, pid: int):
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            from prometheus_client import multiprocess
+
+            # drop its live gauges, its counters and histograms stay accounted for
+            multiprocess.mark_process_dead(pid)
+
+    def _run_worker(self, shared_socket: Optional[socket.socket]):
+        def exit_worker(signum, frame):
+            # the server loop then returns, and the connections are closed gracefully
+            self.server.should_exit = True
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, exit_worker)
+        sock = shared_socket or self._listen_socket(reuse_port=True)
+        # a fresh loop, the one inherited from the parent process is not safe to use after fork
+        self.event_loop = self._new_event_loop()
+        asyncio.set_event_loop(self.event_loop)
+        self.event_loop.run_until_complete(self.initialize_server(sockets=[sock]))
+        self.event_loop.create_task(self._share_statistics())
+        self.event_loop.run_until_complete(self.execute_server())
         self.event_loop.run_until_complete(self.terminate_server())
+        dump_statistics(os.path.join(self._statistics_dir, f"{os.getpid()}.json"))
+
+    async def _share_statistics(self):
+        path = os.path.join(self._statistics_dir, f"{os.getpid()}.json")
+        while True:
+            try:
+                dump_statistics(path)
+            except OSError as e:
+                self.logger.warning(f"Cannot write the statistics snapshot {path}: {e}")
+            await asyncio.sleep(STATISTICS_SYNC_INTERVAL)
+
+    def stop(self):
+        if self.workers > 1:
+            # the server only runs in the workers, start() returns once they exited
+            if self._stop_workers is not None:
+                self._stop_workers()
+        else:
+            self.event_loop.run_until_complete(self.terminate_server())
         self.event_loop.stop()
         self.event_loop.close()
         self.logger.close()
@@ -0,0 +1,82 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import inspect
+import json
+from typing import Any, AsyncIterator, Dict, Optional
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import PydanticSchemaGenerationError, TypeAdapter
+from starlette.concurrency import run_in_threadpool
+
+from .micro_service import opea_microservices
+
+
+class LocalHandler:
+    """Route handler of a micro service running in this process, called without HTTP nor JSON.
+
+    The payload is validated into the type the handler is annotated with, as FastAPI would do.
+    """
+
+    def __init__(self, endpoint, annotation):
+        self.endpoint = endpoint
+        self.adapter = TypeAdapter(annotation)
+        self.is_coroutine = inspect.iscoroutinefunction(endpoint)
+
+    async def __call__(self, input_data: Dict) -> Any:
+        arg = self.adapter.validate_python(input_data)
+        if self.is_coroutine:
+            return await self.endpoint(arg)
+        return await run_in_threadpool(self.endpoint, arg)
+
+
+def find_local_handler(service) -> Optional[LocalHandler]:
+    """Return the handler of the service when it is registered in this process, with a single typed body argument."""
+    if getattr(service, "use_remote_service", True):
+        return None
+    if not any(service is local for local in opea_microservices.values()):
+        return None
+    return route_handler(service.app, service.endpoint)
+
+
+def route_handler(app, path: str) -> Optional[LocalHandler]:
+    """Return the handler of the POST route of the app, when it takes a single typed body argument."""
+    for route in app.routes:
+        if isinstance(route, APIRoute) and route.path == path and "POST" in route.methods:
+            try:
+                parameters = list(inspect.signature(route.endpoint, eval_str=True).parameters.values())
+            except NameError:
+                return None
+            # handlers reading the raw request, headers or several arguments keep going through HTTP
+            if len(parameters) != 1 or parameters[0].annotation is inspect.Parameter.empty:
+                return None
+            if parameters[0].annotation is Request:
+                return None
+            try:
+                return LocalHandler(route.endpoint, parameters[0].annotation)
+            except PydanticSchemaGenerationError:
+                return None
+    return None
+
+
+def local_reply_data(result: Any) -> Any:
+    """Convert a handler result to the data the HTTP path would have parsed from the reply."""
+    if isinstance(result, Response) and not isinstance(result, StreamingResponse):
+        if result.media_type == "application/json":
+            return json.loads(result.body)
+        return result.body
+    return jsonable_encoder(result)
+
+
+async def local_body_iterator(result: Any) -> AsyncIterator[bytes]:
+    """Iterate over the body of a handler result as the chunks the HTTP path would have read."""
+    if isinstance(result, StreamingResponse):
+        async for chunk in result.body_iterator:
+            yield chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+    elif isinstance(result, Response):
+        yield result.body
+    else:
+        yield json.dumps(jsonable_encoder(result)).encode("utf-8")
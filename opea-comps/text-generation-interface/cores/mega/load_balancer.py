@@ -0,0 +1,78 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import random
+from collections import deque
+from typing import List, Optional
+
+
+class LatencyWindow:
+    """Latencies of the most recent requests of a node, for percentile estimates."""
+
+    def __init__(self, size: int = 256, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._sorted = None
+
+    def observe(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._sorted = None
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Return the q-th percentile (0-100), or None until enough samples were observed."""
+        if len(self._samples) < self.min_samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * q / 100))]
+
+
+class Replica:
+    __slots__ = ("endpoint", "outstanding")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.outstanding = 0
+
+
+class ReplicaSet:
+    """Endpoints serving one node, picked client-side by least outstanding requests.
+
+    With more than two replicas two of them are sampled at random and the less loaded one wins
+    (power of two choices), which avoids herding every request on the same replica.
+    """
+
+    def __init__(self, endpoints: List[str], hedge: bool = False, hedge_percentile: float = 95):
+        self.replicas = [Replica(endpoint) for endpoint in endpoints]
+        self.hedge = hedge and len(self.replicas) > 1
+        self.hedge_percentile = hedge_percentile
+        self.latency = LatencyWindow()
+
+    @property
+    def endpoints(self) -> List[str]:
+        return [replica.endpoint for replica in self.replicas]
+
+    def pick(self, exclude: Optional[Replica] = None) -> Replica:
+        candidates = self.replicas if exclude is None else [r for r in self.replicas if r is not exclude]
+        if len(candidates) == 1:
+            return candidates[0]
+        if len(candidates) == 2:
+            first, second = candidates
+        else:
+            first, second = random.sample(candidates, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+    def acquire(self, replica: Replica) -> None:
+        replica.outstanding += 1
+
+    def release(self, replica: Replica, latency: Optional[float] = None) -> None:
+        """Release a request slot of the replica, recording its latency when it succeeded."""
+        replica.outstanding -= 1
+        if latency is not None:
+            self.latency.observe(latency)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Return after how long a duplicate request should be sent, None when hedging does not apply."""
+        if not self.hedge:
+            return None
+        return self.latency.percentile(self.hedge_percentile)
@@ -3,9 +3,13 @@
 
 import asyncio
 import os
+import threading
+import time
 from collections import defaultdict, deque
 from enum import Enum
-from typing import Any, List, Optional, Type
+from typing import Any, Callable, List, Optional, Type
+
+from prometheus_client import Histogram
 
 from ..proto.docarray import TextDoc
 from .constants import ServiceRoleType, ServiceType
@@ -18,6 +22,51 @@ opea_microservices = {}
 logger = CustomLogger("micro_service")
 logflag = os.getenv("LOGFLAG", False)
 
+# shared by all the micro services of the process, created with the first dynamic batcher
+_batch_metrics_lock = threading.Lock()
+_batch_size = None
+_batch_queue_wait = None
+
+
+def _batch_metrics():
+    global _batch_size, _batch_queue_wait
+    with _batch_metrics_lock:
+        if _batch_size is None:
+            _batch_size = Histogram(
+                "opea_microservice_batch_size",
+                "Count of requests in each dynamic batch (histogram)",
+                ["service", "service_type"],
+                buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+            )
+            _batch_queue_wait = Histogram(
+                "opea_microservice_batch_queue_wait",
+                "Time requests waited for their dynamic batch (histogram)",
+                ["service", "service_type"],
+                buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+            )
+    return _batch_size, _batch_queue_wait
+
+
+class BatchQueue(deque):
+    """Requests of one service type waiting for a dynamic batch, with the time each of them was queued at.
+
+    Appending a request wakes the batcher up.
+    """
+
+    def __init__(self, on_append: Callable[[], None]):
+        super().__init__()
+        self.queued_at = deque()
+        self._on_append = on_append
+
+    def append(self, request) -> None:
+        super().append(request)
+        self.queued_at.append(time.monotonic())
+        self._on_append()
+
+    def popleft(self):
+        self.queued_at.popleft()
+        return super().popleft()
+
 
 class MicroService(HTTPService):
     """MicroService class to create a microservice."""
@@ -40,10 +89,27 @@ class MicroService(HTTPService):
         use_remote_service: Optional[bool] = False,
         description: Optional[str] = None,
         dynamic_batching: bool = False,
-        dynamic_batching_timeout: int = 1,
+        dynamic_batching_timeout: float = 1,
         dynamic_batching_max_batch_size: int = 32,
+        grpc_port: Optional[int] = None,
+        workers: Optional[int] = None,
+        shared_memory: bool = False,
     ):
-        """Init the microservice."""
+        """Init the microservice.
+
+        With `dynamic_batching`, the requests queued in `request_buffer` are passed to dynamic_batching_infer() in
+        batches of at most `dynamic_batching_max_batch_size` of the same service type, sent as soon as they are full
+        or their oldest request waited `dynamic_batching_timeout` seconds.
+
+        With `grpc_port`, the routes are also served over gRPC on that port, see GrpcServer. The orchestrator then
+        prefers gRPC to reach the micro service, for a remote one the port has to be given as well.
+
+        With more than one of `workers`, HTTP_SERVICE_WORKERS by default, start() forks that many processes serving
+        the port, each with its own dynamic batcher.
+
+        With `shared_memory`, the micro service accepts the shared memory handles an orchestrator of this host passes
+        instead of large media inputs, see SharedPayloadRoute. Handlers get the inline payloads.
+        """
         self.service_role = service_role
         self.service_type = service_type
         self.protocol = protocol
@@ -57,6 +123,9 @@ class MicroService(HTTPService):
         self.dynamic_batching = dynamic_batching
         self.dynamic_batching_timeout = dynamic_batching_timeout
         self.dynamic_batching_max_batch_size = dynamic_batching_max_batch_size
+        self.grpc_port = grpc_port
+        self.grpc_server = None
+        self.shared_memory = shared_memory
         self.uvicorn_kwargs = {}
 
         if ssl_keyfile:
@@ -83,50 +152,111 @@ class MicroService(HTTPService):
                 "description": "OPEA Microservice Infrastructure",
             }
 
-            super().__init__(uvicorn_kwargs=self.uvicorn_kwargs, runtime_args=runtime_args)
+            super().__init__(uvicorn_kwargs=self.uvicorn_kwargs, workers=workers, runtime_args=runtime_args)
+
+            if self.shared_memory:
+                from .shm import SharedPayloadRoute
+
+                # the routes added from now on resolve the handles of their inputs
+                self.app.router.route_class = SharedPayloadRoute
 
             # create a batch request processor loop if using dynamic batching
             if self.dynamic_batching:
-                self.buffer_lock = asyncio.Lock()
-                self.request_buffer = defaultdict(deque)
+                # the handlers queue their requests holding the lock of the condition the batcher waits on
+                self.buffer_lock = asyncio.Condition()
+                self.request_buffer = defaultdict(lambda: BatchQueue(self._wake_batcher))
                 self.add_startup_event(self._dynamic_batch_processor())
 
+            if self.grpc_port:
+                from .grpc_service import GrpcServer, grpc_available
+
+                if not grpc_available():
+                    raise RuntimeError("grpcio is required to serve a micro service over gRPC")
+                self.grpc_server = GrpcServer(self.app, self.host, self.grpc_port)
+                self.add_startup_event(self.grpc_server.serve())
+
             self._async_setup()
 
         # overwrite name
         self.name = f"{name}/{self.__class__.__name__}" if name else self.__class__.__name__
 
+    def _wake_batcher(self) -> None:
+        if self.buffer_lock.locked():
+            self.buffer_lock.notify()
+        else:
+            # queued without holding buffer_lock, take it to signal the batcher
+            asyncio.get_running_loop().create_task(self._notify_batcher())
+
+    async def _notify_batcher(self) -> None:
+        async with self.buffer_lock:
+            self.buffer_lock.notify()
+
+    async def dynamic_batching_request(self, service_type: Enum, request: Any) -> Any:
+        """Queue the request for the next batch of its service type and return its result."""
+        response = asyncio.get_running_loop().create_future()
+        async with self.buffer_lock:
+            self.request_buffer[service_type].append({"request": request, "response": response})
+        return await response
+
     async def _dynamic_batch_processor(self):
         if logflag:
             logger.info("dynamic batch processor looping...")
-        while True:
-            await asyncio.sleep(self.dynamic_batching_timeout)
-            runtime_batch: dict[Enum, list[dict]] = {}  # {ServiceType.Embedding: [{"request": xx, "response": yy}, {}]}
-
-            async with self.buffer_lock:
-                # prepare the runtime batch, access to buffer is locked
-                if self.request_buffer:
-                    for service_type, request_lst in self.request_buffer.items():
+        batch_size, queue_wait = _batch_metrics()
+        running = set()
+        async with self.buffer_lock:
+            while True:
+                now = time.monotonic()
+                next_flush = None
+                for service_type, queue in self.request_buffer.items():
+                    # a batch is sent once full, or once its oldest request waited long enough
+                    while queue and (
+                        len(queue) >= self.dynamic_batching_max_batch_size
+                        or queue.queued_at[0] + self.dynamic_batching_timeout <= now
+                    ):
                         batch = []
-                        # grab min(MAX_BATCH_SIZE, REQUEST_SIZE) requests from buffer
-                        for _ in range(min(self.dynamic_batching_max_batch_size, len(request_lst))):
-                            batch.append(request_lst.popleft())
-
-                        runtime_batch[service_type] = batch
-
-            # Run batched inference on the batch and set results
-            for service_type, batch in runtime_batch.items():
-                if not batch:
-                    continue
-                results = await self.dynamic_batching_infer(service_type, batch)
+                        for _ in range(min(self.dynamic_batching_max_batch_size, len(queue))):
+                            queue_wait.labels(self.name, service_type.name).observe(now - queue.queued_at[0])
+                            batch.append(queue.popleft())
+                        batch_size.labels(self.name, service_type.name).observe(len(batch))
+                        # batches run concurrently, the next ones are collected meanwhile
+                        task = asyncio.create_task(self._run_batch(service_type, batch))
+                        running.add(task)
+                        task.add_done_callback(running.discard)
+                    if queue:
+                        flush_at = queue.queued_at[0] + self.dynamic_batching_timeout
+                        next_flush = flush_at if next_flush is None else min(next_flush, flush_at)
+                try:
+                    if next_flush is None:
+                        # idle until a request is queued
+                        await self.buffer_lock.wait()
+                    else:
+                        await asyncio.wait_for(self.buffer_lock.wait(), next_flush - now)
+                except asyncio.TimeoutError:
+                    pass
 
-                for req, result in zip(batch, results):
-                    req["response"].set_result(result)
+    async def _run_batch(self, service_type: Enum, batch: list[dict]) -> None:
+        try:
+            results = await self.dynamic_batching_infer(service_type, batch)
+        except Exception as e:
+            logger.error(f"Dynamic batch of {len(batch)} {service_type.name} requests failed: {e}")
+            for req in batch:
+                if not req["response"].done():
+                    req["response"].set_exception(e)
+            return
+        for req, result in zip(batch, results):
+            # the caller may have given up on its request meanwhile
+            if not req["response"].done():
+                req["response"].set_result(result)
 
     async def dynamic_batching_infer(self, service_type: Enum, batch: list[dict]):
         """Need to implement."""
         raise NotImplementedError("Unimplemented dynamic batching inference!")
 
+    async def terminate_server(self):
+        if self.grpc_server is not None:
+            await self.grpc_server.stop()
+        await super().terminate_server()
+
     def _validate_env(self):
         """Check whether to use the microservice locally."""
         if self.use_remote_service:
@@ -139,6 +269,10 @@ class MicroService(HTTPService):
     def endpoint_path(self):
         return f"{self.protocol}://{self.host}:{self.port}{self.endpoint}"
 
+    @property
+    def grpc_target(self):
+        return f"{self.host}:{self.grpc_port}" if self.grpc_port else None
+
 
 def register_microservice(
     name: str,
@@ -156,8 +290,11 @@ def register_microservice(
     provider_endpoint: Optional[str] = None,
     methods: List[str] = ["POST"],
     dynamic_batching: bool = False,
-    dynamic_batching_timeout: int = 1,
+    dynamic_batching_timeout: float = 1,
     dynamic_batching_max_batch_size: int = 32,
+    grpc_port: Optional[int] = None,
+    workers: Optional[int] = None,
+    shared_memory: bool = False,
 ):
     def decorator(func):
         if name not in opea_microservices:
@@ -178,6 +315,9 @@ def register_microservice(
                 dynamic_batching=dynamic_batching,
                 dynamic_batching_timeout=dynamic_batching_timeout,
                 dynamic_batching_max_batch_size=dynamic_batching_max_batch_size,
+                grpc_port=grpc_port,
+                workers=workers,
+                shared_memory=shared_memory,
             )
             opea_microservices[name] = micro_service
         opea_microservices[name].app.router.add_api_route(endpoint, func, methods=methods)
@@ -3,30 +3,103 @@
 
 import asyncio
 import contextlib
-import copy
+import functools
 import json
 import os
-import re
 import threading
 import time
-from typing import Dict, List
+import uuid
+import warnings
+import weakref
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, NamedTuple, Optional
 
 import aiohttp
-import requests
+from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
-from prometheus_client import Gauge, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 from pydantic import BaseModel
 
 from ..proto.docarray import LLMParams
 from ..telemetry.opea_telemetry import opea_telemetry, tracer
+from .admission import ConcurrencyLimiter
+from .batching import NodeBatcher
 from .constants import ServiceType
 from .dag import DAG
+from .execution_plan import ExecutionPlan, RuntimeGraph, compile_black_list_pattern
+from .grpc_service import GrpcClient, grpc_available, stream_chunks
+from .http_service import PROCESS_TIME_HEADER
+from .inprocess import LocalHandler, find_local_handler, local_body_iterator, local_reply_data
+from .load_balancer import Replica, ReplicaSet
 from .logger import CustomLogger
+from .result_cache import DiskCacheTier, NodeResultCache, canonical_hash, without_per_request_fields
+from .shm import RequestPayloads, SharedPayloadStore
+from .single_flight import SingleFlight
+from .sse import (
+    DONE_DATA,
+    DONE_EVENT,
+    TOKEN_PATTERN,
+    SSEDecoder,
+    SSEEventCounter,
+    decode_token,
+    encode_token,
+)
+from .waterfall import RequestWaterfall, current_span
 
 logger = CustomLogger("comps-core-orchestrator")
 LOGFLAG = os.getenv("LOGFLAG", False)
 ENABLE_OPEA_TELEMETRY = os.getenv("ENABLE_OPEA_TELEMETRY", "false").lower() == "true"
 
+# Connection pool shared by all the requests scheduled by one orchestrator
+POOL_LIMIT = int(os.getenv("MEGASERVICE_POOL_LIMIT", 1000))
+POOL_LIMIT_PER_SERVICE = int(os.getenv("MEGASERVICE_POOL_LIMIT_PER_SERVICE", 100))
+POOL_KEEPALIVE_TIMEOUT = float(os.getenv("MEGASERVICE_POOL_KEEPALIVE_TIMEOUT", 60))
+POOL_DNS_CACHE_TTL = int(os.getenv("MEGASERVICE_POOL_DNS_CACHE_TTL", 300))
+POOL_PRECONNECT = int(os.getenv("MEGASERVICE_POOL_PRECONNECT", 1))
+# seconds between the samples of the pool utilisation gauges
+POOL_SAMPLE_INTERVAL = float(os.getenv("MEGASERVICE_POOL_SAMPLE_INTERVAL", 1))
+# Default deadline of a request, in seconds, when the caller does not give one
+REQUEST_TIMEOUT = float(os.getenv("MEGASERVICE_REQUEST_TIMEOUT", 1000))
+# Each node call is bounded by NODE_TIMEOUT_FACTOR times its observed p99 latency, but never below NODE_TIMEOUT_MIN
+# seconds; a factor of 0 bounds node calls by the request deadline only
+NODE_TIMEOUT_FACTOR = float(os.getenv("MEGASERVICE_NODE_TIMEOUT_FACTOR", 5))
+NODE_TIMEOUT_MIN = float(os.getenv("MEGASERVICE_NODE_TIMEOUT_MIN", 10))
+# the absolute deadline (unix time, seconds) forwarded to the micro services
+DEADLINE_HEADER = "X-OPEA-Deadline"
+# how many buffered sentences of a stream may be in flight to its downstream nodes at once
+STREAM_PIPELINE_DEPTH = int(os.getenv("MEGASERVICE_STREAM_PIPELINE_DEPTH", 8))
+# Admission control: requests beyond MEGASERVICE_MAX_PENDING_REQUESTS pending ones are rejected with a 503 error,
+# 0 disables it. Nodes with a concurrency limit queue at most MEGASERVICE_NODE_MAX_QUEUE calls by default.
+MAX_PENDING_REQUESTS = int(os.getenv("MEGASERVICE_MAX_PENDING_REQUESTS", 0))
+NODE_MAX_QUEUE = int(os.getenv("MEGASERVICE_NODE_MAX_QUEUE", 128))
+# Micro-batching defaults of the nodes added with a batch_key: collection window in seconds and maximum batch size
+BATCH_WINDOW = float(os.getenv("MEGASERVICE_BATCH_WINDOW", 0.005))
+MAX_BATCH_SIZE = int(os.getenv("MEGASERVICE_MAX_BATCH_SIZE", 32))
+# Micro services running in the same process as the orchestrator are called directly, without HTTP nor JSON
+INPROCESS = os.getenv("MEGASERVICE_INPROCESS", "true").lower() == "true"
+# Micro services with a gRPC port are reached over gRPC rather than HTTP, when grpcio is installed
+GRPC = os.getenv("MEGASERVICE_GRPC", "true").lower() == "true"
+# The outputs of all the nodes are kept in the results, when unset the output of a node is dropped once all its
+# successors consumed it
+KEEP_INTERMEDIATE_RESULTS = os.getenv("MEGASERVICE_KEEP_INTERMEDIATE_RESULTS", "true").lower() == "true"
+# Media inputs of at least this many characters go through shared memory to the nodes added with shared_memory=True
+SHM_MIN_SIZE = int(os.getenv("MEGASERVICE_SHM_MIN_SIZE", 1 << 20))
+# Waterfalls of the most recent requests kept for /v1/debug/waterfall, 0 disables them
+WATERFALL_HISTORY = int(os.getenv("MEGASERVICE_WATERFALL_HISTORY", 100))
+
+
+class NodeReply(NamedTuple):
+    status: int
+    content_type: str
+    body: bytes
+    # seconds the micro service reported in its PROCESS_TIME_HEADER, and waited for a pooled connection
+    server_time: Optional[float] = None
+    pool_wait: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
 
 class OrchestratorMetrics:
     # Need an static class-level ID for metric prefix because:
@@ -40,7 +113,47 @@ class OrchestratorMetrics:
         else:
             self._prefix = "megaservice"
 
-        self.request_pending = Gauge(f"{self._prefix}_request_pending", "Count of currently pending requests (gauge)")
+        # the gauges are summed over the live worker processes when the service runs several of them
+        self.request_pending = Gauge(
+            f"{self._prefix}_request_pending",
+            "Count of currently pending requests (gauge)",
+            multiprocess_mode="livesum",
+        )
+        self.pending = 0
+
+        # connection pool utilisation, sampled from the pool every POOL_SAMPLE_INTERVAL seconds
+        self.pool_active = Gauge(
+            f"{self._prefix}_pool_connections_active",
+            "Count of pooled connections currently in use (gauge)",
+            multiprocess_mode="livesum",
+        )
+        self.pool_idle = Gauge(
+            f"{self._prefix}_pool_connections_idle",
+            "Count of idle keep-alive connections in the pool (gauge)",
+            multiprocess_mode="livesum",
+        )
+        self.pool_limit = Gauge(
+            f"{self._prefix}_pool_connections_limit",
+            "Maximum size of the connection pool (gauge)",
+            multiprocess_mode="livesum",
+        )
+
+        # latency breakdown of the node calls
+        self.node_queue_wait = Histogram(
+            f"{self._prefix}_node_queue_wait",
+            "Time node calls spent waiting for a node slot or a pooled connection (histogram)",
+            ["node"],
+        )
+        self.node_network_time = Histogram(
+            f"{self._prefix}_node_network_time",
+            "Time node calls spent outside the micro service: connection, transfer and (de)serialization (histogram)",
+            ["node"],
+        )
+        self.node_server_time = Histogram(
+            f"{self._prefix}_node_server_time",
+            "Time the micro services reported spending on node calls until their reply started (histogram)",
+            ["node"],
+        )
 
         # locking for latency metric creation / method change
         self._lock = threading.Lock()
@@ -50,6 +163,14 @@ class OrchestratorMetrics:
         self.first_token_latency = None
         self.inter_token_latency = None
         self.request_latency = None
+        # created only when a node result cache or hedged requests are enabled
+        self.cache_events = None
+        self.hedged_requests = None
+        # created only when admission control or node concurrency limits are enabled
+        self.requests_rejected = None
+        self.node_queue_depth = None
+        self.node_batch_size = None
+        self.requests_deduplicated = None
 
         # initial methods to create the metrics
         self.token_update = self._token_update_create
@@ -91,10 +212,209 @@ class OrchestratorMetrics:
 
     def pending_update(self, increase: bool) -> None:
         if increase:
+            self.pending += 1
             self.request_pending.inc()
         else:
+            self.pending -= 1
             self.request_pending.dec()
 
+    def admission_create(self) -> None:
+        with self._lock:
+            if self.requests_rejected is None:
+                self.requests_rejected = Counter(
+                    f"{self._prefix}_requests_rejected",
+                    "Requests rejected by admission control, node '*' for the whole megaservice (counter)",
+                    ["node"],
+                )
+                self.node_queue_depth = Gauge(
+                    f"{self._prefix}_node_queue_depth",
+                    "Count of calls waiting for a node slot (gauge)",
+                    ["node"],
+                    multiprocess_mode="livesum",
+                )
+
+    def queue_depth_watch(self, node: str, limiter) -> None:
+        limiter.on_waiting = self.node_queue_depth.labels(node=node).set
+
+    def node_call_update(self, node: str, queue: float, network: float, server: Optional[float]) -> None:
+        self.node_queue_wait.labels(node=node).observe(queue)
+        self.node_network_time.labels(node=node).observe(network)
+        if server is not None:
+            self.node_server_time.labels(node=node).observe(server)
+
+    def rejected_update(self, node: str) -> None:
+        self.requests_rejected.labels(node=node).inc()
+
+    def single_flight_create(self) -> None:
+        with self._lock:
+            if self.requests_deduplicated is None:
+                self.requests_deduplicated = Counter(
+                    f"{self._prefix}_requests_deduplicated",
+                    "Requests served by an identical request in flight (counter)",
+                )
+
+    def single_flight_update(self) -> None:
+        self.requests_deduplicated.inc()
+
+    def batch_create(self) -> None:
+        with self._lock:
+            if self.node_batch_size is None:
+                self.node_batch_size = Histogram(
+                    f"{self._prefix}_node_batch_size",
+                    "Count of requests merged in one batched call of a node (histogram)",
+                    ["node"],
+                    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+                )
+
+    def batch_update(self, node: str, size: int) -> None:
+        self.node_batch_size.labels(node=node).observe(size)
+
+    def cache_create(self) -> None:
+        with self._lock:
+            if self.cache_events is None:
+                self.cache_events = Counter(
+                    f"{self._prefix}_node_cache_events",
+                    "Node result cache hits, misses and evictions (counter)",
+                    ["node", "event"],
+                )
+
+    def cache_update(self, node: str, event: str) -> None:
+        self.cache_events.labels(node=node, event=event).inc()
+
+    def hedge_create(self) -> None:
+        with self._lock:
+            if self.hedged_requests is None:
+                self.hedged_requests = Counter(
+                    f"{self._prefix}_hedged_requests",
+                    "Duplicate requests sent to another replica, and how many of them replied first (counter)",
+                    ["node", "event"],
+                )
+
+    def hedge_update(self, node: str, event: str) -> None:
+        self.hedged_requests.labels(node=node, event=event).inc()
+
+    def pool_update(self, connector: aiohttp.TCPConnector) -> None:
+        # aiohttp has no public API for the pool occupancy, read it from the connector
+        self.pool_active.set(len(getattr(connector, "_acquired", ())))
+        self.pool_idle.set(sum(len(c) for c in getattr(connector, "_conns", {}).values()))
+        self.pool_limit.set(connector.limit)
+
+
+def _pool_wait_trace_config() -> aiohttp.TraceConfig:
+    """Add the time requests waited for a pooled connection to the `pool_wait` of their trace_request_ctx."""
+
+    async def on_queued_start(session, context, params):
+        context.queued_at = time.time()
+
+    async def on_queued_end(session, context, params):
+        if isinstance(context.trace_request_ctx, dict):
+            context.trace_request_ctx["pool_wait"] += time.time() - context.queued_at
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(on_queued_start)
+    trace_config.on_connection_queued_end.append(on_queued_end)
+    return trace_config
+
+
+def _once(callback: Callable[[], None]) -> Callable[[], None]:
+    """Return a function calling `callback` on its first call only."""
+    called = False
+
+    def wrapper():
+        nonlocal called
+        if not called:
+            called = True
+            callback()
+
+    return wrapper
+
+
+def on_stream_end(iterator: AsyncIterator, callback: Callable[[], None]) -> AsyncIterator:
+    """Wrap a stream so that `callback` runs once when it ends, fails or is closed, or is dropped without being read."""
+    callback = _once(callback)
+
+    async def guarded():
+        try:
+            async for chunk in iterator:
+                yield chunk
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            callback()
+
+    stream = guarded()
+    # a generator that was never started does not run its finally block
+    weakref.finalize(stream, callback)
+    return stream
+
+
+_TEE_END = object()
+
+
+class StreamTee:
+    """Split one stream into `count` async iterators, without replay.
+
+    Iterating the tee gives the iterators. The source is read on the first read of one of them, and at most `maxsize`
+    chunks ahead of the slowest open one: an iterator that is not read holds the others back instead of buffering the
+    whole stream. An iterator that is closed, or dropped, no longer counts, and the source is closed with the last of
+    them.
+    """
+
+    def __init__(self, source: AsyncIterator, count: int, maxsize: int):
+        self._source = source
+        self._queues = [asyncio.Queue(maxsize) for _ in range(count)]
+        self._open = set(self._queues)
+        self._pump = None
+        self._error = None
+
+    def __iter__(self) -> Iterator[AsyncIterator]:
+        for queue in self._queues:
+            iterator = self._iterate(queue)
+            # an iterator that was never started does not run its finally block
+            weakref.finalize(iterator, self._close, queue)
+            yield iterator
+
+    async def _read_source(self) -> None:
+        try:
+            async for chunk in self._source:
+                for queue in [queue for queue in self._queues if queue in self._open]:
+                    await queue.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            if hasattr(self._source, "aclose"):
+                await self._source.aclose()
+        for queue in [queue for queue in self._queues if queue in self._open]:
+            await queue.put(_TEE_END)
+
+    async def _iterate(self, queue: asyncio.Queue) -> AsyncIterator:
+        if self._pump is None:
+            self._pump = asyncio.ensure_future(self._read_source())
+        try:
+            while (chunk := await queue.get()) is not _TEE_END:
+                yield chunk
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._close(queue)
+
+    def _close(self, queue: asyncio.Queue) -> None:
+        if queue not in self._open:
+            return
+        self._open.discard(queue)
+        # make room for the chunk the source may be waiting to put
+        while not queue.empty():
+            queue.get_nowait()
+        if not self._open and self._pump is not None:
+            self._pump.cancel()
+
+
+def _server_time(response: aiohttp.ClientResponse) -> Optional[float]:
+    try:
+        return float(response.headers[PROCESS_TIME_HEADER])
+    except (KeyError, ValueError):
+        return None
+
 
 class ServiceOrchestrator(DAG):
     """Manage 1 or N micro services in a DAG through Python API."""
@@ -102,129 +422,497 @@ class ServiceOrchestrator(DAG):
     def __init__(self) -> None:
         self.metrics = OrchestratorMetrics()
         self.services = {}  # all services, id -> service
+        self._session = None  # connection pool shared by all requests, created lazily on the serving loop
+        self._pool_sampler = None  # task sampling the utilisation of the pool into the metrics
+        self._plan = None  # compiled graph shared by all requests, reset whenever the graph changes
+        self._caches = {}  # service type -> NodeResultCache, see enable_cache()
+        self._replicas = {}  # service name -> ReplicaSet
+        self._limiters = {}  # service name -> ConcurrencyLimiter, for the nodes with a concurrency limit
+        self._batchers = {}  # service name -> NodeBatcher, for the nodes with a batch_key
+        self._local_handlers = {}  # service name -> LocalHandler, None for the nodes reached over HTTP
+        self._grpc = GrpcClient(POOL_LIMIT_PER_SERVICE) if GRPC and grpc_available() else None
+        self._shm_store = None  # created once a node accepts shared memory payloads
+        self._shm_nodes = set()
+        self._single_flight = None  # see enable_single_flight()
+        self._waterfalls = deque(maxlen=WATERFALL_HISTORY)  # RequestWaterfall of the most recent requests
+        if MAX_PENDING_REQUESTS:
+            self.metrics.admission_create()
         super().__init__()
 
-    def add(self, service):
+    def add(
+        self,
+        service,
+        replicas: Optional[List] = None,
+        hedge: bool = False,
+        max_concurrency: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        batch_key: Optional[str] = None,
+        batch_window: float = BATCH_WINDOW,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        shared_memory: bool = False,
+    ):
+        """Add a micro service as a node of the graph.
+
+        :param service: the micro service.
+        :param replicas: extra endpoints serving the same micro service, as URLs or micro services. Requests are
+            spread over all of them by least outstanding requests.
+        :param hedge: when set and the node has replicas, a duplicate request is sent to another replica once a
+            request exceeds the node's observed p95 latency, and the first reply wins.
+        :param max_concurrency: maximum count of concurrent calls to the node, unlimited by default.
+        :param max_queue: maximum count of calls waiting for a slot of the node, beyond which calls are rejected
+            with a 429 error. Defaults to MEGASERVICE_NODE_MAX_QUEUE.
+        :param batch_key: for micro services accepting a list of inputs, e.g. ``"input"`` of embeddings or
+            ``"prompt"`` of completions, the payload field whose values are batched. Concurrent calls to the node
+            arriving within `batch_window` seconds, whose payloads only differ by this field, are sent as one call
+            of at most `max_batch_size` inputs, see batch_inputs() and unbatch_outputs().
+        :param shared_memory: the micro service runs on this host and was created with `shared_memory=True`, its
+            large media inputs (`byte_str`, `base64_image`) are passed through shared memory segments instead of
+            inline JSON.
+        """
         if service.name not in self.services:
             self.services[service.name] = service
             self.add_node_if_not_exists(service.name)
+            self._plan = None
+            endpoints = [service.endpoint_path]
+            endpoints.extend(r if isinstance(r, str) else r.endpoint_path for r in replicas or [])
+            self._replicas[service.name] = ReplicaSet(endpoints, hedge=hedge)
+            if self._replicas[service.name].hedge:
+                self.metrics.hedge_create()
+            if max_concurrency:
+                self._limiters[service.name] = ConcurrencyLimiter(
+                    service.name, max_concurrency, NODE_MAX_QUEUE if max_queue is None else max_queue
+                )
+                self.metrics.admission_create()
+                self.metrics.queue_depth_watch(service.name, self._limiters[service.name])
+            if batch_key:
+                self._batchers[service.name] = NodeBatcher(
+                    batch_key, batch_window, max_batch_size, functools.partial(self._post_batch, service.name)
+                )
+                self.metrics.batch_create()
+            if shared_memory:
+                if self._shm_store is None:
+                    self._shm_store = SharedPayloadStore(SHM_MIN_SIZE)
+                self._shm_nodes.add(service.name)
         else:
             raise Exception(f"Service {service.name} already exists!")
         return self
 
+    def add_debug_routes(self, service) -> None:
+        """Serve the waterfalls of the recent requests on `/v1/debug/waterfall` of the megaservice's HTTPService.
+
+        `?request_id=` selects one request, it is the `request_id` of the runtime graph returned by schedule().
+        Otherwise the `limit` most recent requests are returned, newest first.
+        """
+
+        async def _waterfall(request_id: Optional[str] = None, limit: int = 20):
+            if request_id is not None:
+                for waterfall in self._waterfalls:
+                    if waterfall.request_id == request_id:
+                        return waterfall.to_dict()
+                raise HTTPException(status_code=404, detail=f"No waterfall for request {request_id}")
+            return [waterfall.to_dict() for waterfall in reversed(self._waterfalls)][:limit]
+
+        service.add_route("/v1/debug/waterfall", _waterfall, methods=["GET"])
+
+    def enable_single_flight(self):
+        """Run identical requests in flight only once.
+
+        A request with the same inputs, LLM parameters and keyword arguments as one being scheduled waits for the
+        latter's results instead of running the graph again. Streamed replies are multicast to all of them, and a
+        request that disconnects only stops the shared run when it was the last one using it.
+        """
+        self.metrics.single_flight_create()
+        self._single_flight = SingleFlight(on_follow=self.metrics.single_flight_update)
+        return self
+
     def flow_to(self, from_service, to_service):
         try:
             self.add_edge(from_service.name, to_service.name)
+            self._plan = None
             return True
         except Exception as e:
             logger.error(e)
             return False
 
+    def enable_cache(
+        self,
+        service_types=(ServiceType.EMBEDDING, ServiceType.RETRIEVER, ServiceType.RERANK),
+        max_size: int = 1024,
+        ttl: float = 300,
+        disk_path: Optional[str] = None,
+    ):
+        """Cache the replies of deterministic nodes, keyed by node name and a canonical hash of their inputs.
+
+        :param service_types: service types whose nodes are cached, or a dict mapping each of them to
+            a ``{"max_size": ..., "ttl": ...}`` override of the defaults below.
+        :param max_size: maximum count of replies kept in memory per service type.
+        :param ttl: seconds after which a cached reply expires.
+        :param disk_path: optional SQLite file backing the in-memory caches, to survive restarts.
+        """
+        if not isinstance(service_types, dict):
+            service_types = {service_type: {} for service_type in service_types}
+        disk = DiskCacheTier(disk_path) if disk_path else None
+        self.metrics.cache_create()
+        self._caches = {
+            service_type: NodeResultCache(
+                max_size=config.get("max_size", max_size),
+                ttl=config.get("ttl", ttl),
+                disk=disk,
+                on_event=self.metrics.cache_update,
+            )
+            for service_type, config in service_types.items()
+        }
+        return self
+
+    def _get_plan(self) -> ExecutionPlan:
+        """Return the compiled execution plan of the graph built with add() and flow_to()."""
+        if self._plan is None:
+            self._plan = ExecutionPlan.compile(self)
+        return self._plan
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled client session, (re)creating it for the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=POOL_LIMIT,
+                limit_per_host=POOL_LIMIT_PER_SERVICE,
+                keepalive_timeout=POOL_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=POOL_DNS_CACHE_TTL,
+                use_dns_cache=True,
+            )
+            timeout = aiohttp.ClientTimeout(total=1000)
+            self._session = aiohttp.ClientSession(
+                connector=connector, trust_env=True, timeout=timeout, trace_configs=[_pool_wait_trace_config()]
+            )
+            self._pool_sampler = loop.create_task(self._sample_pool(connector))
+        return self._session
+
+    async def _sample_pool(self, connector: aiohttp.TCPConnector) -> None:
+        # pushed rather than read on scrape, for the gauges to be aggregated across worker processes
+        while True:
+            self.metrics.pool_update(connector)
+            if connector.closed:
+                return
+            await asyncio.sleep(POOL_SAMPLE_INTERVAL)
+
+    async def preconnect(self) -> None:
+        """Open keep-alive connections to every registered micro service ahead of the first request.
+
+        Register it as a startup event of the megaservice,
+        e.g. ``service.add_startup_event(orchestrator.preconnect())``.
+        """
+        session = self._get_session()
+
+        async def _connect(name, endpoint):
+            try:
+                # any reply keeps the connection in the pool, the status code does not matter
+                async with session.head(endpoint, allow_redirects=False) as response:
+                    await response.release()
+            except Exception as e:
+                logger.warning(f"Pre-connection to {name} ({endpoint}) failed: {e}")
+
+        await asyncio.gather(
+            *(
+                _connect(name, endpoint)
+                for name, replica_set in self._replicas.items()
+                for endpoint in replica_set.endpoints
+                for _ in range(POOL_PRECONNECT)
+            )
+        )
+
+    async def close(self) -> None:
+        """Close the connection pool and unlink the shared memory segments."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._pool_sampler is not None:
+            self._pool_sampler.cancel()
+            self._pool_sampler = None
+        if self._grpc is not None:
+            await self._grpc.close()
+        if self._shm_store is not None:
+            self._shm_store.close()
+
+    async def schedule_many(
+        self,
+        inputs: List[Dict | BaseModel],
+        llm_parameters: LLMParams = LLMParams(),
+        return_exceptions: bool = False,
+        **kwargs,
+    ) -> List:
+        """Run the graph for many requests at once, e.g. an offline workload.
+
+        The requests are scheduled concurrently, so their calls to the nodes added with a `batch_key` are merged
+        into batched calls. Returns the ``(result_dict, runtime_graph)`` of every request, in order.
+        """
+        return await asyncio.gather(
+            *(self.schedule(initial_inputs, llm_parameters=llm_parameters, **kwargs) for initial_inputs in inputs),
+            return_exceptions=return_exceptions,
+        )
+
     @opea_telemetry
-    async def schedule(self, initial_inputs: Dict | BaseModel, llm_parameters: LLMParams = LLMParams(), **kwargs):
+    async def schedule(
+        self,
+        initial_inputs: Dict | BaseModel,
+        llm_parameters: LLMParams = LLMParams(),
+        deadline: Optional[float] = None,
+        **kwargs,
+    ):
+        """Run the graph for one request.
+
+        :param deadline: unix time by which the request has to complete, MEGASERVICE_REQUEST_TIMEOUT seconds from
+            now by default. Pending nodes are cancelled and a 504 error is raised once it cannot be met.
+        """
+        if self._single_flight is None:
+            return await self._schedule(initial_inputs, llm_parameters, deadline, **kwargs)
+        # docs get a random id on creation, it does not take part in the identity of a request
+        key = canonical_hash(
+            "schedule",
+            {
+                "inputs": initial_inputs if isinstance(initial_inputs, dict) else initial_inputs.dict(exclude={"id"}),
+                "llm_parameters": llm_parameters.dict(exclude={"id"}),
+                "kwargs": kwargs,
+            },
+        )
+        return await self._single_flight.run(
+            key, functools.partial(self._schedule, initial_inputs, llm_parameters, deadline, **kwargs)
+        )
+
+    async def _schedule(
+        self,
+        initial_inputs: Dict | BaseModel,
+        llm_parameters: LLMParams,
+        deadline: Optional[float],
+        **kwargs,
+    ):
         req_start = time.time()
+        if deadline is None:
+            deadline = req_start + REQUEST_TIMEOUT
+        if MAX_PENDING_REQUESTS and self.metrics.pending >= MAX_PENDING_REQUESTS:
+            # shed the request instead of queuing it behind the ones the megaservice cannot serve in time
+            self.metrics.rejected_update("*")
+            raise HTTPException(status_code=503, detail="Megaservice overloaded", headers={"Retry-After": "1"})
         self.metrics.pending_update(True)
 
+        plan = self._get_plan()
         result_dict = {}
-        runtime_graph = DAG()
-        runtime_graph.graph = copy.deepcopy(self.graph)
+        runtime_graph = RuntimeGraph(plan)
+        runtime_graph.shared_payloads = RequestPayloads(self._shm_store) if self._shm_nodes else None
+        runtime_graph.request_id = uuid.uuid4().hex
+        waterfall = RequestWaterfall(runtime_graph.request_id)
         if LOGFLAG:
             logger.info(initial_inputs)
 
-        timeout = aiohttp.ClientTimeout(total=1000)
-        async with aiohttp.ClientSession(trust_env=True, timeout=timeout) as session:
-            pending = {
-                asyncio.create_task(
-                    self.execute(session, req_start, node, initial_inputs, runtime_graph, llm_parameters, **kwargs)
+        session = self._get_session()
+
+        def start(node, inputs):
+            return asyncio.create_task(
+                self._execute_node(
+                    waterfall, session, req_start, node, inputs, runtime_graph, llm_parameters, deadline, **kwargs
                 )
-                for node in self.ind_nodes()
-            }
-            ind_nodes = self.ind_nodes()
+            )
+
+        pending = {start(node, initial_inputs) for node in plan.ind_nodes}
+        # count of unfinished predecessors, initialised from the plan when a node is first reached
+        waiting = {}
+        # count of successors that have yet to consume the output of each finished node
+        unconsumed = {}
 
+        try:
             while pending:
-                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                done, pending = await asyncio.wait(
+                    pending, timeout=deadline - time.time(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise HTTPException(status_code=504, detail="Request deadline exceeded")
                 for done_task in done:
-                    response, node = await done_task
-                    result_dict[node] = response
-
-                    # traverse the current node's downstream nodes and execute if all one's predecessors are finished
-                    downstreams = runtime_graph.downstream(node)
-
-                    # remove all the black nodes that are skipped to be forwarded to
-                    if not isinstance(response, StreamingResponse) and "downstream_black_list" in response:
-                        for black_node in response["downstream_black_list"]:
-                            for downstream in reversed(downstreams):
-                                try:
-                                    if re.findall(black_node, downstream):
-                                        if LOGFLAG:
-                                            logger.info(f"skip forwardding to {downstream}...")
-                                        runtime_graph.delete_edge(node, downstream)
-                                        downstreams.remove(downstream)
-                                except re.error as e:
-                                    logger.error("Pattern invalid! Operation cancelled.")
-                            if len(downstreams) == 0 and llm_parameters.stream:
-                                # turn the response to a StreamingResponse
-                                # to make the response uniform to UI
-                                def fake_stream(text):
-                                    yield "data: b'" + text + "'\n\n"
-                                    yield "data: [DONE]\n\n"
-
-                                result_dict[node] = StreamingResponse(
-                                    fake_stream(response["text"]), media_type="text/event-stream"
-                                )
-
-                    for d_node in downstreams:
-                        if all(i in result_dict for i in runtime_graph.predecessors(d_node)):
-                            inputs = self.process_outputs(runtime_graph.predecessors(d_node), result_dict)
-                            pending.add(
-                                asyncio.create_task(
-                                    self.execute(
-                                        session, req_start, d_node, inputs, runtime_graph, llm_parameters, **kwargs
-                                    )
-                                )
-                            )
-        nodes_to_keep = []
-        for i in ind_nodes:
-            nodes_to_keep.append(i)
-            nodes_to_keep.extend(runtime_graph.all_downstreams(i))
-
-        all_nodes = list(runtime_graph.graph.keys())
-
-        for node in all_nodes:
-            if node not in nodes_to_keep:
-                runtime_graph.delete_node_if_exists(node)
-
-        if not llm_parameters.stream:
+                    try:
+                        response, finished = await done_task
+                    except asyncio.TimeoutError as e:
+                        raise HTTPException(status_code=504, detail="Request deadline exceeded") from e
+                    # a stream forwarded through several downstream nodes is reported for each of them, with its own
+                    # stream of the replies of that node
+                    for node in finished if isinstance(finished, list) else [finished]:
+                        ready = self._ready_downstreams(
+                            node,
+                            response[node] if isinstance(finished, list) else response,
+                            plan,
+                            runtime_graph,
+                            result_dict,
+                            waiting,
+                            llm_parameters,
+                        )
+                        unconsumed[node] = len(runtime_graph.downstream(node))
+                        for d_node in ready:
+                            predecessors = runtime_graph.predecessors(d_node)
+                            inputs = self.process_outputs(predecessors, result_dict)
+                            if not KEEP_INTERMEDIATE_RESULTS:
+                                self._release_consumed(predecessors, result_dict, unconsumed)
+                            pending.add(start(d_node, inputs))
+        except BaseException:
+            # the deadline cannot be met or a node failed: free the slots and sockets of the remaining nodes
+            for task in pending:
+                task.cancel()
+                # a task may still end with its own error while being cancelled, retrieve it to silence asyncio
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            # the streams of the nodes that finished before are never returned, dropping them frees their nodes
+            result_dict.clear()
+            self.metrics.pending_update(False)
+            raise
+        finally:
+            # every node reading a shared payload has replied
+            if runtime_graph.shared_payloads is not None:
+                runtime_graph.shared_payloads.release()
+            waterfall.finish(plan.predecessors)
+            self._waterfalls.append(waterfall)
+
+        runtime_graph.prune(plan.ind_nodes)
+
+        # the request stays pending until all its streams are closed, whether consumed to their end or not
+        streams = [response for response in result_dict.values() if isinstance(response, StreamingResponse)]
+        remaining = len(streams)
+
+        def stream_closed():
+            nonlocal remaining
+            remaining -= 1
+            if remaining == 0:
+                self.metrics.pending_update(False)
+
+        for response in streams:
+            response.body_iterator = on_stream_end(response.body_iterator, stream_closed)
+        if not streams:
             self.metrics.pending_update(False)
 
         return result_dict, runtime_graph
 
+    async def _execute_node(
+        self,
+        waterfall: RequestWaterfall,
+        session: aiohttp.ClientSession,
+        req_start: float,
+        cur_node: str,
+        inputs: Dict,
+        runtime_graph: RuntimeGraph,
+        llm_parameters: LLMParams,
+        deadline: float,
+        **kwargs,
+    ):
+        """Execute the node in its own task, recording its span in the waterfall of the request."""
+        span = waterfall.begin(cur_node)
+        # the context is local to the task, the node calls made by it report to this span
+        current_span.set(span)
+        try:
+            return await self.execute(
+                session, req_start, cur_node, inputs, runtime_graph, llm_parameters, deadline=deadline, **kwargs
+            )
+        finally:
+            span.finish()
+
+    def _release_consumed(self, predecessors: List[str], result_dict: Dict, unconsumed: Dict) -> None:
+        """Drop the outputs all the successors have consumed, leaves are kept as the results of the request."""
+        for pred in predecessors:
+            unconsumed[pred] -= 1
+            if unconsumed[pred] == 0:
+                del result_dict[pred]
+
+    def _ready_downstreams(
+        self,
+        node: str,
+        response,
+        plan: ExecutionPlan,
+        runtime_graph: RuntimeGraph,
+        result_dict: Dict,
+        waiting: Dict,
+        llm_parameters: LLMParams,
+    ) -> List[str]:
+        """Record the reply of a finished node and return its downstream nodes whose predecessors all finished."""
+        result_dict[node] = response
+
+        # traverse the current node's downstream nodes and execute if all one's predecessors are finished
+        downstreams = runtime_graph.downstream(node)
+
+        # remove all the black nodes that are skipped to be forwarded to
+        if not isinstance(response, StreamingResponse) and "downstream_black_list" in response:
+            for black_node in response["downstream_black_list"]:
+                pattern = compile_black_list_pattern(black_node)
+                if pattern is None:
+                    logger.error("Pattern invalid! Operation cancelled.")
+                else:
+                    for downstream in reversed(downstreams):
+                        if pattern.search(downstream):
+                            if LOGFLAG:
+                                logger.info(f"skip forwardding to {downstream}...")
+                            runtime_graph.delete_edge(node, downstream)
+                            downstreams.remove(downstream)
+                            # the pruned edge is no longer waited for
+                            waiting[downstream] = waiting.get(downstream, plan.in_degree[downstream]) - 1
+                if len(downstreams) == 0 and llm_parameters.stream:
+                    # turn the response to a StreamingResponse
+                    # to make the response uniform to UI
+                    def fake_stream(text):
+                        yield "data: b'" + text + "'\n\n"
+                        yield "data: [DONE]\n\n"
+
+                    result_dict[node] = StreamingResponse(fake_stream(response["text"]), media_type="text/event-stream")
+
+        ready = []
+        for d_node in downstreams:
+            waiting[d_node] = waiting.get(d_node, plan.in_degree[d_node]) - 1
+            if waiting[d_node] == 0:
+                ready.append(d_node)
+        return ready
+
     def process_outputs(self, prev_nodes: List, result_dict: Dict) -> Dict:
-        all_outputs = {}
+        """Merge the outputs of the predecessors into a new dict, the inputs of a node.
 
-        # assume all prev_nodes outputs' keys are not duplicated
+        The last predecessor wins on duplicated keys. The merge is shallow: align_inputs() may add, replace or delete
+        keys without changing the outputs, but not modify their values in place.
+        """
+        all_outputs = {}
         for prev_node in prev_nodes:
             all_outputs.update(result_dict[prev_node])
         return all_outputs
 
     def wrap_iterable(self, iterable, is_first=True):
-
+        """Deprecated, the streams are read asynchronously by wrap_async_iterable()."""
+        warnings.warn(
+            "ServiceOrchestrator.wrap_iterable() is deprecated, use wrap_async_iterable()",
+            DeprecationWarning,
+            stacklevel=2,
+        )
         with tracer.start_as_current_span("llm_generate_stream") if ENABLE_OPEA_TELEMETRY else contextlib.nullcontext():
             while True:
                 with (
                     tracer.start_as_current_span("llm_generate_stream_first_token")
                     if is_first and ENABLE_OPEA_TELEMETRY
                     else contextlib.nullcontext()
-                ):  #  else tracer.start_as_current_span(f"llm_generate_stream_next_token")
+                ):
                     try:
                         token = next(iterable)
-                        yield token
-                        is_first = False
                     except StopIteration:
                         # Exiting the iterable loop cleanly
                         break
-                    except Exception as e:
-                        raise e
+                    yield token
+                    is_first = False
+
+    async def wrap_async_iterable(self, iterable, is_first=True):
+
+        with tracer.start_as_current_span("llm_generate_stream") if ENABLE_OPEA_TELEMETRY else contextlib.nullcontext():
+            iterator = aiter(iterable)
+            while True:
+                with (
+                    tracer.start_as_current_span("llm_generate_stream_first_token")
+                    if is_first and ENABLE_OPEA_TELEMETRY
+                    else contextlib.nullcontext()
+                ):
+                    try:
+                        token = await anext(iterator)
+                    except StopAsyncIteration:
+                        # Exiting the iterable loop cleanly
+                        break
+                    yield token
+                    is_first = False
 
     @opea_telemetry
     async def execute(
@@ -235,10 +923,12 @@ class ServiceOrchestrator(DAG):
         inputs: Dict,
         runtime_graph: DAG,
         llm_parameters: LLMParams = LLMParams(),
+        deadline: Optional[float] = None,
         **kwargs,
     ):
+        if deadline is None:
+            deadline = time.time() + REQUEST_TIMEOUT
         # send the cur_node request/reply
-        endpoint = self.services[cur_node].endpoint_path
         llm_parameters_dict = llm_parameters.dict()
 
         is_llm_vlm = self.services[cur_node].service_type in (ServiceType.LLM, ServiceType.LVM)
@@ -251,7 +941,6 @@ class ServiceOrchestrator(DAG):
         inputs = self.align_inputs(inputs, cur_node, runtime_graph, llm_parameters_dict, **kwargs)
 
         if is_llm_vlm and llm_parameters.stream:
-            # Still leave to sync requests.post for StreamingResponse
             if LOGFLAG:
                 logger.info(inputs)
             with (
@@ -259,61 +948,173 @@ class ServiceOrchestrator(DAG):
                 if ENABLE_OPEA_TELEMETRY
                 else contextlib.nullcontext()
             ):
-                response = requests.post(
-                    url=endpoint,
-                    data=json.dumps(inputs),
-                    headers={"Content-type": "application/json"},
-                    proxies={"http": None},
-                    stream=True,
-                    timeout=1000,
-                )
+                start = time.time()
+                limiter = await self._acquire_slot(cur_node, deadline)
+                queued = time.time() - start
+                local = self._get_local_handler(cur_node)
+                grpc_target = self._get_grpc_target(cur_node)
+                replica_set = self._replicas[cur_node]
+                replica = response = grpc_call = None
+                server_time, trace = None, {"pool_wait": 0.0}
+
+                @_once
+                def release():
+                    # the slot, the replica and the connection of the node are held until its stream is closed
+                    if replica is not None:
+                        replica_set.release(replica)
+                    if response is not None:
+                        response.release()
+                    if grpc_call is not None:
+                        grpc_call.cancel()
+                    if limiter is not None:
+                        limiter.release()
+
+                try:
+                    if local is not None:
+                        result = await local(inputs)
+                        status, chunks = 200, local_body_iterator(result)
+                        server_time = time.time() - start - queued
+                    elif grpc_target is not None:
+                        status, _, grpc_call = await self._grpc.invoke_stream(
+                            grpc_target,
+                            self.services[cur_node].endpoint,
+                            inputs,
+                            deadline - time.time(),
+                            ((DEADLINE_HEADER.lower(), f"{deadline:.3f}"),),
+                        )
+                        chunks = stream_chunks(grpc_call)
+                    else:
+                        replica = replica_set.pick()
+                        replica_set.acquire(replica)
+                        response = await session.post(
+                            replica.endpoint,
+                            data=json.dumps(inputs),
+                            headers={"Content-type": "application/json", DEADLINE_HEADER: f"{deadline:.3f}"},
+                            # the node budget bounds the connection, the stream itself may last until the deadline
+                            timeout=aiohttp.ClientTimeout(
+                                total=deadline - time.time(), sock_connect=self._node_budget(cur_node, deadline)
+                            ),
+                            trace_request_ctx=trace,
+                        )
+                        status, chunks = response.status, response.content.iter_any()
+                        server_time = _server_time(response)
+                    # up to the start of the stream, its tokens are accounted by the token latencies
+                    self._record_call(cur_node, start, queued + trace["pool_wait"], server_time)
+                    if status >= 400:
+                        # the error reply of the node is reported with its status, not as an empty stream
+                        detail = b"".join([chunk async for chunk in chunks]).decode("utf-8", errors="replace")
+                        raise HTTPException(status_code=status, detail=detail or f"{cur_node} failed")
+                except BaseException:
+                    release()
+                    raise
             downstream = runtime_graph.downstream(cur_node)
             if downstream:
-                assert len(downstream) == 1, "Not supported multiple stream downstreams yet!"
-                cur_node = downstream[0]
+                # the stream is attributed to the downstream nodes it is forwarded through
+                cur_node = downstream[0] if len(downstream) == 1 else downstream
                 hitted_ends = [".", "?", "!", "。", "，", "！"]
-                downstream_endpoint = self.services[downstream[0]].endpoint_path
 
-            def generate():
+            async def forward(sentence):
+                # fan the sentence out to every downstream node, results keep the downstream order
+                return await asyncio.gather(
+                    *(self._forward_text(session, node, sentence, deadline) for node in downstream)
+                )
+
+            async def generate(source):
+                async for item in source:
+                    yield item
+                self.metrics.request_update(req_start)
+
+            async def passthrough():
+                # the chunks are forwarded as read and only their events are counted
                 token_start = req_start
-                if response:
-                    # response.elapsed = time until first headers received
-                    buffered_chunk_str = ""
-                    is_first = True
-
-                    for chunk in self.wrap_iterable(response.iter_content(chunk_size=None)):
-
-                        if chunk:
-                            if downstream:
-                                chunk = chunk.decode("utf-8")
-                                buffered_chunk_str += self.extract_chunk_str(chunk)
-                                is_last = chunk.endswith("[DONE]\n\n")
-                                if (buffered_chunk_str and buffered_chunk_str[-1] in hitted_ends) or is_last:
-                                    res = requests.post(
-                                        url=downstream_endpoint,
-                                        data=json.dumps({"text": buffered_chunk_str}),
-                                        proxies={"http": None},
-                                    )
-                                    res_json = res.json()
-                                    if "text" in res_json:
-                                        res_txt = res_json["text"]
-                                    else:
-                                        raise Exception("Other response types not supported yet!")
-                                    buffered_chunk_str = ""  # clear
-                                    yield from self.token_generator(
-                                        res_txt, token_start, is_first=is_first, is_last=is_last
-                                    )
-                                    token_start = time.time()
-                            else:
-                                token_start = self.metrics.token_update(token_start, is_first)
-                                yield chunk
+                is_first = True
+                events = SSEEventCounter()
+                async for chunk in self.wrap_async_iterable(chunks):
+                    if chunk:
+                        tokens = events.feed(chunk) - chunk.endswith(DONE_EVENT)
+                        for _ in range(tokens):
+                            token_start = self.metrics.token_update(token_start, is_first)
                             is_first = False
+                        yield chunk
+
+            async def sentence_tokens(replies, index=None):
+                # the replies of every downstream node, or of the one at `index`, as token events
+                token_start = req_start
+                is_first = True
+                async for res_txts, is_last in replies:
+                    for res_txt in res_txts if index is None else res_txts[index : index + 1]:
+                        for token in self.token_generator(res_txt, token_start, is_first=is_first, is_last=False):
+                            yield token
+                        is_first = False
+                    token_start = time.time()
+                    if is_last:
+                        yield DONE_EVENT
+
+            async def pipeline():
+                # upstream tokens keep being read while earlier sentences are in flight downstream,
+                # the forwarded sentences are queued in order and bounded by the pipeline depth
+                in_flight = asyncio.Queue()
+                slots = asyncio.Semaphore(STREAM_PIPELINE_DEPTH)
+
+                async def read_upstream():
+                    # events are only decoded once complete, they may be split across chunks
+                    decoder = SSEDecoder()
+                    buffered_chunk_str = ""
+
+                    async def dispatch(events):
+                        nonlocal buffered_chunk_str
+                        for data in events:
+                            is_last = data == DONE_DATA
+                            if not is_last:
+                                buffered_chunk_str += decode_token(data)
+                            if (buffered_chunk_str and buffered_chunk_str[-1] in hitted_ends) or is_last:
+                                await slots.acquire()
+                                in_flight.put_nowait((asyncio.create_task(forward(buffered_chunk_str)), is_last))
+                                buffered_chunk_str = ""  # clear
+
+                    try:
+                        async for chunk in self.wrap_async_iterable(chunks):
+                            if chunk:
+                                await dispatch(decoder.feed(chunk))
+                        await dispatch(decoder.flush())
+                    finally:
+                        in_flight.put_nowait(None)
+
+                reader = asyncio.create_task(read_upstream())
+                try:
+                    while (item := await in_flight.get()) is not None:
+                        task, is_last = item
+                        res_txts = await task
+                        slots.release()
+                        yield res_txts, is_last
+                    # surface upstream read errors
+                    await reader
+                finally:
+                    reader.cancel()
+                    while not in_flight.empty():
+                        item = in_flight.get_nowait()
+                        if item is not None:
+                            item[0].cancel()
 
-                    self.metrics.request_update(req_start)
-                    self.metrics.pending_update(False)
+            if not downstream:
+                body = on_stream_end(generate(passthrough()), release)
+            elif len(downstream) == 1:
+                body = on_stream_end(generate(sentence_tokens(pipeline())), release)
+            else:
+                # the replies are read once and teed, each downstream node gets a stream of its own replies
+                replies = StreamTee(
+                    on_stream_end(generate(pipeline()), release), len(downstream), STREAM_PIPELINE_DEPTH
+                )
+                return {
+                    node: StreamingResponse(
+                        self.align_generator(sentence_tokens(node_replies, index), **kwargs),
+                        media_type="text/event-stream",
+                    )
+                    for index, (node, node_replies) in enumerate(zip(downstream, replies))
+                }, cur_node
 
             return (
-                StreamingResponse(self.align_generator(generate(), **kwargs), media_type="text/event-stream"),
+                StreamingResponse(self.align_generator(body, **kwargs), media_type="text/event-stream"),
                 cur_node,
             )
         else:
@@ -326,19 +1127,45 @@ class ServiceOrchestrator(DAG):
             else:
                 input_data = inputs
 
+            cache = self._caches.get(self.services[cur_node].service_type)
+            if cache is not None:
+                cache_key = canonical_hash(cur_node, input_data)
+                data = cache.get(cur_node, cache_key)
+                if data is not None:
+                    data = self.align_outputs(data, cur_node, inputs, runtime_graph, llm_parameters_dict, **kwargs)
+                    return data, cur_node
+
             with (
                 tracer.start_as_current_span(f"{cur_node}_generate")
                 if ENABLE_OPEA_TELEMETRY
                 else contextlib.nullcontext()
             ):
-                response = await session.post(endpoint, json=input_data)
+                local = self._get_local_handler(cur_node)
+                batcher = self._batchers.get(cur_node)
+                if local is not None:
+                    reply = None
+                    data = await self._call_local(local, cur_node, input_data, deadline)
+                elif batcher is not None and batcher.accepts(input_data):
+                    reply = await batcher.submit(input_data, deadline)
+                else:
+                    shared_payloads = getattr(runtime_graph, "shared_payloads", None)
+                    if shared_payloads is not None and cur_node in self._shm_nodes:
+                        input_data = shared_payloads.share(input_data)
+                    reply = await self._post(session, cur_node, input_data, deadline)
 
-            if response.content_type == "audio/wav":
-                audio_data = await response.read()
-                data = self.align_outputs(audio_data, cur_node, inputs, runtime_graph, llm_parameters_dict, **kwargs)
+            if reply is None:
+                # in-process reply, already decoded
+                if cache is not None and not isinstance(data, bytes):
+                    cache.put(cur_node, cache_key, json.dumps(data).encode("utf-8"))
+                data = self.align_outputs(data, cur_node, inputs, runtime_graph, llm_parameters_dict, **kwargs)
+            elif reply.content_type == "audio/wav":
+                data = self.align_outputs(reply.body, cur_node, inputs, runtime_graph, llm_parameters_dict, **kwargs)
             else:
                 # Parse as JSON
-                data = await response.json()
+                data = json.loads(reply.body)
+                if cache is not None and reply.ok:
+                    # keep the raw reply, align_outputs may modify the parsed one
+                    cache.put(cur_node, cache_key, reply.body)
                 # post process
                 data = self.align_outputs(data, cur_node, inputs, runtime_graph, llm_parameters_dict, **kwargs)
 
@@ -352,8 +1179,46 @@ class ServiceOrchestrator(DAG):
         """Override this method in megaservice definition."""
         return data
 
+    def batch_inputs(self, cur_node: str, batch_key: str, inputs: List[Dict]) -> Dict:
+        """Override this method in megaservice definition.
+
+        Merge the payloads of a batch into the payload of one call, by default the first payload with the list of
+        all the `batch_key` values. The per-request fields, e.g. `id`, differ between the payloads and are left out.
+        """
+        shared = without_per_request_fields({k: v for k, v in inputs[0].items() if k != batch_key})
+        return {**shared, batch_key: [data[batch_key] for data in inputs]}
+
+    def unbatch_outputs(self, cur_node: str, batch_key: str, output: Dict, count: int) -> List[Dict]:
+        """Override this method in megaservice definition.
+
+        Scatter the reply of a batched call back to the `count` calls it merged. OpenAI style `data` and `choices`
+        lists are split by their `index`, any other field, e.g. `usage`, is copied to every reply.
+        """
+        for field in ("data", "choices"):
+            items = output.get(field)
+            if isinstance(items, list) and items and len(items) % count == 0:
+                items = sorted(items, key=lambda item: item.get("index", 0))
+                per_input = len(items) // count
+                return [
+                    {
+                        **output,
+                        field: [
+                            {**item, "index": i} for i, item in enumerate(items[n * per_input : (n + 1) * per_input])
+                        ],
+                    }
+                    for n in range(count)
+                ]
+        values = output.get(batch_key)
+        if isinstance(values, list) and len(values) == count:
+            return [{**output, batch_key: value} for value in values]
+        raise Exception(f"Cannot scatter the batched reply of {cur_node}!")
+
     def align_generator(self, gen, *args, **kwargs):
-        """Override this method in megaservice definition."""
+        """Override this method in megaservice definition.
+
+        `gen` is an async generator of the stream chunks, the override has to consume it with `async for`. Overrides
+        written for the former synchronous generator, iterating it with `for`, have to be ported.
+        """
         return gen
 
     def get_all_final_outputs(self, result_dict, runtime_graph):
@@ -362,7 +1227,202 @@ class ServiceOrchestrator(DAG):
             final_output_dict[leaf] = result_dict[leaf]
         return final_output_dict
 
+    def _node_budget(self, cur_node: str, deadline: float) -> float:
+        """Return how long a call to the node may take, raising a 504 error when the deadline cannot be met."""
+        remaining = deadline - time.time()
+        latency = self._replicas[cur_node].latency
+        typical = latency.percentile(50)
+        if remaining <= 0 or (typical is not None and typical > remaining):
+            raise HTTPException(status_code=504, detail=f"Request deadline cannot be met by {cur_node}")
+        worst = latency.percentile(99)
+        if worst is not None and NODE_TIMEOUT_FACTOR > 0:
+            return min(remaining, max(worst * NODE_TIMEOUT_FACTOR, NODE_TIMEOUT_MIN))
+        return remaining
+
+    async def _post_batch(self, cur_node: str, inputs: List[Dict], deadline: float) -> List[NodeReply]:
+        """POST a batch of compatible payloads as one call and split its reply, see NodeBatcher."""
+        self.metrics.batch_update(cur_node, len(inputs))
+        batcher = self._batchers[cur_node]
+        data = self.batch_inputs(cur_node, batcher.batch_key, inputs)
+        reply = await self._post(self._get_session(), cur_node, data, deadline)
+        if not reply.ok or reply.content_type != "application/json":
+            # errors are reported to every call of the batch
+            return [reply] * len(inputs)
+        outputs = self.unbatch_outputs(cur_node, batcher.batch_key, json.loads(reply.body), len(inputs))
+        return [NodeReply(reply.status, reply.content_type, json.dumps(output).encode("utf-8")) for output in outputs]
+
+    def _get_local_handler(self, cur_node: str) -> Optional[LocalHandler]:
+        """Return the handler to call in-process when the node's micro service runs in this process."""
+        if cur_node not in self._local_handlers:
+            replicated = len(self._replicas[cur_node].replicas) > 1
+            self._local_handlers[cur_node] = (
+                find_local_handler(self.services[cur_node]) if INPROCESS and not replicated else None
+            )
+        return self._local_handlers[cur_node]
+
+    def _get_grpc_target(self, cur_node: str) -> Optional[str]:
+        """Return the gRPC target of the node when it is preferred to HTTP."""
+        service = self.services[cur_node]
+        if self._grpc is None or len(self._replicas[cur_node].replicas) > 1:
+            return None
+        return getattr(service, "grpc_target", None)
+
+    async def _post_grpc(self, target: str, cur_node: str, input_data: Dict, deadline: float) -> NodeReply:
+        budget = self._node_budget(cur_node, deadline)
+        start = time.time()
+        status, content_type, body = await self._grpc.invoke(
+            target,
+            self.services[cur_node].endpoint,
+            input_data,
+            budget,
+            ((DEADLINE_HEADER.lower(), f"{deadline:.3f}"),),
+        )
+        self._replicas[cur_node].latency.observe(time.time() - start)
+        return NodeReply(status, content_type, body)
+
+    async def _call_local(self, local: LocalHandler, cur_node: str, input_data: Dict, deadline: float) -> Any:
+        start = time.time()
+        limiter = await self._acquire_slot(cur_node, deadline)
+        queued = time.time() - start
+        try:
+            data = local_reply_data(await local(input_data))
+        finally:
+            if limiter is not None:
+                limiter.release()
+        # in-process calls have no network part, all the time after the queue is spent in the handler
+        self._record_call(cur_node, start, queued, time.time() - start - queued)
+        return data
+
+    async def _acquire_slot(self, cur_node: str, deadline: float) -> Optional[ConcurrencyLimiter]:
+        """Wait for a free slot of the node when its concurrency is limited, return the limiter to release."""
+        limiter = self._limiters.get(cur_node)
+        if limiter is not None:
+            try:
+                await limiter.acquire(deadline - time.time())
+            except HTTPException:
+                self.metrics.rejected_update(cur_node)
+                raise
+        return limiter
+
+    async def _post(
+        self, session: aiohttp.ClientSession, cur_node: str, input_data: Dict, deadline: float
+    ) -> NodeReply:
+        """POST the inputs to the node once it has a free slot."""
+        start = time.time()
+        limiter = await self._acquire_slot(cur_node, deadline)
+        queued = time.time() - start
+        try:
+            grpc_target = self._get_grpc_target(cur_node)
+            if grpc_target is not None:
+                reply = await self._post_grpc(grpc_target, cur_node, input_data, deadline)
+            else:
+                reply = await self._post_hedged(session, cur_node, input_data, deadline)
+        finally:
+            if limiter is not None:
+                limiter.release()
+        self._record_call(cur_node, start, queued + reply.pool_wait, reply.server_time)
+        return reply
+
+    def _record_call(self, cur_node: str, start: float, queue: float, server: Optional[float]) -> None:
+        """Observe the latency breakdown of a node call that started at `start`, in the metrics and the waterfall."""
+        network = max(0.0, time.time() - start - queue - (server or 0.0))
+        self.metrics.node_call_update(cur_node, queue, network, server)
+        span = current_span.get()
+        # calls made for another node, e.g. the ones a stream is forwarded to, are not part of the span
+        if span is not None and span.node == cur_node:
+            span.add_call(queue, network, server)
+
+    async def _post_hedged(
+        self, session: aiohttp.ClientSession, cur_node: str, input_data: Dict, deadline: float
+    ) -> NodeReply:
+        """POST the inputs to one replica of the node, hedged on another one when it is enabled.
+
+        A replica that cannot be reached falls back to another one.
+        """
+        replica_set = self._replicas[cur_node]
+        budget = self._node_budget(cur_node, deadline)
+        post = functools.partial(self._post_replica, session, replica_set, input_data=input_data, deadline=deadline)
+        primary = replica_set.pick()
+        delay = replica_set.hedge_delay()
+        if delay is None or delay >= budget:
+            try:
+                return await post(primary, budget=budget)
+            except aiohttp.ClientConnectionError:
+                if len(replica_set.replicas) == 1:
+                    raise
+            return await post(replica_set.pick(exclude=primary), budget=self._node_budget(cur_node, deadline))
+
+        primary_task = asyncio.create_task(post(primary, budget=budget))
+        tasks = {primary_task}
+        try:
+            done, tasks = await asyncio.wait(tasks, timeout=delay)
+            hedged = not done
+            if hedged or isinstance(primary_task.exception(), aiohttp.ClientConnectionError):
+                if hedged:
+                    self.metrics.hedge_update(cur_node, "sent")
+                secondary = replica_set.pick(exclude=primary)
+                tasks.add(asyncio.create_task(post(secondary, budget=self._node_budget(cur_node, deadline))))
+            while True:
+                if not done:
+                    done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                # prefer a successful reply, the other request may still succeed after a failure
+                for task in sorted(done, key=lambda t: t.exception() is not None):
+                    if task.exception() is None or not tasks:
+                        if hedged and task is not primary_task:
+                            self.metrics.hedge_update(cur_node, "won")
+                        return task.result()
+                done = set()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _post_replica(
+        self,
+        session: aiohttp.ClientSession,
+        replica_set: ReplicaSet,
+        replica: Replica,
+        input_data: Dict,
+        deadline: float,
+        budget: float,
+    ) -> NodeReply:
+        replica_set.acquire(replica)
+        start = time.time()
+        latency = None
+        trace = {"pool_wait": 0.0}
+        try:
+            async with session.post(
+                replica.endpoint,
+                json=input_data,
+                headers={DEADLINE_HEADER: f"{deadline:.3f}"},
+                timeout=aiohttp.ClientTimeout(total=budget),
+                trace_request_ctx=trace,
+            ) as response:
+                reply = NodeReply(
+                    response.status,
+                    response.content_type,
+                    await response.read(),
+                    _server_time(response),
+                    trace["pool_wait"],
+                )
+            latency = time.time() - start
+            return reply
+        finally:
+            replica_set.release(replica, latency)
+
+    async def _forward_text(self, session: aiohttp.ClientSession, cur_node: str, text: str, deadline: float) -> str:
+        reply = await self._post(session, cur_node, {"text": text}, deadline)
+        res_json = json.loads(reply.body)
+        if "text" in res_json:
+            return res_json["text"]
+        raise Exception("Other response types not supported yet!")
+
     def extract_chunk_str(self, chunk_str):
+        """Deprecated, the streams are decoded by SSEDecoder and decode_token()."""
+        warnings.warn(
+            "ServiceOrchestrator.extract_chunk_str() is deprecated, use cores.mega.sse.SSEDecoder and decode_token()",
+            DeprecationWarning,
+            stacklevel=2,
+        )
         if chunk_str == "data: [DONE]\n\n":
             return ""
         prefix = "data: b'"
@@ -375,12 +1435,10 @@ class ServiceOrchestrator(DAG):
             chunk_str = chunk_str[: -len(suffix)]
         return chunk_str
 
-    def token_generator(self, sentence: str, token_start: float, is_first: bool, is_last: bool) -> str:
-        prefix = "data: "
-        suffix = "\n\n"
-        tokens = re.findall(r"\s?\S+\s?", sentence, re.UNICODE)
-        for token in tokens:
+    def token_generator(self, sentence: str, token_start: float, is_first: bool, is_last: bool) -> Iterator[bytes]:
+        for token in TOKEN_PATTERN.findall(sentence):
             token_start = self.metrics.token_update(token_start, is_first)
-            yield prefix + repr(token.replace("\\n", "\n").encode("utf-8")) + suffix
+            is_first = False
+            yield encode_token(token)
         if is_last:
-            yield "data: [DONE]\n\n"
+            yield DONE_EVENT
@@ -1,102 +1,378 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
+import hashlib
 import json
+import os
 import re
 from collections import OrderedDict
-from typing import Dict, List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-import requests
+import aiohttp
 import yaml
+from fastapi.responses import StreamingResponse
 
+from ..proto.docarray import LLMParams
+from .constants import ServiceType
 from .dag import DAG
+from .execution_plan import ExecutionPlan
+from .logger import CustomLogger
+from .orchestrator import POOL_DNS_CACHE_TTL, POOL_KEEPALIVE_TIMEOUT, POOL_LIMIT, POOL_LIMIT_PER_SERVICE
+from .sse import DONE_DATA, DONE_EVENT, TOKEN_PATTERN, SSEDecoder, decode_token, encode_token
+
+logger = CustomLogger("orchestrator_with_yaml")
+
+# sentences of a stream are forwarded to the downstream nodes as soon as they end with one of these
+SENTENCE_ENDS = (".", "?", "!", "。", "，", "！")
+# Compiled plans are cached in this directory, keyed by the hash of the YAML content; set it empty to compile the plan
+# each time the YAML is loaded
+PLAN_CACHE_DIR = os.getenv(
+    "MEGASERVICE_PLAN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opea", "megaservice_plans")
+)
+# bumped whenever the layout or the validation of the compiled plans changes, cached plans of another version are
+# recompiled
+PLAN_FORMAT = 2
+# How often watch() checks the YAML file for changes, in seconds
+YAML_RELOAD_INTERVAL = float(os.getenv("MEGASERVICE_YAML_RELOAD_INTERVAL", 2))
+
+
+def parse_mega_flow(rules: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """Return the nodes, in order of appearance, and the edges of mega flow rules.
+
+    rules: ['(s1, s2) >> s3', 's3 >> (s4, s5)']
+    ['(s1, s2) >> s3 >> (s4, s5)']
+    """
+    nodes = {}
+    edges = {}
+    for rule in rules:
+        prev_nodes = None
+        for node_group_str in (i.strip() for i in rule.split(">>")):  # ['(s1, s2)', 's3']
+            if node_group_str.startswith("(") and node_group_str.endswith(")"):
+                cur_nodes = [i.strip() for i in re.findall(r"\((.*)\)", node_group_str)[0].split(",")]
+            else:
+                cur_nodes = [node_group_str]
+            nodes.update(dict.fromkeys(cur_nodes))
+            for prev_node in prev_nodes or ():
+                for cur_node in cur_nodes:
+                    edges[(prev_node, cur_node)] = None
+            prev_nodes = cur_nodes
+    return list(nodes), list(edges)
+
+
+def compile_plan(docs: Dict) -> Dict:
+    """Validate the parsed YAML and compile it into a plan that can be serialized: the docs, the successors of each
+    node and a topological order.
+
+    Raises ValueError when the graph is not a DAG, refers to micro services that are not declared, or declares them
+    with an unknown `service_type`.
+    """
+    services = docs.get("opea_micro_services") or {}
+    mega_service = docs.get("opea_mega_service") or {}
+    if "mega_flow" in mega_service:
+        nodes, edges = parse_mega_flow(mega_service["mega_flow"])
+    else:
+        nodes, edges = list(services), []
+    undeclared = [node for node in nodes if node not in services]
+    if undeclared:
+        raise ValueError(f"micro services {undeclared} are not declared in opea_micro_services")
+    missing = [node for node in nodes if "endpoint" not in (services[node] or {})]
+    if missing:
+        raise ValueError(f"micro services {missing} have no endpoint")
+    unknown = [
+        node
+        for node in nodes
+        if str(services[node].get("service_type", "undefined")).upper() not in ServiceType.__members__
+    ]
+    if unknown:
+        raise ValueError(f"micro services {unknown} have an unknown service_type")
+    successors = {node: [] for node in nodes}
+    for prev_node, cur_node in edges:
+        successors[prev_node].append(cur_node)
+    dag = DAG()
+    if nodes and not dag.validate(successors):
+        raise ValueError("the mega flow is not acyclic")
+    return {"format": PLAN_FORMAT, "docs": docs, "successors": successors, "order": dag.topological_sort(successors)}
+
+
+def load_plan(content: bytes, digest: str, cache_dir: Optional[str] = None) -> Dict:
+    """Return the compiled plan of the YAML content, from the cache when the content with this hash was compiled.
+
+    The plans are cached in `cache_dir`, PLAN_CACHE_DIR by default, and not cached when it is empty. A cache that cannot
+    be written is skipped.
+    """
+    if cache_dir is None:
+        cache_dir = PLAN_CACHE_DIR
+    path = os.path.join(cache_dir, f"{digest}.json") if cache_dir else None
+    if path is not None:
+        try:
+            with open(path) as file:
+                plan = json.load(file)
+            if plan.get("format") == PLAN_FORMAT:
+                return plan
+        except (OSError, ValueError):
+            pass
+    plan = compile_plan(yaml.safe_load(content))
+    if path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # written aside then renamed, concurrent readers never see a partial plan
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(plan, file)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Cannot cache the compiled plan in {cache_dir}: {e}")
+    return plan
+
+
+class YamlGraph(NamedTuple):
+    """One version of the mega graph, the requests keep the version they started with."""
+
+    digest: str
+    docs: Dict
+    plan: ExecutionPlan
 
 
 class ServiceOrchestratorWithYaml(DAG):
-    """Manage 1 or N micro services in a DAG defined by YAML."""
+    """Manage 1 or N micro services in a DAG defined by YAML.
+
+    The nodes of a level of the DAG, i.e. whose predecessors all ran in earlier levels, are called concurrently over a
+    connection pool shared by all the requests. Each request keeps its own results. Nodes declared with
+    `service_type: llm` (or `lvm`) in the YAML get the LLM parameters of the request, and stream their reply when
+    they are asked to.
+    """
 
     def __init__(self, yaml_file_path: str):
         self.yaml_file_path = yaml_file_path
-        self.result_dict = {}  # {node: node's dict output}
+        self.result_dict = {}  # {node: node's dict output}, of the last scheduled request
+        self._session = None  # connection pool shared by all requests, created lazily on the serving loop
+        self._current = None  # YamlGraph the new requests are scheduled on
+        self._file_stamp = None  # modification time and size of the YAML file when it was last read
         super().__init__()
-        self.docs, is_valid = self._load_from_yaml()
-        if not is_valid:
-            raise Exception("Invalid mega graph!")
+        try:
+            self._load_from_yaml()
+        except ValueError as e:
+            raise Exception(f"Invalid mega graph! {e}")
+
+    def _get_plan(self) -> ExecutionPlan:
+        return self._current.plan
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled client session, (re)creating it for the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=POOL_LIMIT,
+                limit_per_host=POOL_LIMIT_PER_SERVICE,
+                keepalive_timeout=POOL_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=POOL_DNS_CACHE_TTL,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=1000))
+        return self._session
+
+    async def close(self) -> None:
+        """Close the connection pool."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
-    def execute(self, cur_node: str, inputs: Dict):
-        # send the cur_node request/reply
-        endpoint = self.docs["opea_micro_services"][cur_node]["endpoint"]
-        response = requests.post(url=endpoint, data=json.dumps(inputs), proxies={"http": None})
-        print(response)
-        return response.json()
+    def service_type(self, cur_node: str, docs: Optional[Dict] = None) -> ServiceType:
+        """Return the `service_type` the node is declared with in the YAML, UNDEFINED by default."""
+        docs = self.docs if docs is None else docs
+        service_type = docs["opea_micro_services"][cur_node].get("service_type", "undefined")
+        return ServiceType[str(service_type).upper()]
 
-    def get_all_final_outputs(self):
+    async def execute(
+        self,
+        session: aiohttp.ClientSession,
+        cur_node: str,
+        inputs: Dict,
+        llm_parameters: LLMParams = LLMParams(),
+        docs: Optional[Dict] = None,
+    ):
+        """Call the node and return its parsed JSON reply, or the response itself for a stream to read.
 
+        `docs` are the ones of the graph the request is scheduled on, the current ones by default.
+        """
+        docs = self.docs if docs is None else docs
+        endpoint = docs["opea_micro_services"][cur_node]["endpoint"]
+        if self.service_type(cur_node, docs) in (ServiceType.LLM, ServiceType.LVM):
+            inputs = {**inputs, **llm_parameters.dict(exclude={"id"})}
+            if llm_parameters.stream:
+                response = await session.post(endpoint, json=inputs)
+                if response.content_type == "text/event-stream":
+                    return response
+                try:
+                    return await response.json(content_type=None)
+                finally:
+                    response.release()
+        async with session.post(endpoint, json=inputs) as response:
+            return await response.json(content_type=None)
+
+    def get_all_final_outputs(self, result_dict: Optional[Dict] = None):
+        result_dict = self.result_dict if result_dict is None else result_dict
         for leaf in self.all_leaves():
-            print(self.result_dict[leaf])
+            print(result_dict[leaf])
 
-    def process_outputs(self, prev_nodes: List) -> Dict:
+    def process_outputs(self, prev_nodes: List, result_dict: Optional[Dict] = None) -> Dict:
+        result_dict = self.result_dict if result_dict is None else result_dict
         all_outputs = {}
         # assume all prev_nodes outputs' keys are not duplicated
         for prev_node in prev_nodes:
-            all_outputs.update(self.result_dict[prev_node])
+            all_outputs.update(result_dict[prev_node])
         return all_outputs
 
-    async def schedule(self, initial_inputs: Dict):
-        for node in self.topological_sort():
-            if node in self.ind_nodes():
-                inputs = initial_inputs
-            else:
-                inputs = self.process_outputs(self.predecessors(node))
-            response = self.execute(node, inputs)
-            self.result_dict[node] = response
-
-    def _load_from_yaml(self):
-        """Parse the yaml and output docs, whether the mega graph is valid, the mega graph."""
-        with open(self.yaml_file_path) as file:
-            docs = yaml.safe_load(file)
-
-        if "mega_flow" in docs["opea_mega_service"]:
-            mega_flow = docs["opea_mega_service"]["mega_flow"]
-            return docs, self._construct_dag_from_rules(mega_flow)
-        else:
-            node_ids = docs["opea_micro_services"]
-            return docs, self._construct_dag_from_nodes(node_ids)
-
-    def _construct_dag_from_nodes(self, nodes: List[str]) -> Tuple[bool, OrderedDict]:
-        for cur_node in nodes:
-            self.add_node_if_not_exists(cur_node)
-        return True
+    async def schedule(self, initial_inputs: Dict, llm_parameters: LLMParams = LLMParams()) -> Dict:
+        """Run the graph for one request and return its results, {node: node's output}.
+
+        A streamed LLM reply is returned as a StreamingResponse. When the LLM node has downstream nodes, each complete
+        sentence is sent through them and the stream carries their replies instead; the nodes after those are not
+        run. The results are also bound to `result_dict` for the callers reading them from there.
 
-    def _construct_dag_from_rules(self, rules: List[str]) -> Tuple[bool, OrderedDict]:
-        """rules: ['(s1, s2) >> s3', 's3 >> (s4, s5)']
-        ['(s1, s2) >> s3 >> (s4, s5)']
+        The request runs on the graph loaded when it started, even if the YAML is reloaded meanwhile.
         """
-        is_valid = True
-        for rule in rules:
-            node_groups = [i.strip() for i in rule.split(">>")]  # ['(s1, s2)', 's3']
-            prev_nodes = None
-            for node_group_str in node_groups:
-
-                if node_group_str.startswith("(") and node_group_str.endswith(")"):
-                    cur_nodes = [i.strip() for i in re.findall(r"\((.*)\)", node_group_str)[0].split(",")]
-                    for cur_node in cur_nodes:
-                        self.add_node_if_not_exists(cur_node)
+        current = self._current
+        plan, docs = current.plan, current.docs
+        session = self._get_session()
+        result_dict = {}
+        skipped = set()  # nodes served by a stream
+        streams = []  # upstream responses of the streams, only read once the request is returned
+        for level in plan.levels:
+            nodes = [node for node in level if node not in skipped]
+            inputs = [
+                self.process_outputs(plan.predecessors[node], result_dict) if plan.in_degree[node] else initial_inputs
+                for node in nodes
+            ]
+            outputs = await asyncio.gather(
+                *(self.execute(session, node, data, llm_parameters, docs) for node, data in zip(nodes, inputs)),
+                return_exceptions=True,
+            )
+            streams.extend(output for output in outputs if isinstance(output, aiohttp.ClientResponse))
+            errors = [output for output in outputs if isinstance(output, BaseException)]
+            if errors:
+                for response in streams:
+                    response.release()
+                raise errors[0]
+            for node, output in zip(nodes, outputs):
+                if isinstance(output, aiohttp.ClientResponse):
+                    downstream = plan.successors[node]
+                    result_dict[node] = StreamingResponse(
+                        self._stream(session, output, downstream, llm_parameters, docs), media_type="text/event-stream"
+                    )
+                    # the downstream nodes and all the nodes after them
+                    stack = list(downstream)
+                    while stack:
+                        d_node = stack.pop()
+                        if d_node not in skipped:
+                            skipped.add(d_node)
+                            stack.extend(plan.successors[d_node])
                 else:
-                    cur_nodes = [node_group_str]
-                    self.add_node_if_not_exists(node_group_str)
-                if prev_nodes:
-                    try:
-                        for prev_node in prev_nodes:
-                            for cur_node in cur_nodes:
-                                self.add_edge(prev_node, cur_node)
-                    except Exception as e:
-                        print("**********")
-                        print(f"add edge fail! {prev_node} >> {cur_node}")
-                        print(e)
-                        print("**********")
-                        is_valid = False
-                        self.reset_graph()
-                        break
-                prev_nodes = cur_nodes
-        return is_valid
+                    result_dict[node] = output
+        self.result_dict = result_dict
+        return result_dict
+
+    async def _stream(
+        self,
+        session: aiohttp.ClientSession,
+        response: aiohttp.ClientResponse,
+        downstream: Tuple[str, ...],
+        llm_parameters: LLMParams,
+        docs: Dict,
+    ):
+        try:
+            if not downstream:
+                async for chunk in response.content.iter_any():
+                    yield chunk
+                return
+            decoder = SSEDecoder()
+
+            async def events():
+                async for chunk in response.content.iter_any():
+                    for data in decoder.feed(chunk):
+                        yield data
+                for data in decoder.flush():
+                    yield data
+
+            sentence = ""
+            async for data in events():
+                if data != DONE_DATA:
+                    sentence += decode_token(data)
+                if sentence and (data == DONE_DATA or sentence[-1] in SENTENCE_ENDS):
+                    async for token in self._forward(session, sentence, downstream, llm_parameters, docs):
+                        yield token
+                    sentence = ""
+            # the stream may end without a [DONE] event
+            if sentence:
+                async for token in self._forward(session, sentence, downstream, llm_parameters, docs):
+                    yield token
+            yield DONE_EVENT
+        finally:
+            response.release()
+
+    async def _forward(
+        self,
+        session: aiohttp.ClientSession,
+        sentence: str,
+        downstream: Tuple[str, ...],
+        llm_parameters: LLMParams,
+        docs: Dict,
+    ):
+        """Send a sentence through the downstream nodes, their replies are re-emitted as tokens in order."""
+        replies = await asyncio.gather(
+            *(self.execute(session, node, {"text": sentence}, llm_parameters, docs) for node in downstream)
+        )
+        for reply in replies:
+            if "text" not in reply:
+                raise Exception("Other response types not supported yet!")
+            for token in TOKEN_PATTERN.findall(reply["text"]):
+                yield encode_token(token)
+
+    def _load_from_yaml(self) -> bool:
+        """Load the YAML file when it changed since it was last read, return whether the graph was swapped.
+
+        The plan is compiled once per content, and cached in PLAN_CACHE_DIR unless it is empty. Raises ValueError for an
+        invalid graph.
+        """
+        stat = os.stat(self.yaml_file_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._file_stamp:
+            return False
+        with open(self.yaml_file_path, "rb") as file:
+            content = file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if self._current is not None and digest == self._current.digest:
+            self._file_stamp = stamp
+            return False
+        compiled = load_plan(content, digest)
+        plan = ExecutionPlan(compiled["successors"], compiled["order"])
+        # swapped at once, without awaiting: a request sees either the previous graph or this one
+        self._current = YamlGraph(digest, compiled["docs"], plan)
+        self.docs = compiled["docs"]
+        self.graph = OrderedDict((node, set(successors)) for node, successors in compiled["successors"].items())
+        self._file_stamp = stamp
+        return True
+
+    def reload(self) -> bool:
+        """Reload the graph if the YAML file changed, an invalid file keeps the current graph.
+
+        Requests in flight complete on the graph they started with.
+        """
+        try:
+            reloaded = self._load_from_yaml()
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            logger.error(f"Cannot reload {self.yaml_file_path}, keeping the current graph: {e}")
+            return False
+        if reloaded:
+            logger.info(f"Reloaded the mega graph from {self.yaml_file_path}")
+        return reloaded
+
+    async def watch(self, interval: float = YAML_RELOAD_INTERVAL) -> None:
+        """Reload the graph whenever the YAML file changes, checking it every `interval` seconds.
+
+        Register it as a startup event of the megaservice, e.g. ``service.add_startup_event(orchestrator.watch())``.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.reload()
@@ -0,0 +1,125 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+# fields that differ between otherwise identical requests, e.g. the random id docs get on creation
+PER_REQUEST_FIELDS = frozenset({"id"})
+
+
+def without_per_request_fields(value: Any) -> Any:
+    """Return a copy of the value without the PER_REQUEST_FIELDS of its dicts, at any depth."""
+    if isinstance(value, dict):
+        return {k: without_per_request_fields(v) for k, v in value.items() if k not in PER_REQUEST_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return [without_per_request_fields(v) for v in value]
+    return value
+
+
+def canonical_hash(node: str, inputs: Dict) -> str:
+    """Hash a node name with its inputs, independently of the key order of the inputs.
+
+    The PER_REQUEST_FIELDS of the inputs and of their nested docs do not take part in the hash.
+    """
+    payload = json.dumps(
+        without_per_request_fields(inputs), sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(f"{node}\0{payload}".encode("utf-8")).hexdigest()
+
+
+class DiskCacheTier:
+    """SQLite backed second tier, so that cached replies survive restarts."""
+
+    # purge the expired rows every this many writes
+    _PURGE_INTERVAL = 1000
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS node_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+        )
+        self._writes = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM node_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def put(self, key: str, value: bytes, expires: float) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO node_cache VALUES (?, ?, ?)", (key, value, expires))
+            self._writes += 1
+            if self._writes % self._PURGE_INTERVAL == 0:
+                self._conn.execute("DELETE FROM node_cache WHERE expires < ?", (time.time(),))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class NodeResultCache:
+    """LRU cache of raw JSON node replies with TTL eviction.
+
+    Entries are kept serialized, every hit returns a fresh object that `align_outputs` is free to modify.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 300,
+        disk: Optional[DiskCacheTier] = None,
+        on_event: Optional[Callable[[str, str], None]] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk = disk
+        self._on_event = on_event or (lambda node, event: None)
+        self._entries = OrderedDict()  # key -> (expires, node, serialized reply)
+
+    def get(self, node: str, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self._entries.move_to_end(key)
+                self._on_event(node, "hit")
+                return json.loads(entry[2])
+            del self._entries[key]
+            self._on_event(node, "eviction")
+
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._insert(node, key, value, time.time() + self.ttl)
+                self._on_event(node, "hit")
+                return json.loads(value)
+
+        self._on_event(node, "miss")
+        return None
+
+    def put(self, node: str, key: str, value: bytes) -> None:
+        expires = time.time() + self.ttl
+        self._insert(node, key, value, expires)
+        if self.disk is not None:
+            self.disk.put(key, value, expires)
+
+    def _insert(self, node: str, key: str, value: bytes, expires: float) -> None:
+        self._entries[key] = (expires, node, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            _, (_, evicted_node, _) = self._entries.popitem(last=False)
+            self._on_event(evicted_node, "eviction")
@@ -0,0 +1,214 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import functools
+import hmac
+import inspect
+import re
+import secrets
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+
+# large media payloads passed to co-located micro services are replaced by a handle to a shared memory segment
+SHM_HANDLE_PREFIX = "opea-shm://"
+# payload fields that may carry a handle, the micro services created with shared_memory=True resolve them
+SHM_FIELDS = ("byte_str", "base64_image")
+# name prefix of the segments exported by a SharedPayloadStore, no other segment of the host is ever opened
+SHM_NAME_PREFIX = "opea_shm_"
+
+# each segment starts with a random token, a handle only resolves when it carries the same one
+_TOKEN_SIZE = 16
+# names of the segments exported by the stores of this process
+_exported_names = set()
+_HANDLE_PATTERN = re.compile(
+    rf"^{re.escape(SHM_HANDLE_PREFIX)}({SHM_NAME_PREFIX}[0-9a-f]{{16}})/([0-9]+)/([0-9a-f]{{{2 * _TOKEN_SIZE}}})$"
+)
+
+
+class SharedPayloadStore:
+    """Shared memory segments holding the payloads exported by this process.
+
+    Each segment is reference counted by the requests using it, and unlinked once the last of them released it.
+    """
+
+    def __init__(self, min_size: int):
+        self.min_size = min_size
+        self._lock = threading.Lock()
+        self._segments = {}  # handle -> [segment, refcount, id of the exported value]
+        self._by_value = {}  # id of the exported value -> (value, handle), the value is kept alive with its id
+
+    def export(self, value: str) -> Optional[str]:
+        """Return a handle to a segment holding the value, None when it has to be sent inline."""
+        if len(value) < self.min_size:
+            return None
+        with self._lock:
+            exported = self._by_value.get(id(value))
+            if exported is not None:
+                handle = exported[1]
+                self._segments[handle][1] += 1
+                return handle
+        data = value.encode("utf-8")
+        token = secrets.token_bytes(_TOKEN_SIZE)
+        try:
+            segment = shared_memory.SharedMemory(
+                name=f"{SHM_NAME_PREFIX}{secrets.token_hex(8)}", create=True, size=_TOKEN_SIZE + len(data)
+            )
+        except OSError:
+            # e.g. no /dev/shm in the container, fall back to the inline payload
+            return None
+        segment.buf[:_TOKEN_SIZE] = token
+        segment.buf[_TOKEN_SIZE : _TOKEN_SIZE + len(data)] = data
+        handle = f"{SHM_HANDLE_PREFIX}{segment.name}/{len(data)}/{token.hex()}"
+        with self._lock:
+            self._segments[handle] = [segment, 1, id(value)]
+            self._by_value[id(value)] = (value, handle)
+            _exported_names.add(segment.name)
+        return handle
+
+    def release(self, handle: str) -> None:
+        with self._lock:
+            entry = self._segments.get(handle)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self._segments[handle]
+            if self._by_value.get(entry[2], (None, None))[1] == handle:
+                del self._by_value[entry[2]]
+            _exported_names.discard(entry[0].name)
+        entry[0].close()
+        entry[0].unlink()
+
+    def close(self) -> None:
+        with self._lock:
+            entries = list(self._segments.values())
+            self._segments.clear()
+            self._by_value.clear()
+            _exported_names.difference_update(segment.name for segment, _, _ in entries)
+        for segment, _, _ in entries:
+            segment.close()
+            segment.unlink()
+
+
+class RequestPayloads:
+    """Payloads shared by one request, released together once it completes."""
+
+    def __init__(self, store: SharedPayloadStore):
+        self.store = store
+        self.handles = []
+
+    def share(self, input_data: Dict) -> Dict:
+        """Return the inputs with their large media fields replaced by shared memory handles."""
+        shared = None
+        for field in SHM_FIELDS:
+            value = input_data.get(field)
+            if isinstance(value, str) and not value.startswith(SHM_HANDLE_PREFIX):
+                handle = self.store.export(value)
+                if handle is not None:
+                    self.handles.append(handle)
+                    if shared is None:
+                        shared = dict(input_data)
+                    shared[field] = handle
+        return input_data if shared is None else shared
+
+    def release(self) -> None:
+        for handle in self.handles:
+            self.store.release(handle)
+        self.handles = []
+
+
+def resolve_shared_payload(handle: str) -> str:
+    """Return the payload of a handle exported by a SharedPayloadStore of this host.
+
+    Only the segments named by the stores are opened, and only while they are exported: a handle has to carry the
+    token its store wrote at the start of the segment, so that callers cannot forge handles to other segments.
+    Raises ValueError for any other handle.
+    """
+    match = _HANDLE_PATTERN.match(handle)
+    if match is None:
+        raise ValueError("Invalid shared payload handle")
+    name, size, token = match.group(1), int(match.group(2)), bytes.fromhex(match.group(3))
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        raise ValueError(f"Shared payload {name} is not available on this host")
+    try:
+        if name not in _exported_names:
+            # the segment is owned by the exporting process, it must not be unlinked when this one exits
+            resource_tracker.unregister(segment._name, "shared_memory")
+        if segment.size < _TOKEN_SIZE + size or not hmac.compare_digest(bytes(segment.buf[:_TOKEN_SIZE]), token):
+            raise ValueError(f"Shared payload {name} is not available on this host")
+        # decoded from the segment, without copying its bytes first
+        with segment.buf[_TOKEN_SIZE : _TOKEN_SIZE + size] as payload:
+            return str(payload, "utf-8")
+    finally:
+        segment.close()
+
+
+def resolve_shared_payloads(data: Any) -> Any:
+    """Return the inputs with the handles of their media fields replaced by the payloads, see RequestPayloads."""
+    if not isinstance(data, dict):
+        return data
+    resolved = None
+    for field in SHM_FIELDS:
+        value = data.get(field)
+        if isinstance(value, str) and value.startswith(SHM_HANDLE_PREFIX):
+            if resolved is None:
+                resolved = dict(data)
+            resolved[field] = resolve_shared_payload(value)
+    return data if resolved is None else resolved
+
+
+class SharedPayloadRoute(APIRoute):
+    """Route resolving the shared memory handles of its validated inputs before they reach the handler.
+
+    The route class of the micro services created with shared_memory=True. The request body only carries the handle,
+    it is parsed and validated as is, then the payload read from the segment is handed to the handler without being
+    JSON encoded nor parsed. Requests with an invalid handle are rejected with a 400 error. Handlers reading the raw
+    Request get the handles, they can resolve them with resolve_shared_payloads().
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, _resolving_endpoint(endpoint), **kwargs)
+
+
+def _resolving_endpoint(endpoint):
+    if inspect.iscoroutinefunction(endpoint):
+
+        @functools.wraps(endpoint)
+        async def resolving(*args, **kwargs):
+            args, kwargs = _resolve_arguments(args, kwargs)
+            return await endpoint(*args, **kwargs)
+
+    else:
+
+        @functools.wraps(endpoint)
+        def resolving(*args, **kwargs):
+            args, kwargs = _resolve_arguments(args, kwargs)
+            return endpoint(*args, **kwargs)
+
+    return resolving
+
+
+def _resolve_arguments(args, kwargs):
+    try:
+        return [_resolve_argument(arg) for arg in args], {name: _resolve_argument(arg) for name, arg in kwargs.items()}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _resolve_argument(arg: Any) -> Any:
+    if isinstance(arg, BaseModel):
+        resolved = {}
+        for field in SHM_FIELDS:
+            value = getattr(arg, field, None)
+            if isinstance(value, str) and value.startswith(SHM_HANDLE_PREFIX):
+                resolved[field] = resolve_shared_payload(value)
+        return arg.model_copy(update=resolved) if resolved else arg
+    return resolve_shared_payloads(arg)
@@ -0,0 +1,142 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+_END = object()
+
+
+class StreamBroadcaster:
+    """Multicast one stream to several subscribers, each of them receives it from its start.
+
+    The source is read once into a replay buffer, whether subscribers keep up or not. It is closed early when the last
+    subscriber disconnects.
+    """
+
+    def __init__(self, source: AsyncIterator, on_done: Callable[[], None]):
+        self._source = source
+        self._on_done = on_done
+        self._chunks = []
+        self._queues = set()
+        self._finished = False
+        self._error = None
+        self._pump = asyncio.create_task(self._read_source())
+
+    async def _read_source(self) -> None:
+        try:
+            async for chunk in self._source:
+                self._chunks.append(chunk)
+                for queue in self._queues:
+                    queue.put_nowait(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._finished = True
+            for queue in self._queues:
+                queue.put_nowait(_END)
+            if hasattr(self._source, "aclose"):
+                await self._source.aclose()
+            self._on_done()
+
+    def subscribe(self) -> AsyncIterator:
+        """Return an iterator over the whole stream, the subscriber counts as listening from now on."""
+        queue = asyncio.Queue()
+        for chunk in self._chunks:
+            queue.put_nowait(chunk)
+        if self._finished:
+            queue.put_nowait(_END)
+        else:
+            self._queues.add(queue)
+        return self._iterate(queue)
+
+    async def _iterate(self, queue: asyncio.Queue) -> AsyncIterator:
+        try:
+            while (chunk := await queue.get()) is not _END:
+                yield chunk
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._queues.discard(queue)
+            if not self._queues and not self._finished:
+                # nobody is listening anymore, stop reading the upstream stream
+                self._pump.cancel()
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "streams", "open_streams")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.streams = {}  # node -> StreamBroadcaster of its StreamingResponse
+        self.open_streams = 0
+
+
+class SingleFlight:
+    """Share one run of the graph between identical requests in flight.
+
+    The first request of a key runs the graph, the followers arriving before it completed get the same results. Their
+    StreamingResponses are multicast from the leader's stream, which stays joinable until it ends. The run itself is
+    only cancelled once every request waiting for it was cancelled.
+    """
+
+    def __init__(self, on_follow: Optional[Callable[[], None]] = None):
+        self._on_follow = on_follow or (lambda: None)
+        self._flights = {}  # key -> _Flight
+
+    async def run(self, key: str, schedule: Callable[[], Awaitable[Tuple[Dict, object]]]) -> Tuple[Dict, object]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(schedule()))
+            flight.task.add_done_callback(lambda task: self._on_scheduled(key, flight))
+        else:
+            self._on_follow()
+        flight.waiters += 1
+        try:
+            result_dict, runtime_graph = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        flight.waiters -= 1
+
+        # each request gets its own results, and its own subscription to the streams
+        result_dict = dict(result_dict)
+        for node, broadcaster in flight.streams.items():
+            response = result_dict[node]
+            result_dict[node] = StreamingResponse(
+                broadcaster.subscribe(), status_code=response.status_code, media_type=response.media_type
+            )
+        return result_dict, runtime_graph
+
+    def _on_scheduled(self, key: str, flight: _Flight) -> None:
+        if flight.task.cancelled() or flight.task.exception() is not None:
+            self._forget(key, flight)
+            return
+        result_dict, _ = flight.task.result()
+        # a response may be the result of several nodes, its stream can only be read once
+        broadcasters = {}  # id(response) -> StreamBroadcaster
+        for node, response in result_dict.items():
+            if isinstance(response, StreamingResponse):
+                broadcaster = broadcasters.get(id(response))
+                if broadcaster is None:
+                    flight.open_streams += 1
+                    broadcaster = broadcasters[id(response)] = StreamBroadcaster(
+                        response.body_iterator, lambda: self._on_stream_done(key, flight)
+                    )
+                flight.streams[node] = broadcaster
+        if not flight.streams:
+            self._forget(key, flight)
+
+    def _on_stream_done(self, key: str, flight: _Flight) -> None:
+        flight.open_streams -= 1
+        if flight.open_streams == 0:
+            self._forget(key, flight)
+
+    def _forget(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
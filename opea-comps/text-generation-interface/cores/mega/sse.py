@@ -0,0 +1,84 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import re
+from typing import List, Optional
+
+DONE_EVENT = b"data: [DONE]\n\n"
+DONE_DATA = b"[DONE]"
+
+# tokens re-emitted from the text a downstream node returns: a word with its surrounding whitespace
+TOKEN_PATTERN = re.compile(r"\s?\S+\s?", re.UNICODE)
+
+
+class SSEDecoder:
+    """Incremental decoder of a server-sent event stream.
+
+    Chunks are fed as they are read from the connection, an event split across chunks is only returned once its
+    terminating blank line arrived.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """Return the data of the events completed by the chunk."""
+        if not self._buffer and chunk.endswith(b"\n\n"):
+            # fast path, the chunk holds whole events and nothing is buffered
+            complete = chunk[:-2]
+        else:
+            self._buffer += chunk
+            end = self._buffer.rfind(b"\n\n")
+            if end < 0:
+                return []
+            complete = bytes(memoryview(self._buffer)[:end])
+            del self._buffer[: end + 2]
+        if b"\n\n" not in complete:
+            data = event_data(complete)
+            return [] if data is None else [data]
+        return [data for data in map(event_data, complete.split(b"\n\n")) if data is not None]
+
+    def flush(self) -> List[bytes]:
+        """Return the data of the last event when the stream ended without a blank line."""
+        data = event_data(bytes(self._buffer))
+        self._buffer.clear()
+        return [] if data is None else [data]
+
+
+class SSEEventCounter:
+    """Count the events of a stream that is forwarded as is, without decoding it."""
+
+    def __init__(self):
+        self._pending_newline = False
+
+    def feed(self, chunk: bytes) -> int:
+        count = chunk.count(b"\n\n")
+        # the blank line of an event may be split across two chunks
+        if self._pending_newline and chunk[:1] == b"\n":
+            count += 1
+        self._pending_newline = chunk[-1:] == b"\n" and chunk[-2:] != b"\n\n"
+        return count
+
+
+def event_data(event: bytes) -> Optional[bytes]:
+    """Return the joined `data` fields of an event, None for an event without data, e.g. a comment."""
+    if event.startswith(b"data: ") and b"\n" not in event:
+        # fast path, the events of the micro services are a single data line
+        return event[6:]
+    lines = [line for line in event.replace(b"\r\n", b"\n").split(b"\n") if line.startswith(b"data:")]
+    if not lines:
+        return None
+    return b"\n".join(line[6:] if line[5:6] == b" " else line[5:] for line in lines)
+
+
+def decode_token(data: bytes) -> str:
+    """Return the text of a token event, its data is the repr of the token bytes, e.g. `b'Hello'`."""
+    if data[:2] in (b"b'", b'b"') and data[-1:] in (b"'", b'"'):
+        data = data[2:-1]
+    return data.decode("utf-8")
+
+
+def encode_token(token: str) -> bytes:
+    """Encode a token as an event in the same `data: b'...'` format as the LLM micro services."""
+    return b"data: " + repr(token.replace("\\n", "\n").encode("utf-8")).encode("utf-8") + b"\n\n"
+
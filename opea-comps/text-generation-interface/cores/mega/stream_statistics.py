@@ -0,0 +1,91 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+
+from fastapi.responses import StreamingResponse
+from prometheus_client import Histogram
+
+from .base_statistics import BaseStatistics, statistics_dict
+
+# latencies per model, streamed replies are measured until their end
+request_latency = Histogram(
+    "opea_llm_request_latency",
+    "Whole LLM request latency, to the end of the stream for streamed replies (histogram)",
+    ["model"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+)
+first_token_latency = Histogram(
+    "opea_llm_first_token_latency", "Time to the first token of the streamed replies (histogram)", ["model"]
+)
+inter_token_latency = Histogram(
+    "opea_llm_inter_token_latency",
+    "Mean time between the next tokens of each streamed reply (histogram)",
+    ["model"],
+    buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0),
+)
+output_tokens_per_second = Histogram(
+    "opea_llm_output_tokens_per_second",
+    "Output tokens per second of each streamed reply, over its whole duration (histogram)",
+    ["model"],
+    buckets=(1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500),
+)
+DONE_EVENT = "data: [DONE]"
+
+
+def model_statistics(name: str, model: str) -> BaseStatistics:
+    """Return the statistics of the replies of one model of the service registered as name."""
+    model_name = f"{name}/{model}"
+    if model_name not in statistics_dict:
+        statistics_dict[model_name] = BaseStatistics()
+    return statistics_dict[model_name]
+
+
+def record_latency(name: str, model: str, latency: float):
+    for statistics in (statistics_dict[name], model_statistics(name, model)):
+        statistics.append_latency(latency, None)
+    request_latency.labels(model).observe(latency)
+
+
+def record_stream(name: str, model: str, start: float, first: float, last: float, tokens: int):
+    duration = time.time() - start
+    ttft = first - start if first is not None else None
+    itl = (last - first) / (tokens - 1) if tokens > 1 else None
+    tokens_per_second = tokens / duration if tokens else None
+    for statistics in (statistics_dict[name], model_statistics(name, model)):
+        statistics.append_stream(duration, ttft, itl, tokens_per_second)
+    request_latency.labels(model).observe(duration)
+    if ttft is not None:
+        first_token_latency.labels(model).observe(ttft)
+    if itl is not None:
+        inter_token_latency.labels(model).observe(itl)
+    if tokens_per_second is not None:
+        output_tokens_per_second.labels(model).observe(tokens_per_second)
+
+
+def measure_stream(response: StreamingResponse, name: str, model: str, start: float) -> StreamingResponse:
+    """Record the latencies of a streamed reply once it ended, or the client went away.
+
+    Every event but the final [DONE] counts as a token.
+    """
+    body = response.body_iterator
+
+    async def measured_body():
+        first = last = None
+        tokens = 0
+        try:
+            async for chunk in body:
+                is_done = chunk.startswith(DONE_EVENT if isinstance(chunk, str) else DONE_EVENT.encode())
+                if not is_done:
+                    last = time.time()
+                    if first is None:
+                        first = last
+                    tokens += 1
+                yield chunk
+        finally:
+            record_stream(name, model, start, first, last, tokens)
+            if hasattr(body, "aclose"):
+                await body.aclose()
+
+    response.body_iterator = measured_body()
+    return response
@@ -0,0 +1,94 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import contextvars
+import time
+from typing import Dict, List, Mapping, Optional, Sequence
+
+
+class NodeSpan:
+    """Execution of one node within a request, with the breakdown of the calls made to its micro service."""
+
+    __slots__ = ("node", "start", "end", "queue", "network", "server")
+
+    def __init__(self, node: str):
+        self.node = node
+        self.start = time.time()
+        self.end = None
+        self.queue = 0.0
+        self.network = 0.0
+        # None until a reply reported its processing time
+        self.server = None
+
+    def add_call(self, queue: float, network: float, server: Optional[float]) -> None:
+        self.queue += queue
+        self.network += network
+        if server is not None:
+            self.server = (self.server or 0.0) + server
+
+    def finish(self) -> None:
+        self.end = time.time()
+
+
+# span of the node the running task executes, the node calls report their timings to it
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class RequestWaterfall:
+    """Start and end of every node of a request, for the `/v1/debug/waterfall` endpoint."""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.time()
+        self.end = None
+        self.spans = {}  # node -> NodeSpan
+        self._predecessors = {}
+
+    def begin(self, node: str) -> NodeSpan:
+        span = self.spans[node] = NodeSpan(node)
+        return span
+
+    def finish(self, predecessors: Mapping[str, Sequence[str]]) -> None:
+        self.end = time.time()
+        self._predecessors = predecessors
+
+    def critical_path(self) -> List[str]:
+        """Return the chain of nodes that determined the request latency.
+
+        Starting from the node that ended last, each step goes back to the predecessor that ended last, i.e. the one
+        the node had to wait for.
+        """
+        ended = {node: span.end for node, span in self.spans.items() if span.end is not None}
+        if not ended:
+            return []
+        node = max(ended, key=ended.get)
+        path = [node]
+        while True:
+            preds = [pred for pred in self._predecessors.get(node, ()) if pred in ended]
+            if not preds:
+                return path[::-1]
+            node = max(preds, key=ended.get)
+            path.append(node)
+
+    def to_dict(self) -> Dict:
+        """Times are in seconds, node starts and ends are relative to the start of the request."""
+        end = self.end if self.end is not None else time.time()
+        nodes = []
+        for span in sorted(self.spans.values(), key=lambda span: span.start):
+            nodes.append(
+                {
+                    "node": span.node,
+                    "start": round(span.start - self.start, 6),
+                    "end": None if span.end is None else round(span.end - self.start, 6),
+                    "queue": round(span.queue, 6),
+                    "network": round(span.network, 6),
+                    "server": None if span.server is None else round(span.server, 6),
+                }
+            )
+        return {
+            "request_id": self.request_id,
+            "start": self.start,
+            "duration": round(end - self.start, 6),
+            "nodes": nodes,
+            "critical_path": self.critical_path(),
+        }
@@ -11,10 +11,15 @@ from opentelemetry.context.contextvars_context import ContextVarsRuntimeContext
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter as HTTPSpanExporter
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SimpleSpanProcessor
+
+from .span_store import RingBufferSpanExporter
 
 ENABLE_OPEA_TELEMETRY = os.getenv("ENABLE_OPEA_TELEMETRY", "false").lower() == "true"
+# finished spans kept in memory for the /v1/traces endpoint, 0 to keep none
+SPAN_STORE_CAPACITY = int(os.getenv("TELEMETRY_SPAN_STORE_CAPACITY", 10000))
+# share of the traces kept in memory
+SPAN_STORE_SAMPLE_RATE = float(os.getenv("TELEMETRY_SPAN_STORE_SAMPLE_RATE", 1.0))
 
 
 def detach_ignore_err(self, token: object) -> None:
@@ -38,8 +43,10 @@ resource = Resource.create({SERVICE_NAME: "opea"})
 traceProvider = TracerProvider(resource=resource)
 
 traceProvider.add_span_processor(BatchSpanProcessor(HTTPSpanExporter(endpoint=telemetry_endpoint)))
-in_memory_exporter = InMemorySpanExporter()
-traceProvider.add_span_processor(BatchSpanProcessor(in_memory_exporter))
+in_memory_exporter = RingBufferSpanExporter(SPAN_STORE_CAPACITY, SPAN_STORE_SAMPLE_RATE)
+if SPAN_STORE_CAPACITY > 0:
+    # storing a span is cheaper than queueing it for a batch, and makes it visible right away
+    traceProvider.add_span_processor(SimpleSpanProcessor(in_memory_exporter))
 trace.set_tracer_provider(traceProvider)
 
 tracer = trace.get_tracer(__name__)
@@ -0,0 +1,87 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Sequence
+
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+from opentelemetry.trace import format_span_id, format_trace_id
+
+_TRACE_ID_LOW_BITS = (1 << 64) - 1
+
+
+class RingBufferSpanExporter(SpanExporter):
+    """Keep the last `capacity` finished spans in memory, for the `/v1/traces` endpoint.
+
+    With a `sample_rate` below 1, only that share of the traces is kept, chosen from their trace id so that a trace is
+    either kept with all its spans or not at all.
+    """
+
+    def __init__(self, capacity: int, sample_rate: float = 1.0):
+        self._spans = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        # same sampling as TraceIdRatioBased, on the low 64 bits of the trace id
+        self._threshold = round(max(0.0, min(sample_rate, 1.0)) * (1 << 64))
+        self._stopped = False
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        if self._stopped:
+            return SpanExportResult.FAILURE
+        sampled = [span for span in spans if (span.context.trace_id & _TRACE_ID_LOW_BITS) < self._threshold]
+        if sampled:
+            with self._lock:
+                self._spans.extend(sampled)
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self) -> None:
+        self._stopped = True
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+    def get_finished_spans(self) -> tuple:
+        with self._lock:
+            return tuple(self._spans)
+
+    def query(
+        self,
+        trace_id: Optional[str] = None,
+        name: Optional[str] = None,
+        min_duration_ms: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict]:
+        """Return the most recent spans first, filtered by trace id (hex), span name and minimal duration.
+
+        Raises ValueError for a trace id that is not hexadecimal.
+        """
+        wanted_trace_id = int(trace_id, 16) if trace_id else None
+        results = []
+        for span in reversed(self.get_finished_spans()):
+            if len(results) >= limit:
+                break
+            if wanted_trace_id is not None and span.context.trace_id != wanted_trace_id:
+                continue
+            if name is not None and span.name != name:
+                continue
+            duration_ms = (span.end_time - span.start_time) / 1e6
+            if min_duration_ms is not None and duration_ms < min_duration_ms:
+                continue
+            results.append(
+                {
+                    "trace_id": format_trace_id(span.context.trace_id),
+                    "span_id": format_span_id(span.context.span_id),
+                    "parent_id": format_span_id(span.parent.span_id) if span.parent else None,
+                    "name": span.name,
+                    "start": span.start_time / 1e9,
+                    "duration_ms": round(duration_ms, 3),
+                    "status": span.status.status_code.name,
+                    "attributes": dict(span.attributes or {}),
+                }
+            )
+        return results
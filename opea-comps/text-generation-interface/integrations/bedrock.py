@@ -61,6 +61,10 @@ class OpeaTextGenBedrock(OpeaComponent):
             logger.error("OpeaTextGenBedrock health check failed")
             return False
 
+    def model_name(self, input: ChatCompletionRequest) -> str:
+        """Return the model generating the output of the input."""
+        return input.model if input.model else self.default_model
+
     async def invoke(self, input: ChatCompletionRequest):
         """Invokes the AWS Bedrock service to generate a response based on the
         previous chats.
@@ -3,7 +3,7 @@
 
 import asyncio
 import os
-from typing import Union
+from typing import Hashable, List, Optional, Tuple, Union
 
 from fastapi.responses import StreamingResponse
 from langchain_core.prompts import PromptTemplate
@@ -176,6 +176,88 @@ class OpeaTextGenService(OpeaComponent):
 
             return prompt, input
 
+    def model_name(self, input: Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]) -> str:
+        """Return the model generating the output of the input, the served one whatever the input asks."""
+        return MODEL_NAME
+
+    def _prompt_template(self, input: Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]):
+        prompt_template = None
+        input_variables = None
+        if not isinstance(input, SearchedDoc) and input.chat_template:
+            prompt_template = PromptTemplate.from_template(input.chat_template)
+            input_variables = prompt_template.input_variables
+        return prompt_template, input_variables
+
+    def batch_input(
+        self, input: Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]
+    ) -> Optional[Tuple[Hashable, str, ChatCompletionRequest]]:
+        """Align the input for a batched `completions` call, return its batch key with the prompt and the aligned
+        input, None when it needs a call of its own (chat messages or stream).
+
+        Inputs share a call when they are generated with the same model, sampling parameters and user, i.e. have the
+        same key. The prompt and the aligned input are passed on to invoke_batch(), which does not align them again.
+        """
+        if isinstance(input, ChatCompletionRequest) and not isinstance(input.messages, str):
+            return None
+        prompt, input = self.align_input(input, *self._prompt_template(input))
+        if input.stream:
+            return None
+        stop = tuple(input.stop) if isinstance(input.stop, list) else input.stop
+        key = (
+            MODEL_NAME,
+            input.temperature,
+            input.max_tokens,
+            stop,
+            input.top_p,
+            input.frequency_penalty,
+            input.presence_penalty,
+            input.seed,
+            input.n,
+            input.echo,
+            input.suffix,
+            input.user,
+        )
+        return key, prompt, input
+
+    async def invoke_batch(self, inputs: List[Tuple[str, ChatCompletionRequest]]) -> list:
+        """Generate the outputs of the (prompt, aligned input) pairs given by batch_input() with the same key, with
+        one `completions` call.
+
+        Each input gets a completion of its own choices, without usage since the backend only reports it for the
+        whole call.
+        """
+        prompts = [prompt for prompt, _ in inputs]
+        input = inputs[-1][1]
+        # the inputs share their parameters, take them from the last one
+        completion = await self.client.completions.create(
+            model=MODEL_NAME,
+            prompt=prompts,
+            echo=input.echo,
+            frequency_penalty=input.frequency_penalty,
+            max_tokens=input.max_tokens,
+            n=input.n,
+            presence_penalty=input.presence_penalty,
+            seed=input.seed,
+            stop=input.stop,
+            suffix=input.suffix,
+            temperature=input.temperature,
+            top_p=input.top_p,
+            user=input.user,
+        )
+        if logflag:
+            logger.info(completion)
+        n = input.n or 1
+        if len(completion.choices) != n * len(prompts):
+            raise ValueError(f"{len(completion.choices)} choices returned for {len(prompts)} prompts and n={n}")
+        # the choices of the i-th prompt have the indexes i * n to i * n + n - 1
+        choices = [[] for _ in prompts]
+        for choice in completion.choices:
+            choices[choice.index // n].append(choice.model_copy(update={"index": choice.index % n}))
+        return [
+            completion.model_copy(update={"choices": sorted(c, key=lambda choice: choice.index), "usage": None})
+            for c in choices
+        ]
+
     async def invoke(self, input: Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]):
         """Invokes the TGI/vLLM LLM service to generate output for the provided input.
 
@@ -183,11 +265,7 @@ class OpeaTextGenService(OpeaComponent):
             input (Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]): The input text(s).
         """
 
-        prompt_template = None
-        input_variables = None
-        if not isinstance(input, SearchedDoc) and input.chat_template:
-            prompt_template = PromptTemplate.from_template(input.chat_template)
-            input_variables = prompt_template.input_variables
+        prompt_template, input_variables = self._prompt_template(input)
 
         if isinstance(input, ChatCompletionRequest) and not isinstance(input.messages, str):
             if logflag:
@@ -1,10 +1,13 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
 import os
 import time
+from collections import defaultdict
 from typing import Union
 
+from fastapi.responses import StreamingResponse
 
 from cores.mega.logger import CustomLogger
 from cores.common.component import OpeaComponent, OpeaComponentRegistry, OpeaComponentLoader
@@ -25,8 +28,8 @@ from cores.telemetry.opea_telemetry import opea_telemetry
 
 from cores.mega.base_statistics import (
     register_statistics,
-    statistics_dict,
 )
+from cores.mega.stream_statistics import measure_stream, record_latency
 
 from cores.proto.api_protocol import ChatCompletionRequest
 from cores.telemetry.opea_telemetry import opea_telemetry
@@ -35,6 +38,10 @@ logger = CustomLogger("llm")
 logflag = os.getenv("LOGFLAG", False)
 
 llm_component_name = os.getenv("LLM_COMPONENT_NAME", "OpeaTextGenService")
+# batch concurrent non-streaming requests with the same sampling parameters into one backend call
+llm_dynamic_batching = os.getenv("LLM_DYNAMIC_BATCHING", "false").lower() in ("true", "1", "yes")
+llm_dynamic_batching_timeout = float(os.getenv("LLM_DYNAMIC_BATCHING_TIMEOUT", 0.01))
+llm_dynamic_batching_max_batch_size = int(os.getenv("LLM_DYNAMIC_BATCHING_MAX_BATCH_SIZE", 32))
 if logflag:
     logger.info(f"Get llm_component_name {llm_component_name}")
 
@@ -50,12 +57,21 @@ else:
 loader = OpeaComponentLoader(llm_component_name, description=f"OPEA LLM Component: {llm_component_name}")
 
 
+def model_name(input: Union[LLMParamsDoc, ChatCompletionRequest, SearchedDoc]) -> str:
+    if hasattr(loader.component, "model_name"):
+        return loader.component.model_name(input)
+    return getattr(input, "model", None) or os.getenv("LLM_MODEL_ID") or "unknown"
+
+
 @register_microservice(
     name="opea_service@llm",
     service_type=ServiceType.LLM,
     endpoint="/v1/chat/completions",
     host="0.0.0.0",
     port=9000,
+    dynamic_batching=llm_dynamic_batching,
+    dynamic_batching_timeout=llm_dynamic_batching_timeout,
+    dynamic_batching_max_batch_size=llm_dynamic_batching_max_batch_size,
 )
 @opea_telemetry
 @register_statistics(names=["opea_service@llm"])
@@ -67,10 +83,25 @@ async def llm_generate(input: Union[LLMParamsDoc, ChatCompletionRequest, Searche
         logger.info(input)
 
     try:
-        # Use the loader to invoke the component
-        response = await loader.invoke(input)
+        model = model_name(input)
+        batch_input = None
+        if llm_dynamic_batching and hasattr(loader.component, "invoke_batch"):
+            # (batch key, prompt, aligned input), the input is aligned once for the key and the batched call
+            batch_input = loader.component.batch_input(input)
+        if batch_input is None:
+            # Use the loader to invoke the component
+            response = await loader.invoke(input)
+        else:
+            response = await opea_microservices["opea_service@llm"].dynamic_batching_request(
+                ServiceType.LLM, batch_input
+            )
+            if isinstance(response, Exception):
+                raise response
+        if isinstance(response, StreamingResponse):
+            # measured when the stream ends
+            return measure_stream(response, "opea_service@llm", model, start)
         # Record statistics
-        statistics_dict["opea_service@llm"].append_latency(time.time() - start, None)
+        record_latency("opea_service@llm", model, time.time() - start)
         return response
 
     except Exception as e:
@@ -78,6 +109,33 @@ async def llm_generate(input: Union[LLMParamsDoc, ChatCompletionRequest, Searche
         raise
 
 
+async def llm_generate_batch(service_type: ServiceType, batch: list[dict]) -> list:
+    """Generate a dynamic batch of LLM requests, with one backend call per batch key.
+
+    A call that failed gives its exception as the result of each of its requests.
+    """
+    groups = defaultdict(list)
+    for i, req in enumerate(batch):
+        batch_key = req["request"][0]
+        groups[batch_key].append(i)
+    results = [None] * len(batch)
+
+    async def generate(indexes):
+        try:
+            responses = await loader.component.invoke_batch([batch[i]["request"][1:] for i in indexes])
+        except Exception as e:
+            responses = [e] * len(indexes)
+        for i, response in zip(indexes, responses):
+            results[i] = response
+
+    await asyncio.gather(*(generate(indexes) for indexes in groups.values()))
+    return results
+
+
+if llm_dynamic_batching:
+    opea_microservices["opea_service@llm"].dynamic_batching_infer = llm_generate_batch
+
+
 if __name__ == "__main__":
     logger.info("OPEA LLM Microservice is starting...")
     opea_microservices["opea_service@llm"].start()
\ No newline at end of file
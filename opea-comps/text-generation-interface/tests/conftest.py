@@ -0,0 +1,96 @@
+"""Fixtures shared by the tests: free local ports, fake micro services served by aiohttp, remote nodes, and calls
+to an ASGI app without a server."""
+
+import contextlib
+import json
+import socket
+
+import pytest
+from aiohttp import web
+
+from cores.mega.micro_service import MicroService
+
+
+@pytest.fixture
+def free_port():
+    """Return a function giving a local port nothing listens on."""
+
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    return free_port
+
+
+@pytest.fixture
+def serve():
+    """Return an async context manager serving aiohttp handlers, given as {path: handler}, on a free local port.
+
+    It gives the port, and stops the server on exit. It must be entered in the event loop the test runs.
+    """
+
+    @contextlib.asynccontextmanager
+    async def serve(routes):
+        app = web.Application(client_max_size=1024**3)
+        for path, handler in routes.items():
+            app.router.add_post(path, handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            yield runner.addresses[0][1]
+        finally:
+            await runner.cleanup()
+
+    return serve
+
+
+@pytest.fixture
+def remote_service():
+    """Return a function creating the MicroService of a remote endpoint on localhost."""
+
+    def remote_service(name, port, endpoint, service_type, **kwargs):
+        return MicroService(
+            name,
+            host="127.0.0.1",
+            port=port,
+            endpoint=endpoint,
+            use_remote_service=True,
+            service_type=service_type,
+            **kwargs,
+        )
+
+    return remote_service
+
+
+@pytest.fixture
+def asgi_get():
+    """Return a coroutine function calling GET `path` of an ASGI app in process, giving the status and JSON reply."""
+
+    async def asgi_get(app, path, query_string=b""):
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "GET",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "scheme": "http",
+            "query_string": query_string,
+            "headers": [],
+            "client": ("127.0.0.1", 1),
+            "server": ("127.0.0.1", 80),
+        }
+        await app(scope, receive, send)
+        return sent[0]["status"], json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+
+    return asgi_get
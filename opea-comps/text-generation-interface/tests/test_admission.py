@@ -0,0 +1,111 @@
+import asyncio
+import gc
+
+import pytest
+from aiohttp import web
+from fastapi import HTTPException
+
+from cores.mega.admission import ConcurrencyLimiter
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.proto.docarray import LLMParams
+
+
+def test_limiter_queues_then_rejects():
+    async def run():
+        limiter = ConcurrencyLimiter("node", max_concurrency=1, max_queue=1)
+        depths = []
+        limiter.on_waiting = depths.append
+        assert await limiter.acquire(1) == 0.0
+        waiter = asyncio.create_task(limiter.acquire(1))
+        await asyncio.sleep(0)
+        assert limiter.waiting == 1
+        with pytest.raises(HTTPException) as rejected:
+            await limiter.acquire(1)
+        assert rejected.value.status_code == 429
+        limiter.release()
+        assert await waiter >= 0
+        with pytest.raises(asyncio.TimeoutError):
+            await limiter.acquire(0.01)
+        assert limiter.waiting == 0
+        assert depths == [1, 0, 1, 0]
+
+    asyncio.run(run())
+
+
+async def _generate(request):
+    await request.json()
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in ("Hello", " world."):
+        await response.write(f"data: b'{token}'\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def _fail(request):
+    await request.json()
+    return web.json_response({"detail": "model not loaded"}, status=500)
+
+
+LLM_ROUTES = {"/v1/chat/completions": _generate, "/v1/fail": _fail}
+
+
+def _llm_orchestrator(remote_service, port, endpoint):
+    orchestrator = ServiceOrchestrator()
+    llm = remote_service("llm", port, endpoint, ServiceType.LLM)
+    orchestrator.add(llm, max_concurrency=1, max_queue=0)
+    return orchestrator, llm.name
+
+
+def _assert_released(orchestrator, node):
+    assert orchestrator.metrics.pending == 0
+    assert not orchestrator._limiters[node]._semaphore.locked()
+    assert all(replica.outstanding == 0 for replica in orchestrator._replicas[node].replicas)
+
+
+def test_streams_release_the_request_however_they_end(serve, remote_service):
+    async def run():
+        async with serve(LLM_ROUTES) as port:
+            orchestrator, node = _llm_orchestrator(remote_service, port, "/v1/chat/completions")
+            stream = LLMParams(stream=True)
+            try:
+                # consumed to its end
+                result_dict, _ = await orchestrator.schedule({"text": "hi"}, llm_parameters=stream)
+                chunks = [chunk async for chunk in result_dict[node].body_iterator]
+                assert b"".join(chunks).endswith(b"data: [DONE]\n\n")
+                _assert_released(orchestrator, node)
+
+                # closed by a client that disconnected after the first chunk
+                result_dict, _ = await orchestrator.schedule({"text": "hi"}, llm_parameters=stream)
+                body = result_dict[node].body_iterator
+                await body.__anext__()
+                await body.aclose()
+                _assert_released(orchestrator, node)
+
+                # never read
+                result_dict, _ = await orchestrator.schedule({"text": "hi"}, llm_parameters=stream)
+                assert orchestrator.metrics.pending == 1
+                del result_dict
+                gc.collect()
+                _assert_released(orchestrator, node)
+            finally:
+                await orchestrator.close()
+
+    asyncio.run(run())
+
+
+def test_failed_stream_is_an_error(serve, remote_service):
+    async def run():
+        async with serve(LLM_ROUTES) as port:
+            orchestrator, node = _llm_orchestrator(remote_service, port, "/v1/fail")
+            try:
+                with pytest.raises(HTTPException) as error:
+                    await orchestrator.schedule({"text": "hi"}, llm_parameters=LLMParams(stream=True))
+                assert error.value.status_code == 500
+                assert "model not loaded" in error.value.detail
+                _assert_released(orchestrator, node)
+            finally:
+                await orchestrator.close()
+
+    asyncio.run(run())
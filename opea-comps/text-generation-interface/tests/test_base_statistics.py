@@ -0,0 +1,96 @@
+import json
+import random
+
+import pytest
+
+from cores.mega import base_statistics
+from cores.mega.base_statistics import (
+    STATISTICS_RELATIVE_ACCURACY,
+    WINDOW_SLOT_SECONDS,
+    BaseStatistics,
+    LatencySketch,
+    collect_all_statistics,
+    dump_statistics,
+)
+
+
+def _latencies(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(-3, 1.5) for _ in range(count)]
+
+
+def _sketch(values):
+    sketch = LatencySketch()
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+@pytest.mark.parametrize("q", [0.0, 0.5, 0.9, 0.99, 1.0])
+def test_quantiles_are_within_the_relative_accuracy(q):
+    values = _latencies(20000)
+    exact = sorted(values)[int(q * (len(values) - 1))]
+    assert abs(_sketch(values).quantile(q) - exact) <= STATISTICS_RELATIVE_ACCURACY * exact * 1.0001
+
+
+def test_count_average_and_zeros_are_exact():
+    values = [0.0, 0.0, 0.5, 1.5]
+    sketch = _sketch(values)
+    assert (sketch.count, sketch.zeros, sketch.average()) == (4, 2, 0.5)
+    assert sketch.quantile(0.25) == 0.0
+    assert LatencySketch().quantile(0.5) is None and LatencySketch().average() is None
+
+
+def test_memory_does_not_grow_with_the_count():
+    sketch = LatencySketch()
+    rng = random.Random(0)
+    for _ in range(100000):
+        # from a microsecond to an hour
+        sketch.add(10 ** rng.uniform(-6, 3.56))
+    assert len(sketch.buckets) <= 1200
+
+
+def test_merged_sketches_equal_one_sketch():
+    values = _latencies(3000)
+    merged = LatencySketch()
+    for part in (values[:1000], values[1000:2500], values[2500:]):
+        # through JSON, as between worker processes
+        merged.merge(LatencySketch.from_dict(json.loads(json.dumps(_sketch(part).to_dict()))))
+    whole = _sketch(values)
+    assert merged.buckets == whole.buckets and merged.count == whole.count
+    assert merged.total == pytest.approx(whole.total)
+
+
+def test_windows_slide(monkeypatch):
+    now = [1000 * WINDOW_SLOT_SECONDS]
+    monkeypatch.setattr(base_statistics.time, "time", lambda: now[0])
+    statistics = BaseStatistics()
+    statistics.append_latency(2.0)
+    now[0] += 2 * 60
+    statistics.append_stream(1.0, first_token_latency=0.1, inter_token_latency=0.01, tokens_per_second=100)
+    windows = statistics.calculate_window_statistics()
+    assert windows["1m"]["average_latency"] == 1.0
+    assert windows["1m"]["p50_tokens_per_second"] == pytest.approx(100, rel=0.01)
+    assert windows["5m"]["average_latency"] == 1.5
+    # the whole history is kept
+    assert statistics.calculate_statistics()["average_latency"] == 1.5
+    now[0] += 2 * 3600
+    assert statistics.calculate_window_statistics()["1h"]["average_latency"] is None
+    assert statistics.calculate_statistics()["average_latency"] == 1.5
+
+
+def test_statistics_of_workers_are_merged(tmp_path, monkeypatch):
+    worker, own = BaseStatistics(), BaseStatistics()
+    worker.append_latency(1.0)
+    own.append_latency(3.0)
+    # the snapshot of another worker process
+    monkeypatch.setattr(base_statistics, "statistics_dict", {"opea_service@test": worker})
+    dump_statistics(str(tmp_path / "1.json"))
+    monkeypatch.setattr(base_statistics, "statistics_dict", {"opea_service@test": own})
+
+    merged = collect_all_statistics(str(tmp_path))["opea_service@test"]
+    assert merged["average_latency"] == 2.0
+    assert merged["windows"]["1m"]["average_latency"] == 2.0
+    # the statistics of this process are left as they are
+    assert collect_all_statistics()["opea_service@test"]["average_latency"] == 3.0
+    assert own.response_times.count == 1
@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from cores.mega.batching import NodeBatcher
+from cores.mega.constants import ServiceType
+from cores.mega.micro_service import MicroService
+from cores.mega.orchestrator import ServiceOrchestrator
+
+
+def _node_batcher(window=0.05, max_batch_size=8, fail=False):
+    batches = []
+
+    async def send(payloads, deadline):
+        batches.append((payloads, deadline))
+        if fail:
+            raise RuntimeError("backend down")
+        return [payload["input"].upper() for payload in payloads]
+
+    return NodeBatcher("input", window, max_batch_size, send), batches
+
+
+def test_compatible_calls_are_merged():
+    async def run():
+        batcher, batches = _node_batcher()
+        results = await asyncio.gather(
+            batcher.submit({"input": "a", "model": "m"}, deadline=30),
+            batcher.submit({"input": "b", "model": "m"}, deadline=10),
+            batcher.submit({"input": "c", "model": "other"}, deadline=20),
+        )
+        return results, batches
+
+    results, batches = asyncio.run(run())
+    assert results == ["A", "B", "C"]
+    # one batch per compatible group, sent with the earliest deadline of its calls
+    assert sorted((len(payloads), deadline) for payloads, deadline in batches) == [(1, 20), (2, 10)]
+
+
+def test_calls_differing_by_per_request_fields_are_merged():
+    async def run():
+        batcher, batches = _node_batcher()
+        results = await asyncio.gather(
+            batcher.submit({"input": "a", "id": "1", "docs": [{"text": "t", "id": "x"}]}, deadline=1),
+            batcher.submit({"input": "b", "id": "2", "docs": [{"text": "t", "id": "y"}]}, deadline=1),
+            batcher.submit({"input": "c", "id": "3", "docs": [{"text": "u", "id": "z"}]}, deadline=1),
+        )
+        return results, batches
+
+    results, batches = asyncio.run(run())
+    assert results == ["A", "B", "C"]
+    assert sorted(len(payloads) for payloads, _ in batches) == [1, 2]
+    # the payload of the batched call carries none of the ids of the calls it merged
+    orchestrator = ServiceOrchestrator()
+    payloads = next(payloads for payloads, _ in batches if len(payloads) == 2)
+    assert orchestrator.batch_inputs("embedding", "input", payloads) == {
+        "input": ["a", "b"],
+        "docs": [{"text": "t"}],
+    }
+
+
+def test_full_batches_are_sent_without_waiting():
+    async def run():
+        batcher, batches = _node_batcher(window=10, max_batch_size=2)
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.submit({"input": "a"}, 1), batcher.submit({"input": "b"}, 1)), timeout=1
+        )
+        return results, batches
+
+    results, batches = asyncio.run(run())
+    assert results == ["A", "B"] and len(batches) == 1
+
+
+def test_batch_errors_reach_every_call():
+    async def run():
+        batcher, _ = _node_batcher(fail=True)
+        return await asyncio.gather(
+            batcher.submit({"input": "a"}, 1), batcher.submit({"input": "b"}, 1), return_exceptions=True
+        )
+
+    assert [str(result) for result in asyncio.run(run())] == ["backend down"] * 2
+
+
+def test_only_single_inputs_are_batched():
+    batcher, _ = _node_batcher()
+    assert batcher.accepts({"input": "a"})
+    assert not batcher.accepts({"input": ["a", "b"]})
+    assert not batcher.accepts({"text": "a"})
+
+
+def test_orchestrator_batches_concurrent_requests(serve, remote_service):
+    async def run():
+        calls = []
+
+        async def embed(request):
+            body = await request.json()
+            calls.append(body["input"])
+            data = [{"index": i, "embedding": [float(len(text))]} for i, text in enumerate(body["input"])]
+            return web.json_response({"data": data, "model": body["model"]})
+
+        async with serve({"/v1/embeddings": embed}) as port:
+            orchestrator = ServiceOrchestrator()
+            embedding = remote_service("embedding", port, "/v1/embeddings", ServiceType.EMBEDDING)
+            orchestrator.add(embedding, batch_key="input", batch_window=0.05)
+            try:
+                results = await orchestrator.schedule_many(
+                    [{"input": text, "model": "m"} for text in ("a", "bb", "ccc")]
+                )
+            finally:
+                await orchestrator.close()
+        return calls, [result_dict[embedding.name] for result_dict, _ in results]
+
+    calls, outputs = asyncio.run(run())
+    assert calls == [["a", "bb", "ccc"]]
+    assert outputs == [{"data": [{"index": 0, "embedding": [float(n)]}], "model": "m"} for n in (1, 2, 3)]
+
+
+@pytest.mark.parametrize("max_batch_size, sizes", [(2, [2, 2, 1]), (8, [5])])
+def test_micro_service_dynamic_batching(free_port, max_batch_size, sizes):
+    service = MicroService(
+        "batched",
+        host="127.0.0.1",
+        port=free_port(),
+        endpoint="/v1/batched",
+        service_type=ServiceType.EMBEDDING,
+        dynamic_batching=True,
+        dynamic_batching_timeout=0.05,
+        dynamic_batching_max_batch_size=max_batch_size,
+    )
+    batches = []
+
+    async def infer(service_type, batch):
+        batches.append(len(batch))
+        return [req["request"] * 2 for req in batch]
+
+    service.dynamic_batching_infer = infer
+
+    async def run():
+        requests = (service.dynamic_batching_request(ServiceType.EMBEDDING, i) for i in range(5))
+        return await asyncio.wait_for(asyncio.gather(*requests), 1)
+
+    # the batch processor is a startup event, it runs on the loop of the service
+    try:
+        assert service.event_loop.run_until_complete(run()) == [0, 2, 4, 6, 8]
+    finally:
+        service.event_loop.run_until_complete(service.terminate_server())
+    assert batches == sizes
@@ -0,0 +1,123 @@
+import pytest
+
+from cores.mega.dag import DAG
+from cores.mega.execution_plan import ExecutionPlan, RuntimeGraph
+
+GRAPH = {"a": ["b", "c"], "b": ["d"], "c": ["d"], "d": [], "e": ["d"]}
+
+
+def _dag():
+    dag = DAG()
+    dag.from_dict(GRAPH)
+    return dag
+
+
+def _views(dag):
+    return {
+        "graph": {node: set(successors) for node, successors in dag.graph.items()},
+        "size": dag.size(),
+        "validate": dag.validate(),
+        "order": dag.topological_sort(),
+        "levels": dag.levels(),
+        "ind_nodes": dag.ind_nodes(),
+        "leaves": dag.all_leaves(),
+        "downstream": {node: sorted(dag.downstream(node)) for node in dag.graph},
+        "all_downstreams": {node: dag.all_downstreams(node) for node in dag.graph},
+        "predecessors": {node: dag.predecessors(node) for node in dag.graph},
+    }
+
+
+def test_compile():
+    plan = ExecutionPlan.compile(_dag())
+    assert plan.nodes == ("a", "b", "c", "d", "e")
+    assert plan.ind_nodes == ("a", "e") and plan.leaves == ("d",)
+    assert plan.predecessors["d"] == ("b", "c", "e")
+    assert [set(level) for level in plan.levels] == [{"a", "e"}, {"b", "c"}, {"d"}]
+
+
+def _delete_node(dag):
+    dag.delete_node("b")
+    dag.delete_node_if_exists("b")
+
+
+def _add_nodes(dag):
+    dag.add_node("f")
+    dag.add_node_if_not_exists("f")
+    dag.add_node("g")
+    dag.add_edge("d", "g")
+    # against the current order
+    dag.add_edge("f", "a")
+
+
+def _delete_edge(dag):
+    dag.delete_edge("a", "c")
+    if isinstance(dag, RuntimeGraph):
+        dag.prune(["a"])
+    else:
+        dag.delete_node("c")
+        dag.delete_node("e")
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda dag: None,
+        _delete_node,
+        _add_nodes,
+        _delete_edge,
+        lambda dag: dag.from_dict({"x": ["y"], "y": []}),
+        lambda dag: dag.add_edges([("e", "b"), ("c", "b")]),
+        lambda dag: setattr(dag, "graph", {"x": {"y"}, "y": set()}),
+    ],
+)
+def test_runtime_graph_behaves_like_a_dag(change):
+    plan = ExecutionPlan.compile(_dag())
+    expected, runtime_graph = _dag(), RuntimeGraph(plan)
+    # reading the plan first must not get in the way of changing the graph afterwards
+    assert _views(runtime_graph) == _views(expected)
+    change(expected)
+    change(runtime_graph)
+    assert _views(runtime_graph) == _views(expected)
+    # the plan is shared by every request and stays untouched
+    assert _views(RuntimeGraph(plan)) == _views(_dag())
+
+
+def test_add_edges_sorts_once():
+    edges = [(node, successor) for node, successors in GRAPH.items() for successor in successors]
+    dag, expected = DAG(), DAG()
+    # every edge goes against the order the nodes were added in
+    for node in "edcba":
+        dag.add_node(node)
+        expected.add_node(node)
+    dag.add_edges(edges)
+    for ind_node, dep_node in edges:
+        expected.add_edge(ind_node, dep_node)
+    views = {name: view for name, view in _views(dag).items() if name not in ("order", "levels", "all_downstreams")}
+    assert views == {name: _views(expected)[name] for name in views}
+    order = dag.topological_sort()
+    assert all(order.index(node) < order.index(successor) for node, successor in edges)
+    # nodes that do not depend on each other keep the order they were added in
+    assert order == ["e", "a", "c", "b", "d"]
+    with pytest.raises(Exception, match="validation error"):
+        dag.add_edges([("e", "a"), ("d", "e")])
+    with pytest.raises(KeyError):
+        dag.add_edges([("e", "a"), ("e", "z")])
+    assert dag.topological_sort() == order and dag.predecessors("a") == []
+
+
+def test_runtime_graph_errors():
+    runtime_graph = RuntimeGraph(ExecutionPlan.compile(_dag()))
+    with pytest.raises(KeyError):
+        runtime_graph.downstream("z")
+    with pytest.raises(KeyError):
+        runtime_graph.delete_edge("a", "d")
+    with pytest.raises(Exception, match="validation error"):
+        runtime_graph.add_edge("d", "a")
+    with pytest.raises(KeyError):
+        runtime_graph.add_node("a")
+    with pytest.raises(KeyError):
+        runtime_graph.delete_node("z")
+    with pytest.raises(AttributeError):
+        runtime_graph.request_id
+    runtime_graph.reset_graph()
+    assert runtime_graph.size() == 0 and not runtime_graph.validate()
@@ -0,0 +1,61 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI, HTTPException
+
+from cores.mega.grpc_service import GrpcClient, GrpcServer, stream_chunks
+from cores.proto.docarray import TextDoc
+
+pytest.importorskip("grpc")
+
+
+def _app():
+    app = FastAPI()
+
+    @app.post("/v1/upper")
+    async def upper(doc: TextDoc) -> TextDoc:
+        if doc.text == "teapot":
+            raise HTTPException(status_code=418, detail="teapot")
+        return TextDoc(text=doc.text.upper())
+
+    return app
+
+
+def test_calls_and_errors(free_port):
+    async def run():
+        port = free_port()
+        server = GrpcServer(_app(), "127.0.0.1", port)
+        serving = asyncio.create_task(server.serve())
+        await asyncio.sleep(0.5)
+        client = GrpcClient(limit_per_target=4)
+        target = f"127.0.0.1:{port}"
+        try:
+            status, content_type, body = await client.invoke(target, "/v1/upper", {"text": "hi"}, 5, ())
+            assert (status, content_type, json.loads(body)["text"]) == (200, "application/json", "HI")
+
+            # handler errors keep their HTTP status
+            status, _, body = await client.invoke(target, "/v1/upper", {"text": "teapot"}, 5, ())
+            assert (status, json.loads(body)) == (418, {"detail": "teapot"})
+
+            # gRPC errors are raised as the HTTP errors of the same meaning
+            with pytest.raises(HTTPException) as error:
+                await client.invoke(target, "/v1/missing", {"text": "hi"}, 5, ())
+            assert error.value.status_code == 501
+
+            status, _, call = await client.invoke_stream(target, "/v1/upper", {"text": "hi"}, 5, ())
+            assert json.loads(b"".join([chunk async for chunk in stream_chunks(call)]))["text"] == "HI"
+        finally:
+            await client.close()
+            await server.stop()
+            serving.cancel()
+
+        client = GrpcClient(limit_per_target=4)
+        try:
+            with pytest.raises(HTTPException) as error:
+                await client.invoke(target, "/v1/upper", {"text": "hi"}, 5, ())
+            assert error.value.status_code == 503
+        finally:
+            await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cores.mega.http_service import HTTPService
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the multiprocess mode of prometheus_client is chosen when it is imported, run it in a process of its own
+MULTIPROCESS_METRICS = """
+import asyncio
+
+import aiohttp
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+from cores.mega.admission import ConcurrencyLimiter
+from cores.mega.orchestrator import OrchestratorMetrics
+
+
+async def run():
+    metrics = OrchestratorMetrics()
+    metrics.admission_create()
+    limiter = ConcurrencyLimiter("node", max_concurrency=1, max_queue=4)
+    metrics.queue_depth_watch("node", limiter)
+    await limiter.acquire(1)
+    waiter = asyncio.create_task(limiter.acquire(1))
+    await asyncio.sleep(0)
+    metrics.pool_update(aiohttp.TCPConnector(limit=7))
+    metrics.pending_update(True)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    print(generate_latest(registry).decode())
+    waiter.cancel()
+
+
+asyncio.run(run())
+"""
+
+# the master of several workers never sets up a server of its own, stop() terminates the workers instead
+STOP_WORKERS = """
+import threading
+
+from cores.mega.http_service import HTTPService
+
+runtime_args = {"protocol": "http", "host": "127.0.0.1", "port": 0, "title": "test", "description": "test"}
+service = HTTPService(runtime_args=runtime_args, workers=2)
+service._async_setup()
+threading.Timer(2, service.stop).start()
+service.start()
+print(service.server, service._stop_workers)
+"""
+
+
+def _service(workers):
+    runtime_args = {"protocol": "http", "host": "127.0.0.1", "port": 0, "title": "test", "description": "test"}
+    return HTTPService(runtime_args=runtime_args, workers=workers)
+
+
+def test_workers_require_multiprocess_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        pytest.skip("the tests run in multiprocess mode")
+    with pytest.raises(RuntimeError, match="PROMETHEUS_MULTIPROC_DIR"):
+        _service(2)._serve_workers()
+
+
+def test_gauges_are_aggregated_across_processes(tmp_path):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path), PYTHONPATH=ROOT)
+    output = subprocess.run(
+        [sys.executable, "-c", MULTIPROCESS_METRICS], env=env, capture_output=True, text=True, timeout=60, check=True
+    ).stdout
+    samples = dict(line.rsplit(" ", 1) for line in output.splitlines() if line and not line.startswith("#"))
+    assert float(samples['megaservice_node_queue_depth{node="node"}']) == 1
+    assert float(samples["megaservice_pool_connections_limit"]) == 7
+    assert float(samples["megaservice_pool_connections_active"]) == 0
+    assert float(samples["megaservice_request_pending"]) == 1
+
+
+def test_stop_terminates_the_workers(tmp_path):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path), PYTHONPATH=ROOT)
+    output = subprocess.run(
+        [sys.executable, "-c", STOP_WORKERS], env=env, capture_output=True, text=True, timeout=60, check=True
+    ).stdout
+    assert output.split() == ["None", "None"]
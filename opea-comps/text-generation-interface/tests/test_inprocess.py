@@ -0,0 +1,63 @@
+import asyncio
+
+from aiohttp import web
+
+from cores.mega import orchestrator as orchestrator_module
+from cores.mega.constants import ServiceType
+from cores.mega.inprocess import find_local_handler
+from cores.mega.micro_service import opea_microservices, register_microservice
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.proto.docarray import EmbedDoc, TextDoc
+
+
+def test_co_located_services_are_called_in_process(serve, remote_service, free_port, monkeypatch):
+    calls = []
+
+    # nothing serves the port of the co-located micro service, only an in-process call can reach it
+    @register_microservice(
+        name="opea_service@test_inprocess",
+        service_type=ServiceType.EMBEDDING,
+        host="127.0.0.1",
+        port=free_port(),
+        endpoint="/v1/embeddings",
+        input_datatype=TextDoc,
+        output_datatype=EmbedDoc,
+    )
+    async def embed(input: TextDoc) -> EmbedDoc:
+        calls.append(input)
+        return EmbedDoc(text=input.text, embedding=[0.5, 0.5])
+
+    local = opea_microservices["opea_service@test_inprocess"]
+
+    async def run():
+        http_calls = []
+
+        async def retrieve(request):
+            http_calls.append(await request.json())
+            return web.json_response({"text": "retrieved"})
+
+        async with serve({"/v1/retrieval": retrieve}) as port:
+            remote = remote_service("retriever", port, "/v1/retrieval", ServiceType.RETRIEVER)
+            orchestrator = ServiceOrchestrator()
+            orchestrator.add(local).add(remote).flow_to(local, remote)
+            try:
+                result_dict, _ = await orchestrator.schedule({"text": "hi"})
+            finally:
+                await orchestrator.close()
+        return result_dict, http_calls, remote
+
+    try:
+        result_dict, http_calls, remote = asyncio.run(run())
+        assert find_local_handler(remote) is None
+        # the handler got the validated input object, and the remote service its reply over HTTP
+        assert len(calls) == 1 and isinstance(calls[0], TextDoc) and calls[0].text == "hi"
+        assert result_dict[local.name]["embedding"] == [0.5, 0.5]
+        assert len(http_calls) == 1 and http_calls[0]["text"] == "hi"
+        assert result_dict[remote.name] == {"text": "retrieved"}
+
+        monkeypatch.setattr(orchestrator_module, "INPROCESS", False)
+        orchestrator = ServiceOrchestrator()
+        orchestrator.add(local)
+        assert orchestrator._get_local_handler(local.name) is None
+    finally:
+        del opea_microservices["opea_service@test_inprocess"]
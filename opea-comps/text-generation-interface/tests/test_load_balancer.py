@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from cores.mega.constants import ServiceType
+from cores.mega.load_balancer import LatencyWindow, ReplicaSet
+from cores.mega.orchestrator import ServiceOrchestrator
+
+
+def test_latency_window_percentiles():
+    window = LatencyWindow(size=100, min_samples=10)
+    for latency in range(9):
+        window.observe(latency)
+    assert window.percentile(50) is None
+    for latency in range(9, 200):
+        window.observe(latency)
+    # only the last `size` latencies count
+    assert window.percentile(0) == 100 and window.percentile(95) == 195
+
+
+def test_least_outstanding_replica_is_picked():
+    replica_set = ReplicaSet(["a", "b", "c"], hedge=True)
+    first, second, third = replica_set.replicas
+    replica_set.acquire(first)
+    replica_set.acquire(second)
+    assert replica_set.pick(exclude=first) is third
+    replica_set.acquire(third)
+    replica_set.acquire(third)
+    assert replica_set.pick(exclude=third) is first
+    replica_set.release(first, 0.1)
+    assert [replica.outstanding for replica in replica_set.replicas] == [0, 1, 2]
+    # hedging waits for enough latencies to estimate the p95
+    assert replica_set.hedge_delay() is None
+    assert not ReplicaSet(["a"], hedge=True).hedge
+
+
+def _hedge_count(orchestrator, node, event):
+    return orchestrator.metrics.hedged_requests.labels(node=node, event=event)._value.get()
+
+
+def test_slow_calls_are_hedged_on_another_replica(serve, remote_service):
+    async def run():
+        arrivals = {}
+
+        def handler(name, delay):
+            async def handle(request):
+                arrivals[name] = time.time()
+                body = await request.json()
+                await asyncio.sleep(delay)
+                return web.json_response({"text": body["text"], "replica": name})
+
+            return handle
+
+        async with serve({"/v1/embeddings": handler("slow", 1)}) as slow_port:
+            async with serve({"/v1/embeddings": handler("fast", 0)}) as fast_port:
+                orchestrator = ServiceOrchestrator()
+                # the first replica is picked first, on equal load
+                embedding = remote_service("embedding", slow_port, "/v1/embeddings", ServiceType.EMBEDDING)
+                orchestrator.add(embedding, replicas=[f"http://127.0.0.1:{fast_port}/v1/embeddings"], hedge=True)
+                replica_set = orchestrator._replicas[embedding.name]
+                for _ in range(replica_set.latency.min_samples):
+                    replica_set.latency.observe(0.2)
+                try:
+                    start = time.time()
+                    result_dict, _ = await orchestrator.schedule({"text": "hi"})
+                    elapsed = time.time() - start
+                    await asyncio.sleep(0.05)
+                    # the slow call was cancelled and released its replica, it would still be running otherwise
+                    outstanding = [replica.outstanding for replica in replica_set.replicas]
+                finally:
+                    await orchestrator.close()
+        return result_dict[embedding.name], arrivals["fast"] - start, elapsed, outstanding, orchestrator, embedding
+
+    reply, hedged_after, elapsed, outstanding, orchestrator, embedding = asyncio.run(run())
+    assert reply["replica"] == "fast"
+    # the duplicate is sent once the call exceeded the p95 latency of the node
+    assert 0.2 <= hedged_after < 1 and elapsed < 1
+    assert outstanding == [0, 0]
+    assert _hedge_count(orchestrator, embedding.name, "sent") == 1
+    assert _hedge_count(orchestrator, embedding.name, "won") == 1
+
+
+@pytest.mark.parametrize("hedge", [False, True])
+def test_unreachable_replicas_fall_back_to_another_one(serve, remote_service, free_port, hedge):
+    async def run():
+        async def embed(request):
+            body = await request.json()
+            return web.json_response({"text": body["text"]})
+
+        async with serve({"/v1/embeddings": embed}) as port:
+            orchestrator = ServiceOrchestrator()
+            # nothing listens on the first replica, picked first
+            embedding = remote_service("embedding", free_port(), "/v1/embeddings", ServiceType.EMBEDDING)
+            orchestrator.add(embedding, replicas=[f"http://127.0.0.1:{port}/v1/embeddings"], hedge=hedge)
+            replica_set = orchestrator._replicas[embedding.name]
+            for _ in range(replica_set.latency.min_samples):
+                replica_set.latency.observe(10)
+            try:
+                start = time.time()
+                result_dict, _ = await orchestrator.schedule({"text": "hi"})
+                elapsed = time.time() - start
+            finally:
+                await orchestrator.close()
+        outstanding = [replica.outstanding for replica in replica_set.replicas]
+        return result_dict[embedding.name], elapsed, outstanding
+
+    reply, elapsed, outstanding = asyncio.run(run())
+    assert reply == {"text": "hi"}
+    # without waiting for the hedging delay
+    assert elapsed < 5
+    assert outstanding == [0, 0]
+
+
+def test_unreachable_single_replica_fails(remote_service, free_port):
+    async def run():
+        orchestrator = ServiceOrchestrator()
+        orchestrator.add(remote_service("embedding", free_port(), "/v1/embeddings", ServiceType.EMBEDDING))
+        try:
+            await orchestrator.schedule({"text": "hi"})
+        finally:
+            await orchestrator.close()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(run())
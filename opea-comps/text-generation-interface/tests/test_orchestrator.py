@@ -0,0 +1,210 @@
+import asyncio
+import gc
+import json
+import time
+
+import pytest
+from aiohttp import web
+from fastapi import HTTPException
+
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator, StreamTee
+from cores.mega.sse import DONE_EVENT, SSEDecoder, decode_token
+from cores.proto.docarray import LLMParams
+
+
+async def _retrieve(request):
+    body = await request.json()
+    return web.json_response({"text": body["text"], "retrieved_docs": ["a", "b"], "initial_query": body["text"]})
+
+
+async def _rerank(request):
+    body = await request.json()
+    return web.json_response({"text": " ".join(body["retrieved_docs"]), "received": sorted(body)})
+
+
+class RerankOrchestrator(ServiceOrchestrator):
+    def align_inputs(self, inputs, cur_node, *args, **kwargs):
+        if self.services[cur_node].service_type == ServiceType.RERANK:
+            assert isinstance(inputs, dict)
+            json.dumps(inputs)
+            del inputs["initial_query"]
+            inputs.pop("text")
+            inputs["text"] = "rewritten"
+        return inputs
+
+
+def test_align_inputs_gets_a_dict_of_its_own(serve, remote_service):
+    async def run():
+        async with serve({"/v1/retrieval": _retrieve, "/v1/reranking": _rerank}) as port:
+            orchestrator = RerankOrchestrator()
+            retriever = remote_service("retriever", port, "/v1/retrieval", ServiceType.RETRIEVER)
+            reranker = remote_service("reranker", port, "/v1/reranking", ServiceType.RERANK)
+            orchestrator.add(retriever).add(reranker).flow_to(retriever, reranker)
+            try:
+                return await orchestrator.schedule({"text": "query"}), retriever.name, reranker.name
+            finally:
+                await orchestrator.close()
+
+    (result_dict, _), retriever, reranker = asyncio.run(run())
+    assert result_dict[reranker] == {"text": "a b", "received": ["retrieved_docs", "text"]}
+    # the output of the predecessor is kept, untouched by align_inputs
+    assert result_dict[retriever] == {"text": "query", "retrieved_docs": ["a", "b"], "initial_query": "query"}
+
+
+def test_stream_tee_is_bounded_by_a_stalled_reader():
+    async def run():
+        read = []
+
+        async def source():
+            for i in range(100):
+                read.append(i)
+                yield i
+
+        fast, stalled = StreamTee(source(), 2, maxsize=4)
+        received = []
+
+        async def consume():
+            async for chunk in fast:
+                received.append(chunk)
+
+        consumer = asyncio.create_task(consume())
+        assert await stalled.__anext__() == 0
+        await asyncio.sleep(0.05)
+        # the source is read at most `maxsize` chunks ahead of the stalled reader, nothing else is buffered
+        assert not consumer.done() and len(read) <= 1 + 4 + 1
+        # once the stalled reader goes away, the others read the rest of the stream
+        await stalled.aclose()
+        await asyncio.wait_for(consumer, 1)
+        return received
+
+    assert asyncio.run(run()) == list(range(100))
+
+
+def test_stream_tee_closes_the_source_with_its_last_reader():
+    async def run():
+        closed = asyncio.Event()
+
+        async def source():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.set()
+
+        first, second = StreamTee(source(), 2, maxsize=1)
+        assert await first.__anext__() == 0
+        # never read, then dropped
+        del second
+        gc.collect()
+        assert [chunk async for chunk in first] == list(range(1, 100))
+        await asyncio.wait_for(closed.wait(), 1)
+
+        first, second = StreamTee(source(), 2, maxsize=1)
+        closed.clear()
+        assert await first.__anext__() == 0
+        await first.aclose()
+        del second
+        gc.collect()
+        await asyncio.wait_for(closed.wait(), 1)
+
+    asyncio.run(run())
+
+
+async def _generate(request):
+    await request.json()
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in ("Hello", " world.", " Bye", " now."):
+        await response.write(f"data: b'{token}'\n\n".encode())
+    await response.write(b"data: [DONE]\n\n")
+    return response
+
+
+async def _upper(request):
+    body = await request.json()
+    return web.json_response({"text": body["text"].upper()})
+
+
+async def _length(request):
+    body = await request.json()
+    return web.json_response({"text": f"{len(body['text'])} "})
+
+
+def test_stream_fans_out_to_several_downstream_nodes(serve, remote_service):
+    async def run():
+        routes = {"/v1/chat/completions": _generate, "/v1/upper": _upper, "/v1/length": _length}
+        async with serve(routes) as port:
+            orchestrator = ServiceOrchestrator()
+            llm = remote_service("llm", port, "/v1/chat/completions", ServiceType.LLM)
+            upper = remote_service("upper", port, "/v1/upper", ServiceType.TTS)
+            length = remote_service("length", port, "/v1/length", ServiceType.GUARDRAIL)
+            orchestrator.add(llm).add(upper).add(length).flow_to(llm, upper)
+            orchestrator.flow_to(llm, length)
+            try:
+                result_dict, _ = await orchestrator.schedule({"text": "hi"}, llm_parameters=LLMParams(stream=True))
+                bodies = {}
+                for node in (upper.name, length.name):
+                    chunks = [chunk async for chunk in result_dict[node].body_iterator]
+                    bodies[node] = chunks
+                return bodies, upper.name, length.name, orchestrator.metrics.pending
+            finally:
+                await orchestrator.close()
+
+    bodies, upper, length, pending = asyncio.run(run())
+    assert pending == 0
+
+    def text(chunks):
+        assert chunks[-1] == DONE_EVENT
+        return "".join(decode_token(data) for chunk in chunks[:-1] for data in SSEDecoder().feed(chunk))
+
+    assert text(bodies[upper]) == "HELLO WORLD. BYE NOW."
+    # the text left when the stream ends is forwarded too, even empty
+    assert text(bodies[length]) == "12 9 0 "
+
+
+def test_deprecated_stream_helpers():
+    orchestrator = ServiceOrchestrator()
+    with pytest.deprecated_call():
+        assert orchestrator.extract_chunk_str("data: b'Hello'\n\n") == "Hello"
+    with pytest.deprecated_call():
+        assert list(orchestrator.wrap_iterable(iter([b"a", b"b"]))) == [b"a", b"b"]
+
+
+def test_deadline_is_forwarded_and_enforced(serve, remote_service):
+    async def run():
+        calls = []
+
+        async def retrieve(request):
+            body = await request.json()
+            calls.append(request.headers.get("X-OPEA-Deadline"))
+            await asyncio.sleep(body.get("delay", 0))
+            return web.json_response({"text": body["text"]})
+
+        async with serve({"/v1/retrieval": retrieve}) as port:
+            orchestrator = ServiceOrchestrator()
+            retriever = remote_service("retriever", port, "/v1/retrieval", ServiceType.RETRIEVER)
+            orchestrator.add(retriever)
+            try:
+                deadline = time.time() + 30
+                await orchestrator.schedule({"text": "q"}, deadline=deadline)
+                assert calls == [f"{deadline:.3f}"]
+
+                # a node still running at the deadline is cancelled
+                start = time.time()
+                with pytest.raises(HTTPException) as exceeded:
+                    await orchestrator.schedule({"text": "q", "delay": 1}, deadline=start + 0.2)
+                assert exceeded.value.status_code == 504 and time.time() - start < 0.8
+
+                # a node whose typical latency exceeds the time left is not called
+                for _ in range(20):
+                    orchestrator._replicas[retriever.name].latency.observe(2)
+                with pytest.raises(HTTPException) as unmet:
+                    await orchestrator.schedule({"text": "q"}, deadline=time.time() + 1)
+                assert unmet.value.status_code == 504 and "cannot be met" in unmet.value.detail
+                assert len(calls) == 2
+                assert orchestrator.metrics.pending == 0
+            finally:
+                await orchestrator.close()
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+import yaml
+
+from cores.mega import orchestrator_with_yaml
+from cores.mega.orchestrator_with_yaml import ServiceOrchestratorWithYaml, compile_plan, load_plan, parse_mega_flow
+
+GRAPH = """
+opea_micro_services:
+  s1:
+    endpoint: http://localhost:8001/v1/embeddings
+    service_type: embedding
+  s2:
+    endpoint: http://localhost:8002/v1/retrieval
+  s3:
+    endpoint: http://localhost:8003/v1/chat/completions
+    service_type: llm
+opea_mega_service:
+  mega_flow:
+    - s1 >> s2 >> s3
+"""
+
+
+def test_parse_mega_flow():
+    nodes, edges = parse_mega_flow(["(s1, s2) >> s3", "s3 >> (s4, s5)"])
+    assert nodes == ["s1", "s2", "s3", "s4", "s5"]
+    assert edges == [("s1", "s3"), ("s2", "s3"), ("s3", "s4"), ("s3", "s5")]
+
+
+def test_compile_plan():
+    plan = compile_plan(yaml.safe_load(GRAPH))
+    assert plan["successors"] == {"s1": ["s2"], "s2": ["s3"], "s3": []}
+    assert plan["order"] == ["s1", "s2", "s3"]
+
+
+@pytest.mark.parametrize(
+    "change, error",
+    [
+        (lambda docs: docs["opea_micro_services"].pop("s2"), "not declared"),
+        (lambda docs: docs["opea_micro_services"]["s2"].pop("endpoint"), "no endpoint"),
+        (lambda docs: docs["opea_micro_services"]["s3"].update(service_type="llms"), "unknown service_type"),
+        (lambda docs: docs["opea_mega_service"]["mega_flow"].append("s3 >> s1"), "not acyclic"),
+    ],
+)
+def test_compile_plan_rejects_invalid_graphs(change, error):
+    docs = yaml.safe_load(GRAPH)
+    change(docs)
+    with pytest.raises(ValueError, match=error):
+        compile_plan(docs)
+
+
+def test_plan_cache(tmp_path, monkeypatch):
+    content = GRAPH.encode()
+    digest = hashlib.sha256(content).hexdigest()
+    cache_dir = tmp_path / "plans"
+    plan = load_plan(content, digest, cache_dir=str(cache_dir))
+    assert plan["order"] == ["s1", "s2", "s3"]
+    assert [path.name for path in cache_dir.iterdir()] == [f"{digest}.json"]
+    # the cached plan is served without compiling the content again
+    assert load_plan(b"not: [yaml", digest, cache_dir=str(cache_dir)) == plan
+
+    # PLAN_CACHE_DIR is the default cache, an empty one disables it
+    monkeypatch.setattr(orchestrator_with_yaml, "PLAN_CACHE_DIR", str(cache_dir))
+    assert load_plan(b"not: [yaml", digest) == plan
+    monkeypatch.setattr(orchestrator_with_yaml, "PLAN_CACHE_DIR", "")
+    with pytest.raises(yaml.YAMLError):
+        load_plan(b"not: [yaml", digest)
+
+
+def _write(path, content):
+    path.write_text(content)
+    # the YAML file is only read again when its modification time or size changed
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_reload_swaps_the_graph(tmp_path, monkeypatch):
+    monkeypatch.setattr(orchestrator_with_yaml, "PLAN_CACHE_DIR", str(tmp_path / "plans"))
+    path = tmp_path / "megaservice.yaml"
+    _write(path, GRAPH)
+    orchestrator = ServiceOrchestratorWithYaml(str(path))
+    plan = orchestrator._get_plan()
+    assert orchestrator.topological_sort() == ["s1", "s2", "s3"]
+    assert not orchestrator.reload()
+
+    _write(path, GRAPH.replace("s1 >> s2 >> s3", "s2 >> s1 >> s3"))
+    assert orchestrator.reload()
+    assert orchestrator.topological_sort() == ["s2", "s1", "s3"]
+    # requests in flight keep the plan they started with
+    assert orchestrator._get_plan() is not plan and plan.order == ("s1", "s2", "s3")
+
+    # an invalid file keeps the current graph
+    _write(path, GRAPH.replace("s1 >> s2 >> s3", "s1 >> s2 >> s1"))
+    assert not orchestrator.reload()
+    assert orchestrator.topological_sort() == ["s2", "s1", "s3"]
+
+
+def test_watch_reloads_the_changed_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(orchestrator_with_yaml, "PLAN_CACHE_DIR", "")
+    path = tmp_path / "megaservice.yaml"
+    _write(path, GRAPH)
+    orchestrator = ServiceOrchestratorWithYaml(str(path))
+
+    async def run():
+        watcher = asyncio.create_task(orchestrator.watch(interval=0.01))
+        try:
+            _write(path, GRAPH.replace("s1 >> s2 >> s3", "s3 >> s2 >> s1"))
+            for _ in range(100):
+                await asyncio.sleep(0.01)
+                if orchestrator.topological_sort()[0] == "s3":
+                    break
+        finally:
+            watcher.cancel()
+        return orchestrator.topological_sort()
+
+    assert asyncio.run(run()) == ["s3", "s2", "s1"]
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from aiohttp import web
+
+from cores.mega.constants import ServiceType
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.mega.result_cache import DiskCacheTier, NodeResultCache, canonical_hash
+from cores.proto.docarray import LLMParams, TextDoc
+
+
+def test_canonical_hash_ignores_key_order():
+    assert canonical_hash("embedding", {"a": 1, "b": [1, 2]}) == canonical_hash("embedding", {"b": [1, 2], "a": 1})
+    assert canonical_hash("embedding", {"a": 1}) != canonical_hash("retriever", {"a": 1})
+    assert canonical_hash("embedding", {"a": 1}) != canonical_hash("embedding", {"a": 2})
+
+
+def test_canonical_hash_ignores_doc_ids():
+    first, second = TextDoc(text="hello"), TextDoc(text="hello")
+    assert first.id != second.id
+    assert canonical_hash("embedding", first.dict()) == canonical_hash("embedding", second.dict())
+    nested = {"retrieved_docs": [{"id": "1", "text": "a"}], "id": "2"}
+    assert canonical_hash("rerank", nested) == canonical_hash("rerank", {"retrieved_docs": [{"text": "a"}]})
+
+
+def test_node_result_cache_lru_and_ttl():
+    events = []
+    cache = NodeResultCache(max_size=2, ttl=60, on_event=lambda node, event: events.append(event))
+    cache.put("n", "a", b'{"v": 1}')
+    cache.put("n", "b", b'{"v": 2}')
+    assert cache.get("n", "a") == {"v": 1}
+    cache.put("n", "c", b'{"v": 3}')
+    # "b" was the least recently used
+    assert cache.get("n", "b") is None
+    assert cache.get("n", "c") == {"v": 3}
+
+    cache.ttl = -1
+    cache.put("n", "d", b'{"v": 4}')
+    assert cache.get("n", "d") is None
+    assert events.count("eviction") == 3
+
+
+def test_node_result_cache_returns_fresh_objects():
+    cache = NodeResultCache()
+    cache.put("n", "a", b'{"v": [1]}')
+    cache.get("n", "a")["v"].append(2)
+    assert cache.get("n", "a") == {"v": [1]}
+
+
+def test_disk_tier_survives_new_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    NodeResultCache(disk=DiskCacheTier(path)).put("n", "a", b'{"v": 1}')
+    assert NodeResultCache(disk=DiskCacheTier(path)).get("n", "a") == {"v": 1}
+    DiskCacheTier(path).put("n", b"{}", time.time() - 1)
+    assert DiskCacheTier(path).get("n") is None
+
+
+def test_identical_requests_hit_the_cache(serve, remote_service):
+    async def run():
+        calls = []
+
+        async def embed(request):
+            body = await request.json()
+            calls.append(body)
+            return web.json_response({"text": body["text"], "embedding": [0.1, 0.2]})
+
+        async with serve({"/v1/embeddings": embed}) as port:
+            orchestrator = ServiceOrchestrator()
+            embedding = remote_service("embedding", port, "/v1/embeddings", ServiceType.EMBEDDING)
+            orchestrator.add(embedding).enable_cache()
+            try:
+                results = []
+                for _ in range(2):
+                    # each request gets a doc with a new random id
+                    result_dict, _ = await orchestrator.schedule(TextDoc(text="hello"), llm_parameters=LLMParams())
+                    results.append(result_dict)
+            finally:
+                await orchestrator.close()
+        return calls, results
+
+    calls, results = asyncio.run(run())
+    assert len(calls) == 1
+    assert results[0] == results[1]
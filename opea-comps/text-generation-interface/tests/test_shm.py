@@ -0,0 +1,143 @@
+import asyncio
+import json
+from multiprocessing import shared_memory
+
+import pytest
+from fastapi import FastAPI
+
+from cores.mega.inprocess import route_handler
+from cores.mega.shm import (
+    SHM_HANDLE_PREFIX,
+    RequestPayloads,
+    SharedPayloadRoute,
+    SharedPayloadStore,
+    resolve_shared_payload,
+    resolve_shared_payloads,
+)
+from cores.proto.docarray import Base64ByteStrDoc
+
+
+@pytest.fixture
+def store():
+    store = SharedPayloadStore(min_size=4)
+    yield store
+    store.close()
+
+
+def test_round_trip(store):
+    handle = store.export("payload")
+    assert handle.startswith(SHM_HANDLE_PREFIX)
+    assert resolve_shared_payload(handle) == "payload"
+    assert store.export("abc") is None
+
+
+def test_released_handles_no_longer_resolve(store):
+    value = "payload"
+    handle = store.export(value)
+    # the same value is exported once
+    assert store.export(value) == handle
+    store.release(handle)
+    assert resolve_shared_payload(handle) == "payload"
+    store.release(handle)
+    with pytest.raises(ValueError):
+        resolve_shared_payload(handle)
+
+
+def test_forged_handles_are_rejected(store):
+    handle = store.export("payload")
+    name, size, token = handle[len(SHM_HANDLE_PREFIX) :].split("/")
+    forged_token = f"{SHM_HANDLE_PREFIX}{name}/{size}/{'0' * len(token)}"
+    oversized = f"{SHM_HANDLE_PREFIX}{name}/{int(size) + 100}/{token}"
+    for forged in (forged_token, oversized, f"{SHM_HANDLE_PREFIX}../{name}/{size}/{token}"):
+        with pytest.raises(ValueError):
+            resolve_shared_payload(forged)
+
+    # segments not exported by a store are never opened, whatever their name
+    other = shared_memory.SharedMemory(create=True, size=16)
+    try:
+        with pytest.raises(ValueError):
+            resolve_shared_payload(f"{SHM_HANDLE_PREFIX}{other.name}/16/{token}")
+    finally:
+        other.close()
+        other.unlink()
+
+
+def test_request_payloads(store):
+    payloads = RequestPayloads(store)
+    inputs = {"byte_str": "payload", "text": "not a media field"}
+    shared = payloads.share(inputs)
+    assert shared["byte_str"].startswith(SHM_HANDLE_PREFIX) and shared["text"] == inputs["text"]
+    assert inputs["byte_str"] == "payload"
+    assert resolve_shared_payloads(shared) == inputs
+    payloads.release()
+    with pytest.raises(ValueError):
+        resolve_shared_payloads(shared)
+
+
+async def _post(app, path, body):
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop() if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", b"%d" % len(body))],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    status = sent[0]["status"]
+    return status, json.loads(b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+def test_routes_resolve_handles(store):
+    app = FastAPI()
+    app.router.route_class = SharedPayloadRoute
+    docs = []
+
+    @app.post("/v1/asr")
+    async def asr(doc: Base64ByteStrDoc):
+        docs.append(doc)
+        return {"byte_str": doc.byte_str}
+
+    @app.post("/v1/sync")
+    def sync_asr(doc: Base64ByteStrDoc):
+        return {"byte_str": doc.byte_str}
+
+    handle = store.export("payload")
+
+    async def run():
+        resolved = await _post(app, "/v1/asr", json.dumps({"byte_str": handle}).encode())
+        inline = await _post(app, "/v1/asr", json.dumps({"byte_str": "inline"}).encode())
+        forged_handle = handle[:-1] + ("1" if handle.endswith("0") else "0")
+        forged = await _post(app, "/v1/asr", json.dumps({"byte_str": forged_handle}).encode())
+        resolved_sync = await _post(app, "/v1/sync", json.dumps({"byte_str": handle}).encode())
+        # the in-process and gRPC calls go through the same handler
+        local = await route_handler(app, "/v1/asr")({"byte_str": handle})
+        return resolved, inline, forged, resolved_sync, local
+
+    resolved, inline, forged, resolved_sync, local = asyncio.run(run())
+    assert resolved == (200, {"byte_str": "payload"})
+    assert inline == (200, {"byte_str": "inline"})
+    assert forged[0] == 400
+    assert resolved_sync == (200, {"byte_str": "payload"})
+    assert local == {"byte_str": "payload"}
+    # the handler got the validated doc, its payload read from the segment
+    assert isinstance(docs[0], Base64ByteStrDoc) and docs[0].byte_str == "payload"
+
+
+def test_docs_do_not_resolve_handles(store):
+    handle = store.export("payload")
+    assert Base64ByteStrDoc(byte_str=handle).byte_str == handle
@@ -0,0 +1,109 @@
+import asyncio
+
+from fastapi.responses import StreamingResponse
+
+from cores.mega.single_flight import SingleFlight, StreamBroadcaster
+
+
+async def _read(response):
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+
+async def _tokens(count, delay=0.01):
+    for i in range(count):
+        await asyncio.sleep(delay)
+        yield b"tok%d " % i
+
+
+def test_identical_requests_share_one_run():
+    async def run():
+        calls = []
+        followed = []
+        flight = SingleFlight(on_follow=lambda: followed.append(1))
+
+        async def schedule():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"node": {"text": "done"}}, None
+
+        results = await asyncio.gather(*(flight.run("key", schedule) for _ in range(3)))
+        # once completed, the key runs again
+        await flight.run("key", schedule)
+        return calls, followed, results
+
+    calls, followed, results = asyncio.run(run())
+    assert len(calls) == 2 and len(followed) == 2
+    assert all(result_dict == {"node": {"text": "done"}} for result_dict, _ in results)
+    # each request gets its own results dict
+    assert results[0][0] is not results[1][0]
+
+
+def test_run_is_cancelled_with_its_last_waiter():
+    async def run():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def schedule():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        first = asyncio.create_task(flight.run("key", schedule))
+        second = asyncio.create_task(flight.run("key", schedule))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()
+        second.cancel()
+        await asyncio.sleep(0.01)
+        return cancelled.is_set()
+
+    assert asyncio.run(run())
+
+
+def test_streams_are_multicast():
+    async def run():
+        flight = SingleFlight()
+        reads = []
+
+        async def schedule():
+            async def source():
+                reads.append(1)
+                async for token in _tokens(4):
+                    yield token
+
+            await asyncio.sleep(0.01)
+            # the same stream is the result of two nodes
+            response = StreamingResponse(source(), media_type="text/event-stream")
+            return {"tts": response, "guard": response}, None
+
+        results = await asyncio.gather(*(flight.run("key", schedule) for _ in range(2)))
+        bodies = await asyncio.gather(
+            *(_read(result_dict[node]) for result_dict, _ in results for node in ("tts", "guard"))
+        )
+        return reads, bodies
+
+    reads, bodies = asyncio.run(run())
+    assert len(reads) == 1
+    assert bodies == [b"tok0 tok1 tok2 tok3 "] * 4
+
+
+def test_late_subscribers_replay_the_stream():
+    async def run():
+        done = []
+        broadcaster = StreamBroadcaster(_tokens(3, delay=0), lambda: done.append(1))
+        first = broadcaster.subscribe()
+        assert await first.__anext__() == b"tok0 "
+        await asyncio.sleep(0.01)
+        late = [chunk async for chunk in broadcaster.subscribe()]
+        rest = [chunk async for chunk in first]
+        return done, late, rest
+
+    done, late, rest = asyncio.run(run())
+    assert done == [1]
+    assert late == [b"tok0 ", b"tok1 ", b"tok2 "]
+    assert rest == [b"tok1 ", b"tok2 "]
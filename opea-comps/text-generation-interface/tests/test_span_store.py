@@ -0,0 +1,119 @@
+import asyncio
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.id_generator import IdGenerator
+from opentelemetry.trace import StatusCode, format_trace_id, set_span_in_context
+
+from cores.mega import http_service
+from cores.mega.http_service import HTTPService
+from cores.telemetry.span_store import RingBufferSpanExporter
+
+MS = 1_000_000
+
+
+class SequentialIdGenerator(IdGenerator):
+    """Trace ids whose low 64 bits are the given ones, in turn."""
+
+    def __init__(self, low_bits):
+        self._low_bits = iter(low_bits)
+        self._span_id = 0
+
+    def generate_span_id(self):
+        self._span_id += 1
+        return self._span_id
+
+    def generate_trace_id(self):
+        return (1 << 64) | next(self._low_bits)
+
+
+def _tracer(exporter, low_bits=range(1, 1000)):
+    provider = TracerProvider(id_generator=SequentialIdGenerator(low_bits))
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    return provider.get_tracer(__name__)
+
+
+def _span(tracer, name, duration_ms, parent=None):
+    span = tracer.start_span(name, context=parent, start_time=10**18)
+    span.set_attribute("node", name)
+    span.end(end_time=10**18 + duration_ms * MS)
+    return span
+
+
+def test_the_oldest_spans_are_evicted():
+    exporter = RingBufferSpanExporter(capacity=3)
+    tracer = _tracer(exporter)
+    for i in range(5):
+        _span(tracer, f"span{i}", i)
+    assert [span.name for span in exporter.get_finished_spans()] == ["span2", "span3", "span4"]
+    exporter.clear()
+    assert exporter.query() == []
+
+
+def test_spans_are_queried_most_recent_first():
+    exporter = RingBufferSpanExporter(capacity=10)
+    tracer = _tracer(exporter)
+    root = tracer.start_span("request", start_time=10**18)
+    child = _span(tracer, "llm", 30, parent=set_span_in_context(root))
+    root.end(end_time=10**18 + 50 * MS)
+    other = _span(tracer, "llm", 5)
+    trace_id = format_trace_id(root.get_span_context().trace_id)
+
+    assert [span["name"] for span in exporter.query()] == ["llm", "request", "llm"]
+    assert [span["name"] for span in exporter.query(trace_id=trace_id)] == ["request", "llm"]
+    assert [span["duration_ms"] for span in exporter.query(name="llm")] == [5.0, 30.0]
+    assert [span["duration_ms"] for span in exporter.query(min_duration_ms=30)] == [50.0, 30.0]
+    assert len(exporter.query(limit=1)) == 1
+
+    span = exporter.query(trace_id=trace_id, name="llm")[0]
+    assert span["parent_id"] == exporter.query(trace_id=trace_id, name="request")[0]["span_id"]
+    assert span["trace_id"] == trace_id and span["start"] == 1e9
+    assert span["status"] == StatusCode.UNSET.name and span["attributes"] == {"node": "llm"}
+    assert exporter.query(name="llm")[0]["parent_id"] is None
+    assert child.get_span_context().trace_id != other.get_span_context().trace_id
+
+
+def test_whole_traces_are_sampled_by_their_id():
+    exporter = RingBufferSpanExporter(capacity=10, sample_rate=0.5)
+    # a trace is kept when the low 64 bits of its id are below half of their range
+    tracer = _tracer(exporter, low_bits=[1, 1 << 63, (1 << 63) - 1])
+    for _ in range(3):
+        with tracer.start_as_current_span("request"):
+            _span(tracer, "llm", 1)
+    kept = {span.context.trace_id & ((1 << 64) - 1) for span in exporter.get_finished_spans()}
+    assert kept == {1, (1 << 63) - 1}
+    # with both spans of each kept trace
+    assert len(exporter.get_finished_spans()) == 4
+
+
+def test_unsampled_and_stopped_exporters_keep_nothing():
+    exporter = RingBufferSpanExporter(capacity=10, sample_rate=0.0)
+    tracer = _tracer(exporter)
+    _span(tracer, "llm", 1)
+    assert exporter.get_finished_spans() == ()
+    exporter.shutdown()
+    assert exporter.export([]).name == "FAILURE"
+
+
+def test_traces_are_served(monkeypatch, asgi_get):
+    exporter = RingBufferSpanExporter(capacity=10)
+    tracer = _tracer(exporter)
+    _span(tracer, "embedding", 2)
+    _span(tracer, "llm", 40)
+    monkeypatch.setattr(http_service, "in_memory_exporter", exporter)
+    runtime_args = {"protocol": "http", "host": "127.0.0.1", "port": 0, "title": "test", "description": "test"}
+    app = HTTPService(runtime_args=runtime_args).app
+
+    async def run():
+        return (
+            await asgi_get(app, "/v1/traces"),
+            await asgi_get(app, "/v1/traces", b"min_duration_ms=10"),
+            await asgi_get(app, "/v1/traces", b"name=embedding&limit=1"),
+            await asgi_get(app, "/v1/traces", b"trace_id=not-hex"),
+        )
+
+    (status, spans), (_, slow), (_, embedding), (bad_status, _) = asyncio.run(run())
+    assert status == 200 and [span["name"] for span in spans] == ["llm", "embedding"]
+    assert [span["name"] for span in slow] == ["llm"]
+    assert [span["duration_ms"] for span in embedding] == [2.0]
+    assert bad_status == 400
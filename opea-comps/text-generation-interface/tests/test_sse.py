@@ -0,0 +1,52 @@
+import pytest
+
+from cores.mega.sse import DONE_DATA, SSEDecoder, SSEEventCounter, decode_token, encode_token, event_data
+
+STREAM = (
+    b"data: b'Hello'\n\ndata: b' world'\n\n: keep-alive\n\n"
+    b'event: usage\ndata: {"a":\ndata: 1}\n\ndata: [DONE]\n\n'
+)
+EVENTS = [b"b'Hello'", b"b' world'", b'{"a":\n1}', DONE_DATA]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(STREAM)])
+def test_decoder_reassembles_split_events(size):
+    decoder = SSEDecoder()
+    events = []
+    for i in range(0, len(STREAM), size):
+        events.extend(decoder.feed(STREAM[i : i + size]))
+    assert events == EVENTS
+    assert decoder.flush() == []
+
+
+def test_decoder_flushes_an_unterminated_event():
+    decoder = SSEDecoder()
+    assert decoder.feed(b"data: b'Hello'\n\ndata: b'tail'") == [b"b'Hello'"]
+    assert decoder.flush() == [b"b'tail'"]
+    assert decoder.flush() == []
+
+
+@pytest.mark.parametrize("size", [1, 2, 5, len(STREAM)])
+def test_counter_counts_events_across_chunks(size):
+    counter = SSEEventCounter()
+    assert sum(counter.feed(STREAM[i : i + size]) for i in range(0, len(STREAM), size)) == STREAM.count(b"\n\n")
+
+
+def test_event_data():
+    assert event_data(b"data: x") == b"x"
+    assert event_data(b"data:x\r\ndata: y") == b"x\ny"
+    assert event_data(b": comment") is None
+
+
+@pytest.mark.parametrize("token", ["Hello", " world", "it's", 'say "hi"'])
+def test_tokens_round_trip(token):
+    (data,) = SSEDecoder().feed(encode_token(token))
+    assert decode_token(data) == token
+
+
+def test_escapes_are_kept_in_the_text():
+    # as with the string slicing it replaces, the repr escapes are kept in the text passed downstream
+    (data,) = SSEDecoder().feed(encode_token("a\nb"))
+    assert decode_token(data) == "a\\nb"
+    # and the newlines are restored when the text is tokenised again
+    assert encode_token("a\\nb") == encode_token("a\nb")
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.responses import StreamingResponse
+from prometheus_client import REGISTRY
+
+from cores.mega.base_statistics import BaseStatistics, statistics_dict
+from cores.mega.stream_statistics import measure_stream, record_latency
+
+
+@pytest.fixture
+def statistics(monkeypatch):
+    """Fresh statistics of the service and of its model, dropped after the test."""
+    for name in ("llm", "llm/m"):
+        monkeypatch.setitem(statistics_dict, name, BaseStatistics())
+    return statistics_dict["llm"], statistics_dict["llm/m"]
+
+
+def _count(metric):
+    return REGISTRY.get_sample_value(f"{metric}_count", {"model": "m"}) or 0
+
+
+def _reply(tokens, first_delay=0.05, delay=0.02, encode=False):
+    async def stream():
+        await asyncio.sleep(first_delay)
+        for i in range(tokens):
+            if i:
+                await asyncio.sleep(delay)
+            yield f"data: token {i}\n\n"
+        yield "data: [DONE]\n\n"
+
+    async def encoded():
+        async for chunk in stream():
+            yield chunk.encode()
+
+    return StreamingResponse(encoded() if encode else stream(), media_type="text/event-stream")
+
+
+@pytest.mark.parametrize("encode", [False, True])
+def test_streams_are_measured_to_their_end(statistics, encode):
+    counts = {metric: _count(metric) for metric in ("opea_llm_first_token_latency", "opea_llm_inter_token_latency")}
+
+    async def run():
+        start = time.time()
+        response = measure_stream(_reply(4, encode=encode), "llm", "m", start)
+        chunks = [chunk async for chunk in response.body_iterator]
+        return chunks, time.time() - start
+
+    chunks, duration = asyncio.run(run())
+    assert len(chunks) == 5
+    for stats in statistics:
+        # the response time covers the whole stream, the first token its first event
+        assert stats.response_times.count == 1 and duration - 0.01 <= stats.response_times.total <= duration
+        assert 0.05 <= stats.first_token_latencies.total < stats.response_times.total
+        # the [DONE] event is not a token: 3 intervals of 20 ms between the 4 tokens
+        assert 0.02 <= stats.inter_token_latencies.total < 0.05
+        assert stats.tokens_per_second.total == pytest.approx(4 / stats.response_times.total, rel=0.01)
+    assert {metric: _count(metric) - count for metric, count in counts.items()} == {
+        "opea_llm_first_token_latency": 1,
+        "opea_llm_inter_token_latency": 1,
+    }
+
+
+def test_streams_closed_by_the_client_are_measured(statistics):
+    async def run():
+        response = measure_stream(_reply(4), "llm", "m", time.time())
+        body = response.body_iterator
+        # the client goes away after the first token
+        await body.__anext__()
+        await body.aclose()
+
+    asyncio.run(run())
+    service, model = statistics
+    assert service.first_token_latencies.count == model.first_token_latencies.count == 1
+    # a single token has no inter-token latency
+    assert model.inter_token_latencies.count == 0 and model.tokens_per_second.count == 1
+
+
+def test_replies_without_tokens_have_no_first_token(statistics):
+    async def run():
+        response = measure_stream(_reply(0, first_delay=0), "llm", "m", time.time())
+        return [chunk async for chunk in response.body_iterator]
+
+    assert asyncio.run(run()) == ["data: [DONE]\n\n"]
+    _, model = statistics
+    assert model.response_times.count == 1
+    assert model.first_token_latencies.count == model.tokens_per_second.count == 0
+
+
+def test_latencies_are_recorded_per_model(statistics, monkeypatch):
+    monkeypatch.setitem(statistics_dict, "llm/other", BaseStatistics())
+    count = _count("opea_llm_request_latency")
+    record_latency("llm", "m", 0.5)
+    record_latency("llm", "other", 1.5)
+    service, model = statistics
+    assert service.response_times.total == 2.0 and model.response_times.total == 0.5
+    assert statistics_dict["llm/other"].response_times.total == 1.5
+    assert _count("opea_llm_request_latency") - count == 1
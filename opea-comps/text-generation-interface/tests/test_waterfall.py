@@ -0,0 +1,87 @@
+import asyncio
+
+from aiohttp import web
+
+from cores.mega.constants import ServiceType
+from cores.mega.micro_service import MicroService
+from cores.mega.orchestrator import ServiceOrchestrator
+from cores.mega.waterfall import RequestWaterfall
+
+# a fans out to b and c, which d joins
+PREDECESSORS = {"a": [], "b": ["a"], "c": ["a"], "d": ["b", "c"]}
+
+
+def _waterfall(ends):
+    waterfall = RequestWaterfall("request")
+    for node, end in ends.items():
+        span = waterfall.begin(node)
+        if end is not None:
+            span.end = waterfall.start + end
+    waterfall.finish(PREDECESSORS)
+    return waterfall
+
+
+def test_critical_path_follows_the_predecessors_that_ended_last():
+    assert _waterfall({"a": 1, "b": 2, "c": 3, "d": 4}).critical_path() == ["a", "c", "d"]
+    assert _waterfall({"a": 1, "b": 3, "c": 2, "d": 4}).critical_path() == ["a", "b", "d"]
+    # a request that failed before its last node ended
+    assert _waterfall({"a": 1, "b": 2, "c": 3, "d": None}).critical_path() == ["a", "c"]
+    assert _waterfall({}).critical_path() == []
+
+
+def test_waterfalls_are_served_on_the_debug_route(serve, remote_service, free_port, asgi_get):
+    def handler(delay, process_time=None):
+        async def handle(request):
+            body = await request.json()
+            await asyncio.sleep(delay)
+            headers = {} if process_time is None else {"X-Process-Time": str(process_time)}
+            return web.json_response({"text": body.get("text", "")}, headers=headers)
+
+        return handle
+
+    megaservice = MicroService("megaservice", host="127.0.0.1", port=free_port(), endpoint="/v1/megaservice")
+    nodes = {}
+
+    async def run():
+        routes = {"/v1/a": handler(0), "/v1/b": handler(0.01), "/v1/c": handler(0.2, 0.15), "/v1/d": handler(0)}
+        async with serve(routes) as port:
+            orchestrator = ServiceOrchestrator()
+            nodes.update({name: remote_service(name, port, f"/v1/{name}", ServiceType.UNDEFINED) for name in "abcd"})
+            for node in nodes.values():
+                orchestrator.add(node)
+            for node, predecessors in PREDECESSORS.items():
+                for predecessor in predecessors:
+                    orchestrator.flow_to(nodes[predecessor], nodes[node])
+            orchestrator.add_debug_routes(megaservice)
+            try:
+                _, runtime_graph = await orchestrator.schedule({"text": "hi"})
+                await orchestrator.schedule({"text": "again"})
+            finally:
+                await orchestrator.close()
+        query = f"request_id={runtime_graph.request_id}".encode()
+        one = await asgi_get(megaservice.app, "/v1/debug/waterfall", query)
+        recent = await asgi_get(megaservice.app, "/v1/debug/waterfall", b"limit=1")
+        missing = await asgi_get(megaservice.app, "/v1/debug/waterfall", b"request_id=unknown")
+        return runtime_graph.request_id, one, recent, missing
+
+    # the megaservice serves its routes on the loop it was created with
+    try:
+        result = megaservice.event_loop.run_until_complete(run())
+    finally:
+        megaservice.event_loop.run_until_complete(megaservice.terminate_server())
+    request_id, (status, waterfall), (recent_status, recent), (missing_status, _) = result
+    assert status == 200 and waterfall["request_id"] == request_id
+    names = {service.name: name for name, service in nodes.items()}
+    assert [names[node] for node in waterfall["critical_path"]] == ["a", "c", "d"]
+    spans = {names[span["node"]]: span for span in waterfall["nodes"]}
+    assert set(spans) == set("abcd")
+    # node times are relative to the start of the request, and a node starts once its predecessors ended
+    assert 0 <= spans["a"]["start"] <= spans["a"]["end"] <= spans["c"]["start"]
+    assert spans["d"]["start"] >= spans["c"]["end"] >= 0.2
+    assert spans["d"]["end"] <= waterfall["duration"]
+    # the server time is the X-Process-Time reported by the micro service
+    assert spans["c"]["server"] == 0.15 and spans["b"]["server"] is None
+    assert spans["c"]["network"] >= 0.0
+    # the most recent requests come first
+    assert recent_status == 200 and len(recent) == 1 and recent[0]["request_id"] != request_id
+    assert missing_status == 404